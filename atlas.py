@@ -0,0 +1,239 @@
+# ------------------------------------------------------------
+# Filename: atlas.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# System Imports
+import os
+import json
+import hashlib
+import pygame
+from pygame import Rect
+
+# Local Imports
+import images
+
+# Largest sheet the packer will create
+MAX_SHEET_SIZE = (2048, 2048)
+
+# Version of the on-disk index format
+INDEX_VERSION = 2
+
+
+# Helper Functions
+def _key(path):
+	"""Returns the normalized path used to look images up in an atlas."""
+	return os.path.normcase(os.path.abspath(path))
+
+def _colorkey(trans):
+	"""Returns the (r, g, b) of a Tiled trans color such as "ff00ff", or None."""
+	if trans is None:
+		return None
+	return tuple(pygame.Color("#" + trans.lstrip("#")))[:3]
+
+def _colorkeys(trans):
+	"""Returns a dict of normalized image path to (r, g, b) for a dict of path to trans color."""
+	return dict((_key(path), _colorkey(value)) for path, value in (trans or {}).items() if value is not None)
+
+def pack(sizes, max_size = MAX_SHEET_SIZE):
+	"""
+	Packs rectangles of the given (w, h) sizes into as few sheets as possible using
+	shelves of similar height. Returns a (sheet, Rect) pair for each size, in order,
+	and the list of sheet sizes.
+
+	"""
+	max_w, max_h = max_size
+	order = sorted(range(len(sizes)), key = lambda i: (-sizes[i][1], -sizes[i][0]))
+	placed = [None] * len(sizes)
+	sheets = []
+	sheet = x = y = shelf_h = used_w = 0
+	for i in order:
+		w, h = sizes[i]
+		if w > max_w or h > max_h:
+			raise ValueError("Image of size %dx%d does not fit in a %dx%d sheet." % (w, h, max_w, max_h))
+		if x + w > max_w:
+			# Start a New Shelf
+			x, y, shelf_h = 0, y + shelf_h, 0
+		if y + h > max_h:
+			# Start a New Sheet
+			sheets.append((used_w, y))
+			sheet, x, y, shelf_h, used_w = sheet + 1, 0, 0, 0, 0
+		placed[i] = (sheet, Rect(x, y, w, h))
+		x += w
+		shelf_h = max(shelf_h, h)
+		used_w = max(used_w, x)
+	if placed:
+		sheets.append((used_w, y + shelf_h))
+	return placed, sheets
+
+
+# Atlas Class
+class Atlas:
+	"""
+	A few large sheets holding many small images, so they are loaded with a few file
+	opens and blitted from the same memory. Images are looked up by their file path.
+
+	Data members:
+	sheets    -- List of sheet Surfaces. Converted to the display format once it exists.
+	index     -- Dict of normalized image path to a (sheet number, Rect) pair.
+	colorkeys -- Dict of normalized image path to the (r, g, b) colorkey that was made
+	             transparent when the image was packed. Images without one are absent.
+
+	"""
+	def __init__(self, sheets, index, colorkeys = None):
+		"""See Atlas object's Docstring."""
+		self.sheets = sheets
+		self.index = index
+		self.colorkeys = colorkeys or {}
+		images.when_ready(self._convert)
+
+	def _convert(self):
+		self.sheets = [images.convert(sheet, alpha = True) for sheet in self.sheets]
+
+	def __contains__(self, path):
+		return _key(path) in self.index
+
+	def __len__(self):
+		return len(self.index)
+
+	def has(self, path, trans = None):
+		"""
+		Returns whether the atlas holds the image at path packed with the Tiled trans
+		colorkey (such as "ff00ff", or None for an image used as it is).
+
+		"""
+		key = _key(path)
+		return key in self.index and self.colorkeys.get(key) == _colorkey(trans)
+
+	def get(self, path):
+		"""
+		Returns the image for the path, as a subsurface of its sheet. Subsurfaces taken
+		before the display exists must be taken again after images.convert_pending().
+
+		"""
+		sheet, rect = self.index[_key(path)]
+		return self.sheets[sheet].subsurface(rect)
+
+	@classmethod
+	def build(cls, paths, max_size = MAX_SHEET_SIZE, trans = None):
+		"""
+		Creates an atlas holding the images at the given paths. trans is a dict of path
+		to a Tiled colorkey such as "ff00ff": those images are packed as images.convert
+		would key them, opaque but for the colorkey pixels, which are left transparent.
+
+		"""
+		paths = sorted(set(_key(path) for path in paths))
+		colorkeys = _colorkeys(trans)
+		loaded = [pygame.image.load(path) for path in paths]
+		placed, sizes = pack([image.get_size() for image in loaded], max_size)
+		sheets = [pygame.Surface(size, pygame.SRCALPHA, 32) for size in sizes]
+		for path, image, (sheet, rect) in zip(paths, loaded, placed):
+			colorkey = colorkeys.get(path)
+			if colorkey is not None:
+				# Drop Any Alpha and Keep the Colorkey Pixels' Color Under Zero Alpha
+				image = pygame.image.frombuffer(pygame.image.tostring(image, "RGB"), image.get_size(), "RGB")
+				image.set_colorkey(colorkey)
+				sheets[sheet].fill(colorkey + (0,), rect)
+			sheets[sheet].blit(image, rect)
+		colorkeys = dict((path, colorkeys[path]) for path in paths if path in colorkeys)
+		return cls(sheets, dict(zip(paths, placed)), colorkeys)
+
+	def save(self, path):
+		"""Saves the sheets as path-N.png next to a path.json index."""
+		root, ext = os.path.splitext(path)
+		index = {}
+		for key, (sheet, rect) in self.index.items():
+			index[key] = [sheet, rect.x, rect.y, rect.width, rect.height]
+		for i, sheet in enumerate(self.sheets):
+			pygame.image.save(sheet, "%s-%d.png" % (root, i))
+		colorkeys = dict((key, list(colorkey)) for key, colorkey in self.colorkeys.items())
+		with open(root + ".json", "w") as f:
+			json.dump({"version": INDEX_VERSION, "sheets": len(self.sheets), "index": index,
+				"colorkeys": colorkeys}, f)
+
+	@classmethod
+	def load(cls, path):
+		"""Loads an atlas written by save()."""
+		root, ext = os.path.splitext(path)
+		with open(root + ".json") as f:
+			data = json.load(f)
+		if data.get("version") != INDEX_VERSION:
+			raise ValueError("Unsupported atlas index version: " + str(data.get("version")))
+		sheets = [pygame.image.load("%s-%d.png" % (root, i)) for i in range(data["sheets"])]
+		index = {}
+		for key, (sheet, x, y, w, h) in data["index"].items():
+			index[key] = (sheet, Rect(x, y, w, h))
+		colorkeys = dict((key, tuple(colorkey)) for key, colorkey in data["colorkeys"].items())
+		return cls(sheets, index, colorkeys)
+
+
+# Loading Functions
+def cache_key(paths, trans = None):
+	"""Returns a hash of the image paths, their sizes, modification times and colorkeys."""
+	colorkeys = _colorkeys(trans)
+	digest = hashlib.sha1()
+	for path in sorted(set(_key(path) for path in paths)):
+		stat = os.stat(path)
+		digest.update(("%s\0%d\0%d\0%r\n" % (path, stat.st_size, stat.st_mtime_ns,
+			colorkeys.get(path))).encode("utf-8"))
+	return digest.hexdigest()
+
+def remove_stale(cache_dir, atlas, keep):
+	"""
+	Removes the atlases cached in cache_dir, other than the one saved as keep, that
+	only hold images the given atlas also holds: they were built from older versions
+	of its images and would never be loaded again. Atlases of other image sets stay.
+
+	"""
+	keep = os.path.splitext(os.path.basename(keep))[0]
+	for name in os.listdir(cache_dir):
+		root, ext = os.path.splitext(name)
+		if ext != ".json" or root == keep:
+			continue
+		root = os.path.join(cache_dir, root)
+		try:
+			with open(root + ".json") as f:
+				data = json.load(f)
+			if not all(key in atlas.index for key in data["index"]):
+				continue
+			sheets = data["sheets"]
+		except (IOError, ValueError, KeyError, TypeError):
+			continue
+		for i in range(sheets):
+			try:
+				os.remove("%s-%d.png" % (root, i))
+			except OSError:
+				pass
+		try:
+			os.remove(root + ".json")
+		except OSError:
+			pass
+
+def load_atlas(paths, cache_dir = ".atlas", max_size = MAX_SHEET_SIZE, trans = None):
+	"""
+	Returns an atlas holding the images at the given paths, with trans as for
+	Atlas.build. The atlas is cached in cache_dir and rebuilt when any of the images
+	or colorkeys is changed, added or removed; the atlas it replaces is removed.
+
+	"""
+	path = os.path.join(cache_dir, cache_key(paths, trans) + ".png")
+	if os.path.exists(os.path.splitext(path)[0] + ".json"):
+		try:
+			return Atlas.load(path)
+		except (IOError, ValueError, KeyError, pygame.error):
+			pass
+	atlas = Atlas.build(paths, max_size, trans)
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+	atlas.save(path)
+	remove_stale(cache_dir, atlas, path)
+	return atlas
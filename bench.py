@@ -0,0 +1,755 @@
+# ------------------------------------------------------------
+# Filename: bench.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# Headless Display (must be set before PyGame starts)
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+# System Imports
+import sys
+import gzip
+import time
+import base64
+import random
+import struct
+import tempfile
+import tracemalloc
+import pygame
+
+# Local Imports
+import world
+import images
+import tmx
+import tmxloader3
+import mapcache
+import pathfinding
+import streaming
+import compile_maps
+
+# Registered Benchmarks
+BENCHMARKS = {}
+
+def benchmark(func):
+	"""Registers a benchmark so it can be run by name from the command line."""
+	BENCHMARKS[func.__name__[len("bench_"):]] = func
+	return func
+
+
+# Helper Functions
+def timed(func, repeat):
+	"""Returns the average time (in ms) of calling func repeat times."""
+	start = time.perf_counter()
+	for i in range(repeat):
+		func()
+	return (time.perf_counter() - start) * 1000.0 / repeat
+
+def make_tile(tile_size, color):
+	"""Returns a world.Tile with a solid colored image, without touching the disk."""
+	tile = world.Tile.__new__(world.Tile)
+	pygame.sprite.Sprite.__init__(tile)
+	tile.image = pygame.Surface((tile_size, tile_size))
+	tile.image.fill(color)
+	return tile
+
+def make_map(size, tile_size = 56):
+	"""Returns a world.Map of size x size tiles, without touching the disk."""
+	map_obj = world.Map.__new__(world.Map)
+	map_obj.map_name = "bench"
+	map_obj.map_size = (size, size)
+	map_obj.tile_size = (tile_size, tile_size)
+	map_obj.tile_list = [make_tile(tile_size, (i*40, 100, 200 - i*40)) for i in range(4)]
+	map_obj.map_data = [map_obj.tile_list[i % 4] for i in range(size * size)]
+	return map_obj
+
+def make_tmx(path, size, encoding = "base64", flip_rate = 0.01, seed = 1):
+	"""Writes a size x size TMX map using the grass tileset, with some flipped tiles."""
+	rand = random.Random(seed)
+	gids = [rand.randint(1, 6) for i in range(size * size)]
+	for i in rand.sample(range(size * size), int(size * size * flip_rate)):
+		gids[i] |= rand.choice((1 << 31, 1 << 30, 3 << 30))
+	if encoding == "base64":
+		data = base64.b64encode(gzip.compress(struct.pack("<%dI" % len(gids), *gids))).decode("ascii")
+		data_tag = '<data encoding="base64" compression="gzip">' + data + '</data>'
+	elif encoding == "csv":
+		data_tag = '<data encoding="csv">\n' + ",\n".join(",".join(str(gid) for gid in gids[y*size:(y+1)*size])
+			for y in range(size)) + '\n</data>'
+	else:
+		data_tag = '<data>' + "".join('<tile gid="%d"/>' % gid for gid in gids) + '</data>'
+	image = os.path.abspath("assets/tilesets/grass.png")
+	with open(path, "w") as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		f.write('<map version="1.0" orientation="orthogonal" width="%d" height="%d" tilewidth="56" tileheight="56">\n' % (size, size))
+		f.write(' <tileset firstgid="1" name="grass" tilewidth="56" tileheight="56">\n')
+		f.write('  <image source="%s" width="168" height="112"/>\n' % image)
+		f.write(' </tileset>\n')
+		f.write(' <layer name="ground" width="%d" height="%d">\n  %s\n </layer>\n' % (size, size, data_tag))
+		f.write('</map>\n')
+	return gids
+
+def make_maze(size, seed = 1):
+	"""Returns the gids of a size x size maze (1 for floor, 2 for wall) with one path between any two floor cells."""
+	rand = random.Random(seed)
+	gids = [2] * (size * size)
+	rooms = (size - 1) // 2
+	stack = [(0, 0)]
+	gids[size + 1] = 1
+	while stack:
+		x, y = stack[-1]
+		doors = [(x + dx, y + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+			if 0 <= x + dx < rooms and 0 <= y + dy < rooms and gids[(2 * (y + dy) + 1) * size + 2 * (x + dx) + 1] == 2]
+		if not doors:
+			stack.pop()
+			continue
+		nx, ny = rand.choice(doors)
+		gids[(2 * ny + 1) * size + 2 * nx + 1] = 1
+		gids[(y + ny + 1) * size + x + nx + 1] = 1
+		stack.append((nx, ny))
+	return gids
+
+
+# Benchmarks
+@benchmark
+def bench_culling():
+	"""Frame time of World's map drawing as the map grows. Should stay flat."""
+	print("%10s %12s" % ("map size", "ms / frame"))
+	for size in (16, 64, 256, 1024):
+		game = world.World((560, 560), make_map(size))
+		game.offset_x, game.offset_y = -(size * 56 // 2), -(size * 56 // 2)
+		ms = timed(lambda: game.renderer.draw(game.screen, game.get_view()), 50)
+		print("%10s %12.3f" % ("%dx%d" % (size, size), ms))
+
+@benchmark
+def bench_chunks():
+	"""Frame time of per-tile drawing against pre-baked chunks while panning a large map."""
+	print("%10s %12s %10s %12s" % ("renderer", "ms / frame", "chunks", "cached MB"))
+	for chunk_size in (None, 8, 16):
+		game = world.World((560, 560), make_map(1024), chunk_size = chunk_size, chunk_budget = 16 << 20)
+		def frame():
+			game.offset_x -= 7
+			game.renderer.draw(game.screen, game.get_view())
+		ms = timed(frame, 500)
+		if chunk_size:
+			cache = game.renderer.cache
+			print("%10s %12.3f %10d %12.1f" % ("%dx%d" % (chunk_size, chunk_size), ms, len(cache), cache.used / 1048576.0))
+		else:
+			print("%10s %12.3f %10s %12s" % ("tiles", ms, "-", "-"))
+
+@benchmark
+def bench_scroll():
+	"""Frame time and pixels drawn per frame while panning, with and without the scroll buffer."""
+	print("%10s %12s %14s" % ("renderer", "ms / frame", "fill / frame"))
+	for scroll_buffer in (False, True):
+		game = world.World((560, 560), make_map(1024), scroll_buffer = scroll_buffer)
+		area = float(560 * 560)
+		def frame():
+			game.move(world.RIGHT, game.scroll_speed)
+			game.renderer.draw(game.screen, game.get_view())
+		ms = timed(frame, 500)
+		fill = game.renderer.filled / area if scroll_buffer else 1.0
+		print("%10s %12.3f %13.1f%%" % ("scroll" if scroll_buffer else "full", ms, fill * 100))
+
+@benchmark
+def bench_dirty():
+	"""Pixels pushed to the display per frame with a still camera and a moving mouse."""
+	print("%10s %12s %14s" % ("mode", "ms / frame", "pushed / frame"))
+	positions = [(i * 13 % 560, i * 29 % 560) for i in range(200)]
+	get_pos = pygame.mouse.get_pos
+	for dirty_rects in (False, True):
+		game = world.World((560, 560), make_map(256), dirty_rects = dirty_rects)
+		pushed = [0, 0]
+		def frame():
+			# the dummy video driver ignores mouse.set_pos(), so fake the mouse instead
+			pygame.mouse.get_pos = lambda: positions[pushed[1] % len(positions)]
+			rects = game.draw()
+			if game.dirty is None:
+				pygame.display.flip()
+			else:
+				game.dirty.extend(rects)
+				rects = game.dirty.flush()
+			pushed[0] += sum(rect.width * rect.height for rect in rects)
+			pushed[1] += 1
+		ms = timed(frame, 200)
+		print("%10s %12.3f %13.1f%%" % ("dirty" if dirty_rects else "flip", ms, 100.0 * pushed[0] / pushed[1] / (560 * 560)))
+	pygame.mouse.get_pos = get_pos
+
+@benchmark
+def bench_convert():
+	"""
+	Blit throughput of tiles as loaded from disk against tiles converted to the display
+	format by images.convert. Some formats (such as 8 bit images) may blit faster raw on
+	some displays; this is where that shows, the loader always converts.
+
+	"""
+	screen = images.set_mode((560, 560))
+	print("%24s %12s %12s %8s" % ("image", "raw ms", "converted ms", "speedup"))
+	for path in ("assets/raw/308.png", "assets/other/147.png", "assets/tilesets/grass.png"):
+		raw = pygame.image.load(path)
+		converted = images.convert(raw)
+		blits = [(x % 10 * 56, x // 10 % 10 * 56) for x in range(1000)]
+		raw_ms, converted_ms = [timed(lambda: screen.blits([(image, pos) for pos in blits], False), 20)
+			for image in (raw, converted)]
+		print("%24s %12.3f %12.3f %7.1fx" % (path, raw_ms, converted_ms, raw_ms / converted_ms))
+
+@benchmark
+def bench_atlas():
+	"""Load time and image file opens of map2.tmx with loose tileset images against a cached atlas."""
+	images.set_mode((560, 560))
+	load, opens = pygame.image.load, [0]
+	def counting_load(*args):
+		opens[0] += 1
+		return load(*args)
+	pygame.image.load = counting_load
+	tmxloader3.load_pygame("map2.tmx", atlas = True)
+	print("%10s %12s %10s" % ("images", "ms / load", "opens"))
+	def load_map(use_atlas):
+		images.cache.clear()
+		tmxloader3.load_pygame("map2.tmx", atlas = use_atlas or None)
+	for use_atlas in (False, True):
+		opens[0] = 0
+		ms = timed(lambda: load_map(use_atlas), 10)
+		print("%10s %12.3f %10d" % ("atlas" if use_atlas else "loose", ms, opens[0] // 10))
+	pygame.image.load = load
+
+@benchmark
+def bench_image_cache():
+	"""Time to reload map2.tmx with a cold image cache against a warm one."""
+	images.set_mode((560, 560))
+	def cold():
+		images.cache.clear()
+		tmxloader3.load_pygame("map2.tmx")
+	print("%10s %12s" % ("cache", "ms / load"))
+	print("%10s %12.3f" % ("cold", timed(cold, 10)))
+	print("%10s %12.3f" % ("warm", timed(lambda: tmxloader3.load_pygame("map2.tmx"), 10)))
+
+@benchmark
+def bench_load_tmx():
+	"""Time for tmxloader3.load_tmx to parse and decode large base64/gzip maps."""
+	print("%12s %10s %12s" % ("map size", "file MB", "load s"))
+	folder = tempfile.mkdtemp()
+	for size in (256, 1024, 2048, 4096):
+		path = os.path.join(folder, "bench%d.tmx" % size)
+		make_tmx(path, size)
+		seconds = timed(lambda: tmxloader3.load_tmx(path), 1) / 1000.0
+		print("%12s %10.1f %12.3f" % ("%dx%d" % (size, size), os.path.getsize(path) / 1048576.0, seconds))
+		os.remove(path)
+	os.rmdir(folder)
+
+@benchmark
+def bench_load_memory():
+	"""Peak Python memory while loading CSV, base64 and <tile> encoded maps, against the decoded size."""
+	print("%12s %10s %12s %10s %12s %12s" % ("map size", "encoding", "loader", "file MB", "decoded MB", "peak MB"))
+	folder = tempfile.mkdtemp()
+	def load_tmxloader3(path):
+		tiledmap = tmxloader3.load_tmx(path)
+		return sum(len(layer.data.array) * layer.data.array.itemsize for layer in tiledmap.tilelayers)
+	def load_tmx(path):
+		tilemap = tmx.load(path, (560, 560))
+		return sum(len(layer.grid) * layer.grid.itemsize for layer in tilemap.layers)
+	for size, encoding in ((512, "csv"), (1024, "csv"), (1024, "base64"), (256, "xml"), (512, "xml")):
+		path = os.path.join(folder, "bench.tmx")
+		make_tmx(path, size, encoding)
+		# tmx only reads CSV and base64 layers
+		loaders = [("tmxloader3", load_tmxloader3)]
+		if encoding != "xml":
+			loaders.append(("tmx", load_tmx))
+		for name, load in loaders:
+			tracemalloc.start()
+			decoded = load(path)
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			print("%12s %10s %12s %10.1f %12.1f %12.1f" % ("%dx%d" % (size, size), encoding, name,
+				os.path.getsize(path) / 1048576.0, decoded / 1048576.0, peak / 1048576.0))
+		os.remove(path)
+	os.rmdir(folder)
+
+@benchmark
+def bench_map_cache():
+	"""Time for load_tmx to parse large maps against loading their compiled (memory-mapped) form."""
+	print("%12s %10s %12s %12s %12s" % ("map size", "file MB", "xml s", "compile s", "compiled s"))
+	folder = tempfile.mkdtemp()
+	for size in (256, 1024, 2048):
+		path = os.path.join(folder, "bench%d.tmx" % size)
+		make_tmx(path, size)
+		cache = mapcache.cache_path(path)
+		xml = timed(lambda: tmxloader3.load_tmx(path), 1) / 1000.0
+		compile = timed(lambda: tmxloader3.load_tmx(path, cache = True), 1) / 1000.0
+		compiled = timed(lambda: tmxloader3.load_tmx(path, cache = True), 5) / 1000.0
+		print("%12s %10.1f %12.3f %12.3f %12.4f" % ("%dx%d" % (size, size),
+			os.path.getsize(path) / 1048576.0, xml, compile, compiled))
+		os.remove(path)
+		os.remove(cache)
+	os.rmdir(os.path.dirname(cache))
+	os.rmdir(folder)
+
+@benchmark
+def bench_layer_memory():
+	"""Memory held by a tmx.Layer as the map grows, and the time to look up a cell in it."""
+	print("%12s %10s %14s %12s" % ("map size", "layer MB", "bytes / cell", "get_at us"))
+	folder = tempfile.mkdtemp()
+	for size in (256, 1024, 2048):
+		path = os.path.join(folder, "bench.tmx")
+		make_tmx(path, size, flip_rate = 0)
+		tracemalloc.start()
+		tilemap = tmx.load(path, (560, 560))
+		used = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		layer = tilemap.layers[0]
+		points = [(i * 7919 % layer.px_width, i * 104729 % layer.px_height) for i in range(10000)]
+		us = timed(lambda: [layer.get_at(x, y) for x, y in points], 5) * 1000.0 / len(points)
+		print("%12s %10.1f %14.1f %12.3f" % ("%dx%d" % (size, size), used / 1048576.0, used / float(size * size), us))
+		os.remove(path)
+	os.rmdir(folder)
+
+@benchmark
+def bench_find():
+	"""Time for Layer.find and Layer.match on a 512x512 map where 1% of the cells are spawn points."""
+	folder = tempfile.mkdtemp()
+	path = os.path.join(folder, "bench.tmx")
+	make_tmx(path, 512, flip_rate = 0)
+	layer = tmx.load(path, (560, 560)).layers[0]
+	os.remove(path)
+	os.rmdir(folder)
+	rand = random.Random(1)
+	for i in rand.sample(range(512 * 512), 512 * 512 // 100):
+		layer[i % 512, i // 512]["spawn"] = i % 3
+	scan = lambda: [cell for cell in layer.cells.values() if "spawn" in cell]
+	print("%10s %12s %10s" % ("query", "ms / call", "cells"))
+	print("%10s %12.3f %10d" % ("scan", timed(scan, 3), len(scan())))
+	print("%10s %12.3f %10d" % ("find", timed(lambda: layer.find("spawn"), 20), len(layer.find("spawn"))))
+	print("%10s %12.3f %10d" % ("match", timed(lambda: layer.match(spawn = 1), 20), len(layer.match(spawn = 1))))
+
+@benchmark
+def bench_collide():
+	"""Time to collide 1k and 10k entities with the solid cells of a 256x256 map, one by one and batched."""
+	folder = tempfile.mkdtemp()
+	path = os.path.join(folder, "bench.tmx")
+	make_tmx(path, 256, flip_rate = 0)
+	tilemap = tmx.load(path, (560, 560))
+	os.remove(path)
+	os.rmdir(folder)
+	layer = tilemap.layers[0]
+	tilemap.tilesets[1].properties["solid"] = 1
+	rand = random.Random(1)
+	print("%10s %10s %12s %10s" % ("entities", "query", "ms / tick", "hits"))
+	for count in (1000, 10000):
+		rects = [pygame.Rect(rand.randrange(layer.px_width), rand.randrange(layer.px_height), 40, 40) for i in range(count)]
+		# what collide() did before the batched lookup
+		region = lambda: [[cell for cell in layer.get_in_region(rect.left, rect.top, rect.right, rect.bottom)
+			if cell.intersects(rect) and "solid" in cell] for rect in rects]
+		one_by_one = lambda: [layer.collide(rect, "solid") for rect in rects]
+		batched = lambda: layer.collide_many(rects, "solid")
+		for name, query in (("region", region), ("collide", one_by_one), ("batched", batched)):
+			hits = sum(len(cells) for cells in query())
+			print("%10d %10s %12.3f %10d" % (count, name, timed(query, 5), hits))
+
+@benchmark
+def bench_sprites():
+	"""Frame time of a SpriteLayer with 50k sprites on an 8000x8000 map, a few hundred of them in view."""
+	screen = pygame.Surface((560, 560))
+	image = pygame.Surface((24, 24))
+	rand = random.Random(1)
+	class Walker(pygame.sprite.Sprite):
+		def __init__(self):
+			pygame.sprite.Sprite.__init__(self)
+			self.image = image
+			self.rect = pygame.Rect(rand.randrange(8000), rand.randrange(8000), 24, 24)
+		def update(self, dt):
+			# one in a hundred sprites moves each tick
+			if rand.random() < 0.01:
+				self.rect.move_ip(rand.randint(-8, 8), rand.randint(-8, 8))
+	layer = tmx.SpriteLayer()
+	layer.add(*[Walker() for i in range(50000)])
+	layer.set_view(4000, 4000, 560, 560)
+	def draw_all():
+		# what draw() did before culling: blit every sprite
+		for sprite in layer.sprites():
+			screen.blit(sprite.image, (sprite.rect.x - 4000, sprite.rect.y - 4000))
+	print("%10s %12s %10s" % ("step", "ms / call", "sprites"))
+	print("%10s %12.3f %10d" % ("draw all", timed(draw_all, 5), len(layer)))
+	print("%10s %12.3f %10d" % ("draw", timed(lambda: layer.draw(screen), 50), len(layer.get_in_region(4000, 4000, 4560, 4560))))
+	print("%10s %12.3f %10d" % ("update", timed(lambda: layer.update(1), 5), len(layer)))
+	print("%10s %12.3f %10d" % ("get_near", timed(lambda: layer.get_near(4280, 4280, 200), 200), len(layer.get_near(4280, 4280, 200))))
+
+@benchmark
+def bench_depth():
+	"""Frame time of drawing 50k sprites in y order: a full sort every frame against DepthSpriteLayer."""
+	screen = pygame.Surface((560, 560))
+	image = pygame.Surface((24, 24))
+	rand = random.Random(1)
+	sprites = []
+	for i in range(50000):
+		sprite = pygame.sprite.Sprite()
+		sprite.image = image
+		sprite.rect = pygame.Rect(rand.randrange(8000), rand.randrange(8000), 24, 24)
+		sprites.append(sprite)
+	view = pygame.Rect(4000, 4000, 560, 560)
+	sorted_layer = tmx.SpriteLayer()
+	depth_layer = tmx.DepthSpriteLayer()
+	for layer in (sorted_layer, depth_layer):
+		layer.add(*sprites)
+		layer.set_view(view.x, view.y, view.width, view.height)
+	# one in a hundred sprites moves each frame
+	walkers = rand.sample(sprites, len(sprites) // 100)
+	def walk(layer):
+		for sprite in walkers:
+			sprite.rect.move_ip(rand.randint(-8, 8), rand.randint(-8, 8))
+			layer.moved(sprite)
+	def full_sort():
+		walk(sorted_layer)
+		for sprite in sorted(sorted_layer.sprites(), key = lambda sprite: sprite.rect.bottom):
+			if view.colliderect(sprite.rect):
+				screen.blit(sprite.image, (sprite.rect.x - view.x, sprite.rect.y - view.y))
+	def incremental():
+		walk(depth_layer)
+		depth_layer.draw(screen)
+	print("%12s %12s" % ("order", "ms / frame"))
+	print("%12s %12.3f" % ("full sort", timed(full_sort, 20)))
+	print("%12s %12.3f" % ("depth layer", timed(incremental, 20)))
+
+@benchmark
+def bench_path():
+	"""Time to find paths on 512x512 mazes, in each search mode, and to look them up again from the cache."""
+	folder = tempfile.mkdtemp()
+	path = os.path.join(folder, "bench.tmx")
+	make_tmx(path, 512, flip_rate = 0)
+	tilemap = tmx.load(path, (560, 560))
+	os.remove(path)
+	os.rmdir(folder)
+	layer = tilemap.layers[0]
+	tilemap.tilesets[2].properties["blocked"] = 1
+	rand = random.Random(1)
+	mazes = (("maze", make_maze(512)), ("rooms", [2 if rand.random() < 0.3 else 1 for i in range(512 * 512)]))
+	print("%8s %10s %12s %10s %12s" % ("map", "mode", "ms / path", "length", "cached us"))
+	for name, gids in mazes:
+		layer.set_gids(gids)
+		grid = pathfinding.Grid(layer)
+		floor = [(i % 512, i // 512) for i, gid in enumerate(gids) if gid == 1]
+		pairs = [(rand.choice(floor), rand.choice(floor)) for i in range(10)]
+		for mode in (pathfinding.ORTHOGONAL, pathfinding.DIAGONAL, pathfinding.JUMP):
+			finder = pathfinding.Pathfinder(grid, mode)
+			ms = timed(lambda: [finder.find(start, goal) for start, goal in pairs], 1) / len(pairs)
+			length = sum(len(finder.find(start, goal) or ()) for start, goal in pairs) / len(pairs)
+			us = timed(lambda: [finder.find(start, goal) for start, goal in pairs], 100) * 1000.0 / len(pairs)
+			print("%8s %10s %12.3f %10d %12.3f" % (name, mode, ms, length, us))
+	print("%8s %12s" % ("grid", "ms / call"))
+	print("%8s %12.3f" % ("build", timed(lambda: pathfinding.Grid(layer).detach(), 10)))
+	cell = layer[3, 3]
+	def toggle():
+		cell["blocked"] = 1
+		del cell["blocked"]
+	print("%8s %12.3f" % ("toggle", timed(toggle, 1000)))
+
+@benchmark
+def bench_flow():
+	"""Time for 200 agents on a 512x512 map to find their way to one goal: A* each, or one shared flow field."""
+	folder = tempfile.mkdtemp()
+	path = os.path.join(folder, "bench.tmx")
+	make_tmx(path, 512, flip_rate = 0)
+	tilemap = tmx.load(path, (560, 560))
+	os.remove(path)
+	os.rmdir(folder)
+	layer = tilemap.layers[0]
+	tilemap.tilesets[2].properties["blocked"] = 1
+	rand = random.Random(1)
+	gids = [2 if rand.random() < 0.3 else 1 for i in range(512 * 512)]
+	goal = (256, 256)
+	gids[goal[1] * 512 + goal[0]] = 1
+	layer.set_gids(gids)
+	grid = pathfinding.Grid(layer)
+	floor = [(i % 512, i // 512) for i, gid in enumerate(gids) if gid == 1]
+	agents = rand.sample(floor, 200)
+	print("%10s %12s" % ("step", "ms / call"))
+	for mode in (pathfinding.ORTHOGONAL, pathfinding.DIAGONAL):
+		finder = pathfinding.Pathfinder(grid, mode, cache_size = 0)
+		print("%10s %12.3f" % ("A* " + mode, timed(lambda: [finder.find(agent, goal) for agent in agents], 1)))
+		field = pathfinding.FlowField(grid, [goal], mode == pathfinding.DIAGONAL)
+		print("%10s %12.3f" % ("field " + mode, timed(lambda: pathfinding.FlowField(grid, [goal], field.diagonal), 1)))
+		print("%10s %12.3f" % ("read", timed(lambda: [field.direction_at(x, y) for x, y in agents], 100)))
+		doors = [rand.choice(floor) for i in range(100)]
+		def toggle():
+			x, y = doors.pop()
+			layer[x, y] = layer.tilesets[2 if grid.passable(x, y) else 1]
+			field.update()
+		print("%10s %12.3f" % ("repair", timed(toggle, 100)))
+
+@benchmark
+def bench_streaming():
+	"""Frame times while panning across a 2048x2048 map split into regions, loading only around the focus."""
+	folder = tempfile.mkdtemp()
+	path = os.path.join(folder, "bench.tmx")
+	make_tmx(path, 2048, flip_rate = 0)
+	world_folder = os.path.join(folder, "world")
+	start = time.perf_counter()
+	streaming.split(path, world_folder, 64)
+	print("split in %.1f s" % (time.perf_counter() - start))
+	screen = pygame.Surface((560, 560))
+	print("%22s %10s %10s %8s %8s %8s %8s" % ("mode", "mean ms", "max ms", "waits", "loads", "regions", "missing"))
+	for name, radius, prefetch in (("in view only", 0, 0), ("radius 1", 1, 0), ("radius 1 + prefetch", 1, 1)):
+		tilemap = streaming.StreamingMap(world_folder, (560, 560), radius = radius, prefetch = prefetch)
+		tilemap.set_focus(2000, 2000)
+		times = []
+		# regions in view that were not loaded after set_focus; should stay 0
+		missing = 0
+		# pan right, then down, at 32 pixels a frame
+		for i in range(1500):
+			fx, fy = (2000 + 32 * i, 2000) if i < 1000 else (2000 + 32 * 1000, 2000 + 32 * (i - 1000))
+			frame = time.perf_counter()
+			tilemap.set_focus(fx, fy)
+			missing += sum(region not in tilemap.loaded for region in tilemap.visible_regions())
+			tilemap.draw(screen)
+			times.append((time.perf_counter() - frame) * 1000.0)
+			# the rest of the frame, while regions are read in the background
+			time.sleep(0.001)
+		tilemap.close()
+		print("%22s %10.3f %10.3f %8d %8d %8d %8d" % (name, sum(times) / len(times), max(times),
+			tilemap.waits, tilemap.loads, len(tilemap.loaded), missing))
+	for name in os.listdir(world_folder):
+		os.remove(os.path.join(world_folder, name))
+	os.rmdir(world_folder)
+	os.remove(path)
+	os.rmdir(folder)
+
+@benchmark
+def bench_startup():
+	"""Startup time with a cold image cache: map2.tmx (29 small tilesets), then 8 large sheets, on 1 to 8 threads."""
+	def cold(load):
+		def run():
+			images.cache.clear()
+			load()
+		return run
+	print("%22s %8s %10s" % ("load", "workers", "ms"))
+	for workers in (1, 4):
+		ms = timed(cold(lambda: tmx.load("map2.tmx", (560, 560), workers = workers)), 20)
+		print("%22s %8d %10.3f" % ("map2.tmx (tmx)", workers, ms))
+		ms = timed(cold(lambda: tmxloader3.load_pygame("map2.tmx", workers = workers)), 20)
+		print("%22s %8d %10.3f" % ("map2.tmx (tmxloader3)", workers, ms))
+	folder = tempfile.mkdtemp()
+	rand = random.Random(1)
+	paths = []
+	for i in range(8):
+		sheet = pygame.Surface((1024, 1024))
+		for j in range(2000):
+			sheet.fill((rand.randrange(256), rand.randrange(256), rand.randrange(256)),
+				(rand.randrange(1024), rand.randrange(1024), 40, 40))
+		paths.append(os.path.join(folder, "%d.png" % i))
+		pygame.image.save(sheet, paths[-1])
+	for workers in (1, 2, 4, 8):
+		ms = timed(cold(lambda: images.preload(paths, workers)), 5)
+		print("%22s %8d %10.3f" % ("8 1024x1024 sheets", workers, ms))
+	for path in paths:
+		os.remove(path)
+	os.rmdir(folder)
+	print("(%d CPUs)" % (os.cpu_count() or 1))
+
+@benchmark
+def bench_compile():
+	"""Time to validate and compile 32 256x256 maps with compile_maps, on 1 to 8 processes."""
+	folder = tempfile.mkdtemp()
+	filenames = []
+	for i in range(32):
+		filenames.append(os.path.join(folder, "level%02d.tmx" % i))
+		make_tmx(filenames[-1], 256, encoding = ("base64", "csv", "xml")[i % 3], seed = i)
+	output = os.path.join(folder, "compiled")
+	print("%8s %10s %10s" % ("jobs", "seconds", "speedup"))
+	base = None
+	for jobs in (1, 2, 4, 8):
+		start = time.perf_counter()
+		results = compile_maps.compile_all(filenames, jobs, output)
+		seconds = time.perf_counter() - start
+		assert all(result["ok"] for result in results)
+		base = base or seconds
+		print("%8d %10.2f %9.2fx" % (jobs, seconds, base / seconds))
+	print("(%d CPUs)" % (os.cpu_count() or 1))
+	for name in os.listdir(output):
+		os.remove(os.path.join(output, name))
+	os.rmdir(output)
+	for filename in filenames:
+		os.remove(filename)
+	os.rmdir(folder)
+
+@benchmark
+def bench_dedup():
+	"""Time and Python memory to find the duplicate tiles of a 1024x1024 sheet, 3 in 4 tiles blank."""
+	print("%6s %10s %10s %10s %10s %12s" % ("tiles", "keys", "ms", "peak KB", "unique", "saved KB"))
+	for tile in (16, 64):
+		rand = random.Random(1)
+		sheet = pygame.Surface((1024, 1024), pygame.SRCALPHA, 32)
+		for y in range(0, 1024, tile):
+			for x in range(0, 1024, tile):
+				if rand.random() < 0.25:
+					sheet.fill((rand.randrange(256), rand.randrange(256), rand.randrange(256), 255), (x, y, tile, tile))
+		def pixel_keys():
+			# what load_pygame did before: a Surface and a full RGBA copy for every tile
+			cache = {}
+			for y in range(0, 1024, tile):
+				for x in range(0, 1024, tile):
+					surface = sheet.subsurface((x, y, tile, tile))
+					cache.setdefault(pygame.image.tostring(surface, "RGBA"), surface)
+			return len(cache), 0
+		def digests():
+			deduper = tmxloader3.TileDeduper()
+			unique = {}
+			for rect, digest in deduper.scan(sheet, (tile, tile)):
+				deduper.add(digest, ("sheet", None, rect), tile * tile * 4)
+				if digest not in unique:
+					unique[digest] = sheet.subsurface(rect)
+			return len(unique), deduper.bytes_saved
+		for name, func in (("pixels", pixel_keys), ("digests", digests)):
+			tracemalloc.start()
+			unique, saved = func()
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			print("%6s %10s %10.2f %10d %10d %12s" % ("%dx%d" % (tile, tile), name, timed(func, 5),
+				peak // 1024, unique, saved // 1024 if saved else "-"))
+
+@benchmark
+def bench_flipped():
+	"""Surfaces made for the flipped tiles of a 100x100 map, every tile flipped, then for 1000 runtime flips."""
+	print("%10s %10s %10s %12s %14s" % ("tiles", "ms", "surfaces", "tile MB", "runtime adds"))
+	path = os.path.join(tempfile.mkdtemp(), "flipped.tmx")
+	make_tmx(path, 100, flip_rate = 1.0)
+	def per_tile():
+		# what load_pygame did before: a new Surface (and gid) for every flipped tile
+		tiledmap = tmxloader3.load_tmx(path)
+		sheet = images.load(os.path.abspath("assets/tilesets/grass.png"))
+		tiles = [0] + [sheet.subsurface(((i % 3) * 56, (i // 3) * 56, 56, 56)) for i in range(6)]
+		made = []
+		for layer in tiledmap.tilelayers:
+			gids, flags = layer.data.array, layer.flags.array
+			for i, flag in enumerate(flags):
+				if flag:
+					made.append(pygame.transform.flip(tiles[gids[i]], flag & tmxloader3.FLIP_X, flag & tmxloader3.FLIP_Y))
+		return made, None
+	def variants():
+		tiledmap = tmxloader3.load_pygame(path)
+		made = list(tiledmap.variants.values())
+		for i in range(1000):
+			tiledmap.setTileGID(i % 100, i // 100, 0, i % 6 + 1, i % 4)
+			tiledmap.get_tile_image(i % 100, i // 100, 0)
+		return made, len(tiledmap.variants) - len(made)
+	for name, func in (("per tile", per_tile), ("variants", variants)):
+		made, added = func()
+		size = sum(surface.get_height() * surface.get_pitch() for surface in made)
+		print("%10s %10.2f %10d %12.2f %14s" % (name, timed(func, 3), len(made), size / float(1 << 20),
+			"-" if added is None else added))
+	os.remove(path)
+	os.rmdir(os.path.dirname(path))
+
+@benchmark
+def bench_tile_images():
+	"""Time to gather (and blit) a screen of tiles from a TiledMap, cell by cell against one region query."""
+	print("%10s %10s %12s %12s" % ("query", "area", "query ms", "frame ms"))
+	path = os.path.join(tempfile.mkdtemp(), "region.tmx")
+	make_tmx(path, 256)
+	tiledmap = tmxloader3.load_pygame(path)
+	screen = pygame.Surface((1920, 1080))
+	def per_cell(x, y, w, h):
+		# what a renderer had to do before: get_tile_image for every cell
+		blits = []
+		for ty in range(y, y + h):
+			for tx in range(x, x + w):
+				image = tiledmap.get_tile_image(tx, ty, 0)
+				if image:
+					blits.append((image, (tx * 56 - x * 56, ty * 56 - y * 56)))
+		return blits
+	def region(x, y, w, h):
+		return tiledmap.getTileImages((x, y, w, h), 0, (-x * 56, -y * 56))
+	for w, h in ((11, 11), (35, 20)):
+		for name, func in (("per cell", per_cell), ("region", region)):
+			query_ms = timed(lambda: func(100, 100, w, h), 200)
+			frame_ms = timed(lambda: screen.blits(func(100, 100, w, h), False), 100)
+			print("%10s %10s %12.3f %12.3f" % (name, "%dx%d" % (w, h), query_ms, frame_ms))
+	os.remove(path)
+	os.rmdir(os.path.dirname(path))
+
+@benchmark
+def bench_tiled_renderer():
+	"""Frame time of tmxloader3.TiledRenderer on map2.tmx and larger maps, against drawing every tile of every layer."""
+	print("%10s %10s %12s" % ("map", "renderer", "ms / frame"))
+	screen = pygame.Surface((800, 600))
+	folder = tempfile.mkdtemp()
+	maps = [("map2", "map2.tmx")]
+	for size in (256, 1024):
+		maps.append(("%dx%d" % (size, size), os.path.join(folder, "%d.tmx" % size)))
+		make_tmx(maps[-1][1], size)
+	for name, path in maps:
+		renderer = tmxloader3.TiledRenderer(path)
+		tiledmap = renderer.tiledmap
+		if name != "map2":
+			# and a half transparent copy of the ground on top of it
+			top = tmxloader3.TiledLayer()
+			top.name, top.width, top.height, top.opacity = "top", tiledmap.width, tiledmap.height, 0.5
+			top.data, top.flags = tiledmap.tilelayers[0].data, tiledmap.tilelayers[0].flags
+			tiledmap.tilelayers.append(top)
+			tiledmap.layers.append(top)
+		def every_tile():
+			# what TiledRenderer.render did before (ported to Python 3): every tile, one blit at a time
+			for layer in range(len(tiledmap.tilelayers)):
+				for y in range(tiledmap.height):
+					for x in range(tiledmap.width):
+						tile = tiledmap.get_tile_image(x, y, layer)
+						if tile: screen.blit(tile, (x * tiledmap.tilewidth, y * tiledmap.tileheight))
+		view = pygame.Rect(0, 0, 800, 600)
+		def frame():
+			view.x += 7
+			renderer.render(screen, view)
+		if name != "1024x1024":
+			print("%10s %10s %12.3f" % (name, "every tile", timed(every_tile, 3)))
+		print("%10s %10s %12.3f" % (name, "culled", timed(frame, 100)))
+	for name, path in maps[1:]:
+		os.remove(path)
+	os.rmdir(folder)
+
+@benchmark
+def bench_flatten():
+	"""Frame time of a 256x256 tmx.TileMap with 5 static layers and 1 dynamic one, per layer against flattened."""
+	print("%22s %12s %12s" % ("layers", "ms / frame", "edit ms"))
+	path = os.path.join(tempfile.mkdtemp(), "layers.tmx")
+	make_tmx(path, 256, flip_rate = 0)
+	screen = pygame.Surface((800, 600))
+	for name, flatten, alpha in (("one by one", False, True), ("flattened", True, True), ("flattened, opaque", True, False)):
+		tilemap = tmx.load(path, (800, 600))
+		rand = random.Random(1)
+		tilemap.layers[0].static = True
+		# road, decoration, shadows... mostly empty, and a dynamic layer on top
+		for i, density in enumerate((0.4, 0.2, 0.1, 0.1, 0.05)):
+			layer = tmx.Layer("layer%d" % i, 1, tilemap)
+			layer.set_gids([rand.randint(1, 6) if rand.random() < density else 0 for j in range(256 * 256)])
+			layer.static = i < 4
+			tilemap.layers.add_named(layer, layer.name)
+		if flatten:
+			tilemap.flatten(alpha = alpha)
+		focus = [400, 7000]
+		def frame():
+			focus[0] += 8
+			tilemap.set_focus(*focus)
+			tilemap.draw(screen)
+		frame_ms = timed(frame, 300)
+		def edit():
+			# change a static tile in view, and draw the frame it shows up in
+			tilemap.layers["layer1"][focus[0] // 56, 125] = tilemap.tilesets[3]
+			tilemap.draw(screen)
+		print("%22s %12.3f %12.3f" % (name, frame_ms, timed(edit, 100)))
+	os.remove(path)
+	os.rmdir(os.path.dirname(path))
+
+# Run Benchmarks
+if __name__ == "__main__":
+	names = sys.argv[1:] or sorted(BENCHMARKS)
+	for name in names:
+		print("== " + name + " ==")
+		BENCHMARKS[name]()
+		print("")
+	pygame.quit()
@@ -0,0 +1,195 @@
+# ------------------------------------------------------------
+# Filename: compile_maps.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+#
+# Validates and compiles every TMX map under a folder, on one process per core:
+#
+#   python compile_maps.py levels/ [--jobs N] [--output DIR] [--report FILE]
+#
+# Each map is loaded with tmxloader3.load_tmx, its layers' gids are checked against the
+# tilesets' gid ranges, and valid maps are written in compiled form (see mapcache), where
+# tmxloader3.load_tmx(..., cache = True) and tmx.TileMap.load(..., cache = True) find them.
+# Maps compiled into another folder with --output are found by passing the same folder as
+# cache_dir to those loaders.
+
+# System Imports
+import os
+import sys
+import json
+import time
+import bisect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Local Imports
+import tmxloader3
+import mapcache
+
+# Most bad gids reported per layer
+MAX_REPORTED_GIDS = 10
+
+
+# Validation Functions
+def gid_ranges(tiledmap):
+	"""
+	Returns the (firstgid, lastgid, name) of each tileset of a loaded map, sorted by firstgid.
+	A tileset whose size is unknown is taken to reach up to the next tileset.
+
+	"""
+	tilesets = sorted(tiledmap.tilesets, key = lambda t: t.firstgid)
+	ranges = []
+	for i, t in enumerate(tilesets):
+		lastgid = t.lastgid
+		if lastgid < t.firstgid:
+			lastgid = tilesets[i + 1].firstgid - 1 if i + 1 < len(tilesets) else sys.maxsize
+		ranges.append((t.firstgid, lastgid, t.name))
+	return ranges
+
+def validate(tiledmap):
+	"""Returns a list of messages describing the problems with a loaded map's gids (empty if it is valid)."""
+	errors = []
+	ranges = gid_ranges(tiledmap)
+	for (first, last, name), (next_first, next_last, next_name) in zip(ranges, ranges[1:]):
+		if next_first <= last:
+			errors.append("tilesets %s (gids %d-%d) and %s (gids %d-%d) overlap" % (name, first, last,
+				next_name, next_first, next_last))
+
+	starts = [first for first, last, name in ranges]
+	for layer in tiledmap.tilelayers:
+		# each distinct gid is only looked up once
+		used = set(layer.data.array)
+		used.discard(0)
+		bad = []
+		for gid in sorted(used):
+			i = bisect.bisect_right(starts, gid) - 1
+			if i < 0 or gid > ranges[i][1]:
+				bad.append(gid)
+		if bad:
+			shown = ", ".join(str(gid) for gid in bad[:MAX_REPORTED_GIDS])
+			if len(bad) > MAX_REPORTED_GIDS:
+				shown += " and %d more" % (len(bad) - MAX_REPORTED_GIDS)
+			errors.append("layer %s uses gids in no tileset: %s" % (layer.name, shown))
+	return errors
+
+
+# Compilation Functions
+def compile_map(filename, cache_dir = None):
+	"""
+	Loads, validates and (if it is valid) compiles one map. Returns a dict describing the
+	result; any exception is reported in it rather than raised, so one broken map does not
+	stop a batch.
+
+	"""
+	result = {"map": filename, "ok": False, "errors": [], "output": None,
+		"load_ms": 0.0, "validate_ms": 0.0, "save_ms": 0.0}
+	try:
+		start = time.perf_counter()
+		tiledmap = tmxloader3.load_tmx(filename)
+		loaded = time.perf_counter()
+		result["errors"] = validate(tiledmap)
+		validated = time.perf_counter()
+		result["load_ms"] = (loaded - start) * 1000.0
+		result["validate_ms"] = (validated - loaded) * 1000.0
+		result["size"] = [tiledmap.width, tiledmap.height]
+		result["layers"] = len(tiledmap.tilelayers)
+		if not result["errors"]:
+			output = mapcache.cache_path(filename, cache_dir)
+			mapcache.save(tiledmap, output)
+			result["save_ms"] = (time.perf_counter() - validated) * 1000.0
+			result["output"] = output
+			result["ok"] = True
+	except Exception as e:
+		result["errors"].append("%s: %s" % (type(e).__name__, e))
+	return result
+
+def find_maps(folder):
+	"""Returns the paths of the TMX files under folder, sorted."""
+	found = []
+	for root, dirs, files in os.walk(folder):
+		# compiled maps and atlases are not sources
+		dirs[:] = [name for name in dirs if name not in (mapcache.CACHE_DIR, ".atlas")]
+		found.extend(os.path.join(root, name) for name in files if name.lower().endswith(".tmx"))
+	return sorted(found)
+
+def compile_all(filenames, jobs = None, cache_dir = None):
+	"""
+	Compiles the maps on a pool of jobs processes (one per core by default), largest files
+	first so a big map started last does not hold the batch up. Returns the compile_map
+	results in the order of filenames.
+
+	"""
+	jobs = jobs or os.cpu_count() or 1
+	order = sorted(range(len(filenames)), key = lambda i: -os.path.getsize(filenames[i]))
+	results = [None] * len(filenames)
+	if jobs == 1:
+		for i in order:
+			results[i] = compile_map(filenames[i], cache_dir)
+		return results
+	with ProcessPoolExecutor(jobs) as pool:
+		futures = [(i, pool.submit(compile_map, filenames[i], cache_dir)) for i in order]
+		for i, future in futures:
+			results[i] = future.result()
+	return results
+
+
+# Reporting Functions
+def summary(results, seconds):
+	"""Returns the summary report of a batch, as the dict written by --report."""
+	failed = [result for result in results if not result["ok"]]
+	return {
+		"maps": len(results),
+		"compiled": len(results) - len(failed),
+		"failed": len(failed),
+		"seconds": seconds,
+		"load_ms": sum(result["load_ms"] for result in results),
+		"validate_ms": sum(result["validate_ms"] for result in results),
+		"save_ms": sum(result["save_ms"] for result in results),
+		"slowest": sorted(results, key = lambda result: -result["load_ms"])[:5],
+		"results": results,
+	}
+
+def print_summary(report, out = sys.stdout):
+	"""Prints a summary report: one line per map, its errors, then the totals."""
+	out.write("%-40s %6s %10s %10s %10s\n" % ("map", "status", "load ms", "check ms", "save ms"))
+	for result in report["results"]:
+		out.write("%-40s %6s %10.1f %10.1f %10.1f\n" % (result["map"][-40:], "ok" if result["ok"] else "FAILED",
+			result["load_ms"], result["validate_ms"], result["save_ms"]))
+		for error in result["errors"]:
+			out.write("    " + error + "\n")
+	out.write("\n%d maps: %d compiled, %d failed in %.2f s (%.1f s of loading, %.1f s of saving over all processes)\n" % (
+		report["maps"], report["compiled"], report["failed"], report["seconds"],
+		report["load_ms"] / 1000.0, report["save_ms"] / 1000.0))
+
+
+# Command Line
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = "Validate and compile every TMX map under a folder.")
+	parser.add_argument("folder", help = "folder searched (recursively) for .tmx files")
+	parser.add_argument("--jobs", "-j", type = int, default = None, help = "number of processes (default: one per core)")
+	parser.add_argument("--output", "-o", default = None,
+		help = "folder for the compiled maps (default: %s next to each map)" % mapcache.CACHE_DIR)
+	parser.add_argument("--report", default = None, help = "also write the summary report to this JSON file")
+	args = parser.parse_args(argv)
+
+	filenames = find_maps(args.folder)
+	start = time.perf_counter()
+	results = compile_all(filenames, args.jobs, args.output)
+	report = summary(results, time.perf_counter() - start)
+	print_summary(report)
+	if args.report:
+		with open(args.report, "w") as f:
+			json.dump(report, f, indent = 1)
+	return 1 if report["failed"] else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,264 @@
+# ------------------------------------------------------------
+# Filename: images.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# System Imports
+import os
+import pygame
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Default memory budget for cached images (in bytes)
+DEFAULT_CACHE_BUDGET = 64 * 1024 * 1024
+
+# Default number of threads decoding images in preload (PyGame releases the GIL while decoding)
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+# Smallest total file size preload decodes on threads; starting them costs more for less
+PARALLEL_MIN_BYTES = 256 * 1024
+
+# Callbacks waiting for the display to be created
+_pending = []
+
+# Images waiting for the display to be created, as (path, alpha, colorkey) keys in load order
+_pending_images = OrderedDict()
+
+
+# Display Functions
+def display_ready():
+	"""Returns True once the display has been created, so Surfaces can be converted."""
+	return pygame.display.get_init() and pygame.display.get_surface() is not None
+
+def set_mode(*args, **kwargs):
+	"""Creates the display (see pygame.display.set_mode) and runs any queued conversions."""
+	screen = pygame.display.set_mode(*args, **kwargs)
+	convert_pending()
+	return screen
+
+
+# Conversion Functions
+def convert(surface, alpha = None, colorkey = None):
+	"""
+	Returns a copy of the surface in the display's pixel format, so blitting it does not
+	need a per-pixel format conversion. Must be called after the display is created.
+
+	Arguments:
+	alpha    -- Keep per-pixel alpha. None keeps it only if the surface has it.
+	colorkey -- Color to treat as transparent on the converted surface. With alpha,
+	            pixels of this color are made transparent instead.
+
+	"""
+	if alpha is None:
+		alpha = bool(surface.get_flags() & pygame.SRCALPHA)
+	if alpha:
+		if colorkey is not None:
+			# Colorkey pixels become fully transparent
+			surface = surface.copy()
+			surface.set_colorkey(colorkey)
+		return surface.convert_alpha()
+	converted = surface.convert()
+	if colorkey is not None:
+		converted.set_colorkey(colorkey)
+	return converted
+
+def when_ready(callback):
+	"""Calls callback() now if the display exists, otherwise as soon as it is created."""
+	if display_ready():
+		callback()
+	else:
+		_pending.append(callback)
+
+def convert_later(surface, setter, alpha = None, colorkey = None):
+	"""Converts the surface (see convert) when the display is ready and passes the result to setter."""
+	when_ready(lambda: setter(convert(surface, alpha, colorkey)))
+
+def convert_pending():
+	"""
+	Converts the images queued by load_queued and runs the conversions queued before the
+	display was created. Returns how many ran.
+
+	"""
+	if not display_ready():
+		return 0
+	count = 0
+	while _pending_images:
+		(path, alpha, colorkey), value = _pending_images.popitem(last = False)
+		if os.path.exists(path):
+			load(path, alpha, colorkey)
+		count += 1
+	while _pending:
+		callback = _pending.pop(0)
+		callback()
+		count += 1
+	return count
+
+
+# Image Cache Class
+class ImageCache:
+	"""
+	Process-wide cache of loaded images, so maps sharing tilesets do not decode the same
+	files again or keep duplicate pixel buffers. Images are keyed by resolved path, file
+	modification time and conversion mode, and the least recently used ones are dropped
+	when the cache is over its memory budget.
+
+	Data members:
+	budget -- Maximum number of bytes of pixel data to keep. The image added last is always kept.
+	used   -- Number of bytes of pixel data currently cached.
+	hits   -- Number of lookups that found their image.
+	misses -- Number of lookups that did not.
+
+	"""
+	def __init__(self, budget = DEFAULT_CACHE_BUDGET):
+		"""See ImageCache object's Docstring."""
+		self.budget = budget
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self._images = OrderedDict()
+
+	def __len__(self):
+		return len(self._images)
+
+	def __contains__(self, key):
+		return key in self._images
+
+	def has_file(self, key):
+		"""Returns True if the image file of a key (see key) is cached in any conversion mode."""
+		return any(cached[:2] == key[:2] for cached in self._images)
+
+	def key(self, path, mode):
+		"""Returns the cache key for an image file loaded with the given conversion mode."""
+		path = os.path.realpath(path)
+		return (path, os.stat(path).st_mtime_ns, mode)
+
+	def get(self, key):
+		"""Returns the cached Surface for key (marking it as recently used), or None."""
+		surface = self._images.get(key)
+		if surface is None:
+			self.misses += 1
+			return None
+		self._images.move_to_end(key)
+		self.hits += 1
+		return surface
+
+	def put(self, key, surface):
+		"""Adds a Surface to the cache, dropping the least recently used images over the budget."""
+		self.discard(key)
+		self._images[key] = surface
+		self.used += self._size(surface)
+		while self.used > self.budget and len(self._images) > 1:
+			old_key, old_surface = self._images.popitem(last = False)
+			self.used -= self._size(old_surface)
+
+	def discard(self, key):
+		"""Removes an image from the cache, if present."""
+		surface = self._images.pop(key, None)
+		if surface is not None:
+			self.used -= self._size(surface)
+
+	def clear(self):
+		"""Removes every image from the cache."""
+		self._images.clear()
+		self.used = 0
+
+	def _size(self, surface):
+		"""Returns the number of bytes of pixel data in a Surface."""
+		width, height = surface.get_size()
+		return width * height * surface.get_bytesize()
+
+# The Shared Cache
+cache = ImageCache()
+
+
+# Loading Functions
+def load(path, alpha = None, colorkey = None):
+	"""
+	Loads an image through the shared cache. It is converted to the display format right
+	away if the display exists, otherwise the raw image is returned (see load_later).
+	The returned Surface may be shared, so it must not be drawn on.
+
+	"""
+	if colorkey is not None:
+		colorkey = tuple(pygame.Color(colorkey))
+	raw_key = cache.key(path, None)
+	if not display_ready():
+		raw = cache.get(raw_key)
+		if raw is None:
+			raw = pygame.image.load(path)
+			cache.put(raw_key, raw)
+		return raw
+
+	key = raw_key[:2] + ((alpha, colorkey),)
+	surface = cache.get(key)
+	if surface is None:
+		raw = cache.get(raw_key)
+		if raw is None:
+			raw = pygame.image.load(path)
+		surface = convert(raw, alpha, colorkey)
+		cache.put(key, surface)
+		# The converted image replaces the raw one
+		cache.discard(raw_key)
+	return surface
+
+def preload(paths, workers = None):
+	"""
+	Decodes the image files that are not cached yet on a pool of worker threads and adds
+	them to the shared cache, so the load() calls that follow only have to convert them.
+	Slicing and converting stays on the calling thread. Returns how many were decoded.
+
+	Arguments:
+	paths   -- Paths of the image files. Duplicates are decoded once.
+	workers -- Number of threads decoding. Defaults to DEFAULT_WORKERS. With 1 (or less than
+	           PARALLEL_MIN_BYTES of files) the images are decoded in the calling thread.
+
+	"""
+	keys = OrderedDict()
+	for path in paths:
+		key = cache.key(path, None)
+		if key not in keys and not cache.has_file(key):
+			keys[key] = path
+	if workers is None:
+		workers = DEFAULT_WORKERS
+	if workers <= 1 or len(keys) <= 1 or sum(os.path.getsize(key[0]) for key in keys) < PARALLEL_MIN_BYTES:
+		decoded = map(pygame.image.load, keys.values())
+		for key, surface in zip(keys, decoded):
+			cache.put(key, surface)
+		return len(keys)
+	with ThreadPoolExecutor(min(workers, len(keys))) as pool:
+		# The cache is only touched from this thread
+		for key, surface in zip(keys, pool.map(pygame.image.load, keys.values())):
+			cache.put(key, surface)
+	return len(keys)
+
+def load_queued(path, alpha = None, colorkey = None):
+	"""
+	Loads an image (see load). If the display does not exist yet, only the image's key is
+	queued, so it is converted with the other queued images once it is created and the
+	next load() of it is a cache hit; nothing else is kept alive until then.
+
+	"""
+	if colorkey is not None:
+		colorkey = tuple(pygame.Color(colorkey))
+	if not display_ready():
+		_pending_images[path, alpha, colorkey] = None
+	return load(path, alpha, colorkey)
+
+def load_later(path, setter, alpha = None, colorkey = None):
+	"""
+	Loads an image (see load) and passes it to setter. If the display does not exist yet,
+	setter is called again with the converted image once it is created.
+
+	"""
+	setter(load(path, alpha, colorkey))
+	if not display_ready():
+		when_ready(lambda: setter(load(path, alpha, colorkey)))
@@ -0,0 +1,273 @@
+# ------------------------------------------------------------
+# Filename: mapcache.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# System Imports
+import os
+import sys
+import mmap
+import json
+import array
+import struct
+import hashlib
+
+# Local Imports
+import tmxloader3
+
+# Marks a compiled map file
+MAGIC = b"PGTMAP\r\n"
+
+# Version of the compiled map format
+FORMAT_VERSION = 4
+
+# Magic, format version and length of the JSON metadata that follows
+HEADER = struct.Struct("<8sII")
+
+# Layer arrays start on a multiple of this many bytes
+ALIGN = 8
+
+# Folder (next to the map) compiled maps are kept in
+CACHE_DIR = ".mapcache"
+
+# Attributes kept out of the metadata, as they are stored separately
+_SKIPPED = set(["layers", "tilesets", "tilelayers", "objectgroups", "tile_properties",
+	"images", "filename", "data", "flags", "objects", "variants", "make_variant"])
+
+
+# Helper Functions
+def _attributes(obj):
+	"""Returns the plain attributes of a loaded TMX element as a dict."""
+	attrs = {}
+	for name in getattr(obj, "__slots__", ()):
+		if hasattr(obj, name):
+			attrs[name] = getattr(obj, name)
+	attrs.update(getattr(obj, "__dict__", {}))
+	return dict((k, v) for k, v in attrs.items() if k not in _SKIPPED)
+
+def _restore(obj, attrs):
+	"""Sets the attributes saved by _attributes on a new element."""
+	for name, value in attrs.items():
+		setattr(obj, name, value)
+	return obj
+
+def _digest(path):
+	"""Returns the sha1 of a file's contents."""
+	digest = hashlib.sha1()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(1 << 16), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+def _stamp(path):
+	"""Returns the [path, size, mtime_ns, sha1] a compiled map uses to check a file for changes."""
+	stat = os.stat(path)
+	return [path, stat.st_size, stat.st_mtime_ns, _digest(path)]
+
+def _refresh(stamp):
+	"""
+	Returns the stamp if the file is unchanged since it was stamped, or None if it changed.
+	The contents are only hashed when the modification time differs, so touching a file
+	does not invalidate; the stamp returned then has the new modification time.
+
+	"""
+	path, size, mtime_ns, digest = stamp
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	if stat.st_size != size:
+		return None
+	if stat.st_mtime_ns == mtime_ns:
+		return stamp
+	if _digest(path) != digest:
+		return None
+	return [path, size, stat.st_mtime_ns, digest]
+
+def _little_endian(gids):
+	"""Returns the bytes of an array of gids (or flags) in little-endian order."""
+	if sys.byteorder == "little" or memoryview(gids).itemsize == 1:
+		return memoryview(gids).cast("B")
+	gids = array.array(gids.typecode, gids)
+	gids.byteswap()
+	return memoryview(gids).cast("B")
+
+def _typecode(itemsize):
+	"""Returns the array typecode for unsigned ints of the given size."""
+	return {1: "B", 2: "H"}.get(itemsize, tmxloader3._UINT32)
+
+def _align(offset):
+	return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+# Dependency Functions
+def dependencies(tiledmap):
+	"""Returns the paths of the files a loaded map was built from: the TMX, its TSX and its images."""
+	folder = os.path.dirname(tiledmap.filename)
+	paths = [tiledmap.filename]
+	for tileset in tiledmap.tilesets:
+		if getattr(tileset, "tsx", None):
+			paths.append(os.path.join(folder, tileset.tsx))
+		if getattr(tileset, "source", None):
+			paths.append(os.path.join(folder, tileset.source))
+	return [os.path.abspath(path) for path in paths]
+
+def cache_path(filename, cache_dir = None):
+	"""Returns where the compiled form of a TMX file is kept. cache_dir defaults to CACHE_DIR next to the map."""
+	filename = os.path.realpath(filename)
+	if cache_dir is None:
+		cache_dir = os.path.join(os.path.dirname(filename), CACHE_DIR)
+	name = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+	return os.path.join(cache_dir, name + ".tmc")
+
+
+# Compiled Map Functions
+def save(tiledmap, path, stamps = None):
+	"""
+	Writes a map loaded by tmxloader3.load_tmx (before load_pygame changes it) to path.
+	The file is a small header, JSON metadata holding the map, tileset, layer and object
+	attributes and stamps of the files it depends on, then each layer's gids and flip
+	flags as aligned little-endian arrays. stamps may give the files' stamps if they are
+	already known, instead of hashing the files again.
+
+	"""
+	arrays = []
+	offset = 0
+	def add_array(data, itemsize):
+		# Returns the [offset, itemsize, count] of an array in the data section
+		entry = [offset, itemsize, len(data)]
+		arrays.append(data)
+		return entry
+
+	layers = []
+	for layer in tiledmap.layers:
+		if isinstance(layer, tmxloader3.TiledLayer):
+			gids = layer.data.array
+			entry = {"kind": "tiles", "attrs": _attributes(layer), "flags": None}
+			entry["gids"] = add_array(gids, gids.itemsize)
+			offset = _align(offset + len(gids) * gids.itemsize)
+			if layer.flags is not None:
+				entry["flags"] = add_array(layer.flags.array, 1)
+				offset = _align(offset + len(layer.flags.array))
+		else:
+			entry = {"kind": "objects", "attrs": _attributes(layer),
+				"objects": [_attributes(obj) for obj in layer.objects]}
+		layers.append(entry)
+
+	meta = {
+		"dependencies": stamps or [_stamp(path) for path in dependencies(tiledmap)],
+		"map": _attributes(tiledmap),
+		"tilesets": [_attributes(tileset) for tileset in tiledmap.tilesets],
+		"tile_properties": [[gid, dict(props)] for gid, props in tiledmap.tile_properties.items()],
+		"layers": layers,
+	}
+	meta = json.dumps(meta).encode("utf-8")
+	start = _align(HEADER.size + len(meta))
+
+	folder = os.path.dirname(path)
+	if folder and not os.path.isdir(folder):
+		os.makedirs(folder)
+	# Written next to the target and renamed, so readers never see half a file
+	temp = "%s.%d.tmp" % (path, os.getpid())
+	with open(temp, "wb") as f:
+		f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(meta)))
+		f.write(meta)
+		for data in arrays:
+			f.write(b"\0" * (start - f.tell()))
+			f.write(_little_endian(data))
+			start = _align(f.tell())
+	os.replace(temp, path)
+
+def load(path, filename = None, check = True):
+	"""
+	Returns the map compiled to path as a tmxloader3.TiledMap, or None if any of the files
+	it was built from changed (unless check is False). Layer data is memory-mapped from the
+	file copy-on-write, so it is paged in as it is used and can still be changed.
+	Raises ValueError if path is not a compiled map this version can read.
+
+	"""
+	with open(path, "rb") as f:
+		data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+	if len(data) < HEADER.size:
+		raise ValueError("Not a compiled map: " + path)
+	magic, version, length = HEADER.unpack_from(data, 0)
+	if magic != MAGIC or version != FORMAT_VERSION:
+		raise ValueError("Not a compiled map of version %d: %s" % (FORMAT_VERSION, path))
+	meta = json.loads(data[HEADER.size:HEADER.size + length].decode("utf-8"))
+	stamps = meta["dependencies"]
+	if check:
+		stamps = []
+		for stamp in meta["dependencies"]:
+			stamps.append(_refresh(stamp))
+			if stamps[-1] is None:
+				return None
+	start = _align(HEADER.size + length)
+	view = memoryview(data)
+
+	def get_array(entry):
+		offset, itemsize, count = entry
+		begin = start + offset
+		items = view[begin:begin + itemsize * count].cast(_typecode(itemsize))
+		if sys.byteorder == "little" or itemsize == 1:
+			return items
+		items = array.array(items.typecode, items)
+		items.byteswap()
+		return items
+
+	tiledmap = _restore(tmxloader3.TiledMap(), meta["map"])
+	tiledmap.filename = filename or meta["dependencies"][0][0]
+	for attrs in meta["tilesets"]:
+		tiledmap.tilesets.append(_restore(tmxloader3.TiledTileset(), attrs))
+	for gid, props in meta["tile_properties"]:
+		tiledmap.tile_properties[gid] = props
+	for entry in meta["layers"]:
+		if entry["kind"] == "tiles":
+			layer = _restore(tmxloader3.TiledLayer(), entry["attrs"])
+			layer.data = tmxloader3.TiledLayerData(get_array(entry["gids"]), layer.width, layer.height)
+			if entry["flags"] is not None:
+				layer.flags = tmxloader3.TiledLayerData(get_array(entry["flags"]), layer.width, layer.height)
+			tiledmap.tilelayers.append(layer)
+		else:
+			layer = _restore(tmxloader3.TiledObjectGroup(), entry["attrs"])
+			for attrs in entry["objects"]:
+				layer.objects.append(_restore(tmxloader3.TiledObject(), attrs))
+			tiledmap.objectgroups.append(layer)
+		tiledmap.layers.append(layer)
+
+	if stamps != meta["dependencies"]:
+		# Files were only touched: stamp them again, or they would be hashed on every load
+		try:
+			save(tiledmap, path, stamps)
+		except (IOError, OSError):
+			pass
+	return tiledmap
+
+def load_tmx(filename, cache_dir = None):
+	"""
+	Loads a TMX file like tmxloader3.load_tmx, from its compiled form when that is up to
+	date. Otherwise the TMX is parsed and compiled for next time.
+
+	"""
+	path = cache_path(filename, cache_dir)
+	if os.path.exists(path):
+		try:
+			tiledmap = load(path, filename)
+		except (IOError, ValueError, KeyError):
+			tiledmap = None
+		if tiledmap is not None:
+			return tiledmap
+	tiledmap = tmxloader3.load_tmx(filename)
+	try:
+		save(tiledmap, path)
+	except (IOError, OSError):
+		pass
+	return tiledmap
@@ -0,0 +1,615 @@
+# ------------------------------------------------------------
+# Filename: pathfinding.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# System Imports
+from array import array
+from heapq import heappush, heappop, heapify
+from collections import OrderedDict
+
+# Search Modes
+ORTHOGONAL = "4"   # A*, moving North, South, East and West
+DIAGONAL = "8"     # A*, also moving diagonally (but not past the corner of a blocked cell)
+JUMP = "jps"       # Jump point search: moves like DIAGONAL, expanding far fewer cells
+
+# Cost of a straight and a diagonal step (scaled so they stay integers)
+STRAIGHT = 10
+SLANT = 14
+
+# Default number of paths a Pathfinder remembers
+DEFAULT_CACHE_SIZE = 256
+
+# Default number of flow fields a Pathfinder remembers
+DEFAULT_FIELD_CACHE_SIZE = 16
+
+# Number of passability changes a Grid remembers (see Grid.changes)
+MAX_CHANGE_LOG = 4096
+
+# Steps a FlowField can point along, as (dx, dy); its direction codes are index + 1
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1))
+
+
+# Helper Functions
+def _sign(n):
+	return (n > 0) - (n < 0)
+
+def _octile(dx, dy):
+	"""Returns the cost of the shortest 8-direction path across dx by dy cells with no obstacles."""
+	dx, dy = abs(dx), abs(dy)
+	return STRAIGHT * (dx + dy) + (SLANT - 2 * STRAIGHT) * min(dx, dy)
+
+
+# Grid Class
+class Grid:
+	"""
+	Passability grid of a tmx.Layer: a cell is blocked if it (or its tile) has the blocking
+	property. It is built from the layer's property mask and kept up to date through the
+	layer's on_change callbacks, so searches never look at Cells.
+
+	Data members:
+	layer    -- The tmx.Layer the grid is built from.
+	propname -- Name of the property that blocks a cell.
+	width    -- Width of the layer in cells.
+	height   -- Height of the layer in cells.
+	stride   -- Length of a row of the cells bytearray (the layer width plus the border).
+	cells    -- bytearray, 1 for blocked cells. The layer is surrounded by a border of blocked
+	            cells so searches need no bounds checks: cell (x, y) is at index
+	            (y + 1) * stride + x + 1.
+	version  -- Incremented whenever a cell changes passability.
+
+	"""
+	def __init__(self, layer, propname = "blocked"):
+		"""See Grid object's Docstring."""
+		self.layer = layer
+		self.propname = propname
+		self.width = layer.width
+		self.height = layer.height
+		self.stride = self.width + 2
+		self.version = 0
+		self._build()
+		layer.on_change.append(self._changed)
+
+	def rebuild(self):
+		"""
+		Builds the grid from the layer again, dropping the layer's index and mask of the
+		blocking property first (see tmx.Layer.reindex). Only needed after changing tile
+		properties, as cell changes are followed through on_change.
+
+		"""
+		self.layer.reindex(self.propname)
+		self._build()
+
+	def _build(self):
+		width, stride = self.width, self.stride
+		mask = self.layer.get_mask(self.propname)
+		cells = bytearray(b"\1") * (stride * (self.height + 2))
+		for y in range(self.height):
+			start = (y + 1) * stride + 1
+			cells[start:start + width] = mask[y * width:(y + 1) * width]
+		self.cells = cells
+		self.version += 1
+		self._source = self.layer.grid
+		# Indexes of the cells changed since _log_version, oldest first
+		self._log = []
+		self._log_version = self.version
+
+	def detach(self):
+		"""Stops following changes to the layer."""
+		self.layer.on_change.remove(self._changed)
+
+	def update(self):
+		"""Rebuilds the grid if the layer's grid was replaced without notifying it since it was built."""
+		if self.layer.grid is not self._source:
+			self.rebuild()
+
+	def _changed(self, x, y):
+		# Called by the layer when a cell is set or its properties change, or with no
+		# cell when the whole layer was refilled
+		if x is None:
+			self._build()
+			return
+		cell = self.layer[x, y]
+		blocked = int(cell is not None and self.propname in cell)
+		i = (y + 1) * self.stride + x + 1
+		if self.cells[i] != blocked:
+			self.cells[i] = blocked
+			self.version += 1
+			self._log.append(i)
+			if len(self._log) > MAX_CHANGE_LOG:
+				drop = len(self._log) // 2
+				del self._log[:drop]
+				self._log_version += drop
+		self._source = self.layer.grid
+
+	def changes(self, version):
+		"""
+		Returns the indexes (in cells) of the cells that changed passability since the grid
+		had the given version, or None if that is no longer known (a rebuild, or too many).
+
+		"""
+		if version < self._log_version:
+			return None
+		return self._log[version - self._log_version:]
+
+	def index(self, x, y):
+		"""Returns the index of cell (x, y) in cells, or None if it is outside the layer."""
+		if 0 <= x < self.width and 0 <= y < self.height:
+			return (y + 1) * self.stride + x + 1
+		return None
+
+	def position(self, i):
+		"""Returns the (x, y) index of the cell at index i of cells."""
+		return (i % self.stride - 1, i // self.stride - 1)
+
+	def passable(self, x, y):
+		"""Returns True if cell (x, y) is inside the layer and not blocked."""
+		i = self.index(x, y)
+		return i is not None and not self.cells[i]
+
+	def neighbors(self, x, y, diagonal = False):
+		"""
+		Returns the (x, y) indexes of the passable neighbors of cell (x, y). Diagonal
+		neighbors are only included if both cells beside the step are passable too.
+
+		"""
+		cells, stride = self.cells, self.stride
+		i = (y + 1) * stride + x + 1
+		found = [(x + dx, y + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+			if not cells[i + dx + dy * stride]]
+		if diagonal:
+			found.extend((x + dx, y + dy) for dx, dy in ((1, 1), (-1, 1), (1, -1), (-1, -1))
+				if not (cells[i + dx + dy * stride] or cells[i + dx] or cells[i + dy * stride]))
+		return found
+
+
+# Search Functions
+def _endpoints(grid, start, goal):
+	"""Returns the cells indexes of start and goal, or None if either is blocked or outside the layer."""
+	grid.update()
+	s, g = grid.index(*start), grid.index(*goal)
+	if s is None or g is None or grid.cells[s] or grid.cells[g]:
+		return None
+	return s, g
+
+def _trace(grid, came, s, g):
+	"""Returns the (x, y) indexes of the cells from s to g, following came back from g."""
+	path = [g]
+	while path[-1] != s:
+		path.append(came[path[-1]])
+	path.reverse()
+	return [grid.position(i) for i in path]
+
+def astar(grid, start, goal, diagonal = False):
+	"""
+	Returns the shortest path from start to goal (both (x, y) cell indexes) as a list of
+	cell indexes, including both ends, or None if there is no path. Uses A* with a binary
+	heap; with diagonal, steps may also be diagonal (but not past a blocked corner).
+
+	"""
+	ends = _endpoints(grid, start, goal)
+	if ends is None:
+		return None
+	s, g = ends
+	cells, stride = grid.cells, grid.stride
+	gx, gy = g % stride, g // stride
+	size = len(cells)
+	cost = array("l", [0]) * size
+	came = array("l", [0]) * size
+	closed = bytearray(size)
+	if diagonal:
+		moves = [(d, STRAIGHT, 0, 0) for d in (1, -1, stride, -stride)]
+		moves += [(dx + dy, SLANT, dx, dy) for dx in (1, -1) for dy in (stride, -stride)]
+	else:
+		moves = [(d, STRAIGHT, d, d) for d in (1, -1, stride, -stride)]
+
+	# Entries are (estimated total, estimate to goal, index): ties go to the cell nearer the goal
+	open_heap = [(0, 0, s)]
+	while open_heap:
+		f, h, i = heappop(open_heap)
+		if i == g:
+			return _trace(grid, came, s, g)
+		if closed[i]:
+			continue
+		closed[i] = 1
+		c = cost[i]
+		for d, step, dx, dy in moves:
+			# Straight moves look at a cell already checked, diagonal ones at the cells beside the step
+			j = i + d
+			if cells[j] or closed[j] or cells[i + dx] or cells[i + dy]:
+				continue
+			new_cost = c + step
+			if came[j] and cost[j] <= new_cost:
+				continue
+			cost[j] = new_cost
+			came[j] = i
+			x, y = abs(j % stride - gx), abs(j // stride - gy)
+			if diagonal:
+				h = STRAIGHT * (x + y) + (SLANT - 2 * STRAIGHT) * (x if x < y else y)
+			else:
+				h = STRAIGHT * (x + y)
+			heappush(open_heap, (new_cost + h, h, j))
+	return None
+
+def jump_point(grid, start, goal):
+	"""
+	Returns a path as short as astar(grid, start, goal, diagonal = True), found with jump
+	point search: runs of cells with nothing to decide are skipped over in straight and
+	diagonal lines, so only the cells where the path may turn go on the heap.
+
+	"""
+	ends = _endpoints(grid, start, goal)
+	if ends is None:
+		return None
+	s, g = ends
+	cells, stride = grid.cells, grid.stride
+	gx, gy = g % stride, g // stride
+	size = len(cells)
+	cost = array("l", [0]) * size
+	came = array("l", [0]) * size
+	closed = bytearray(size)
+
+	def jump(i, dx, dy):
+		# Returns the first jump point stepping from i in direction (dx, dy), or -1
+		d = dx + dy * stride
+		v = dy * stride
+		while True:
+			i += d
+			if cells[i]:
+				return -1
+			if i == g:
+				return i
+			if dx and dy:
+				# A diagonal run stops where a straight run from it would find a jump point
+				if jump(i, dx, 0) >= 0 or jump(i, 0, dy) >= 0:
+					return i
+				if cells[i + dx] or cells[i + v]:
+					return -1
+			elif dx:
+				# Forced neighbors: a cell beside the run opens up past a blocked one
+				if (not cells[i - stride] and cells[i - dx - stride]) or (not cells[i + stride] and cells[i - dx + stride]):
+					return i
+			elif (not cells[i - 1] and cells[i - 1 - v]) or (not cells[i + 1] and cells[i + 1 - v]):
+				return i
+
+	def directions(i):
+		# Returns the directions worth searching from i, pruned by the way the path came in
+		if i == s:
+			return [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx or dy) and
+				not (cells[i + dx + dy * stride] or cells[i + dx] or cells[i + dy * stride])]
+		p = came[i]
+		dx = _sign(i % stride - p % stride)
+		dy = _sign(i // stride - p // stride)
+		found = []
+		if dx and dy:
+			side_x, side_y = not cells[i + dx], not cells[i + dy * stride]
+			if side_y:
+				found.append((0, dy))
+			if side_x:
+				found.append((dx, 0))
+			if side_x and side_y:
+				found.append((dx, dy))
+		elif dx:
+			ahead, below, above = not cells[i + dx], not cells[i + stride], not cells[i - stride]
+			if ahead:
+				found.append((dx, 0))
+				if below:
+					found.append((dx, 1))
+				if above:
+					found.append((dx, -1))
+			if below:
+				found.append((0, 1))
+			if above:
+				found.append((0, -1))
+		else:
+			ahead, right, left = not cells[i + dy * stride], not cells[i + 1], not cells[i - 1]
+			if ahead:
+				found.append((0, dy))
+				if right:
+					found.append((1, dy))
+				if left:
+					found.append((-1, dy))
+			if right:
+				found.append((1, 0))
+			if left:
+				found.append((-1, 0))
+		return found
+
+	open_heap = [(0, 0, s)]
+	while open_heap:
+		f, h, i = heappop(open_heap)
+		if i == g:
+			break
+		if closed[i]:
+			continue
+		closed[i] = 1
+		c = cost[i]
+		x, y = i % stride, i // stride
+		for dx, dy in directions(i):
+			j = jump(i, dx, dy)
+			if j < 0 or closed[j]:
+				continue
+			jx, jy = j % stride, j // stride
+			new_cost = c + _octile(jx - x, jy - y)
+			if came[j] and cost[j] <= new_cost:
+				continue
+			cost[j] = new_cost
+			came[j] = i
+			h = _octile(jx - gx, jy - gy)
+			heappush(open_heap, (new_cost + h, h, j))
+	else:
+		return None
+
+	# Fill in the straight and diagonal runs between the jump points
+	points = _trace(grid, came, s, g)
+	path = points[:1]
+	for x2, y2 in points[1:]:
+		x, y = path[-1]
+		dx, dy = _sign(x2 - x), _sign(y2 - y)
+		while (x, y) != (x2, y2):
+			x, y = x + dx, y + dy
+			path.append((x, y))
+	return path
+
+
+# Flow Field Class
+class FlowField:
+	"""
+	Costs and directions to the nearest of a set of goal cells from every cell of a Grid,
+	found with one Dijkstra pass started from all the goals at once. Any number of agents
+	heading for the same goals can then step along the direction field in O(1) per step.
+	When cells change passability, only the part of the field that went through them is
+	searched again.
+
+	Data members:
+	grid      -- The Grid the field covers.
+	goals     -- frozenset of the goal (x, y) cell indexes.
+	diagonal  -- Whether agents may step diagonally (but not past a blocked corner).
+	cost      -- array of the cost to the nearest goal for each index of grid.cells, in
+	             STRAIGHT and SLANT steps, or -1 where no goal can be reached.
+	direction -- bytearray of the step to take from each index of grid.cells: 0 at the
+	             goals and where no goal can be reached, otherwise DIRECTIONS[code - 1].
+	version   -- The grid version the field is up to date with.
+	rebuilds  -- Number of times the whole field was searched.
+	repairs   -- Number of times part of it was searched again.
+
+	"""
+	def __init__(self, grid, goals, diagonal = False):
+		"""See FlowField object's Docstring."""
+		self.grid = grid
+		self.goals = frozenset(tuple(goal) for goal in goals)
+		self.diagonal = diagonal
+		self.rebuilds = 0
+		self.repairs = 0
+		stride = grid.stride
+		# (offset, cost, side, side, code): the sides of a straight step are the cell itself
+		self._moves = []
+		for code, (dx, dy) in enumerate(DIRECTIONS[:8 if diagonal else 4], 1):
+			# Reached by stepping (dx, dy), so the way back is the opposite direction
+			back = DIRECTIONS.index((-dx, -dy)) + 1
+			if dx and dy:
+				self._moves.append((dx + dy * stride, SLANT, dx, dy * stride, back))
+			else:
+				self._moves.append((dx + dy * stride, STRAIGHT, 0, 0, back))
+		self._offsets = [0] + [dx + dy * stride for dx, dy in DIRECTIONS]
+		self._rebuild()
+
+	def _rebuild(self):
+		grid = self.grid
+		grid.update()
+		size = len(grid.cells)
+		self.cost = array("l", [-1]) * size
+		self.direction = bytearray(size)
+		self._goal_indexes = set(filter(None, (grid.index(*goal) for goal in self.goals)))
+		heap = []
+		for i in self._goal_indexes:
+			if not grid.cells[i]:
+				self.cost[i] = 0
+				heap.append((0, i))
+		self._spread(heap)
+		self.version = grid.version
+		self.rebuilds += 1
+
+	def _spread(self, heap):
+		# Dijkstra from the cells on the heap, lowering the cost of the cells they reach
+		cells, cost, direction, moves = self.grid.cells, self.cost, self.direction, self._moves
+		while heap:
+			c, i = heappop(heap)
+			if c != cost[i]:
+				continue
+			for d, step, a, b, back in moves:
+				j = i + d
+				if cells[j] or cells[i + a] or cells[i + b]:
+					continue
+				new_cost = c + step
+				old = cost[j]
+				if old < 0 or new_cost < old:
+					cost[j] = new_cost
+					direction[j] = back
+					heappush(heap, (new_cost, j))
+
+	def update(self):
+		"""Brings the field up to date with the grid, searching again only where needed."""
+		self.grid.update()
+		if self.version == self.grid.version:
+			return
+		changed = self.grid.changes(self.version)
+		if changed is None or self._goal_indexes.intersection(changed) or not self._repair(changed):
+			self._rebuild()
+		self.version = self.grid.version
+
+	def _repair(self, changed):
+		# Returns False if so much of the field is affected that it is quicker to rebuild it
+		cells, cost, direction, offsets = self.grid.cells, self.cost, self.direction, self._offsets
+		around = offsets[1:] if self.diagonal else offsets[1:5]
+
+		# Cells whose way to a goal went through (or past the corner of) a newly blocked cell
+		stale = []
+		for i in set(changed):
+			if not cells[i]:
+				continue
+			stale.append(i)
+			for d in offsets[1:5] if self.diagonal else ():
+				# a diagonal step from j past the corner at i
+				j = i + d
+				code = direction[j]
+				if code > 4:
+					dx, dy = DIRECTIONS[code - 1]
+					if i in (j + dx, j + dy * self.grid.stride):
+						stale.append(j)
+
+		# ... and every cell whose way went through them
+		lost = set()
+		while stale:
+			i = stale.pop()
+			if i in lost:
+				continue
+			lost.add(i)
+			for d in around:
+				j = i + d
+				if direction[j] and j + offsets[direction[j]] == i:
+					stale.append(j)
+		if len(lost) > len(cells) // 4:
+			return False
+		for i in lost:
+			cost[i] = -1
+			direction[i] = 0
+
+		# Start again from the best neighbors of the lost cells and of the changed ones
+		todo = set(lost)
+		for i in changed:
+			todo.update(i + d for d in offsets)
+		heap = []
+		for j in todo:
+			if cells[j] or j in self._goal_indexes:
+				continue
+			for d, step, a, b, back in self._moves:
+				i = j - d
+				if cells[i] or cells[i + a] or cells[i + b] or cost[i] < 0:
+					continue
+				new_cost = cost[i] + step
+				if cost[j] < 0 or new_cost < cost[j]:
+					cost[j] = new_cost
+					direction[j] = back
+			if cost[j] >= 0:
+				heap.append((cost[j], j))
+		heapify(heap)
+		self._spread(heap)
+		self.repairs += 1
+		return True
+
+	def cost_at(self, x, y):
+		"""Returns the cost from cell (x, y) to the nearest goal, or None if there is no way there."""
+		self.update()
+		i = self.grid.index(x, y)
+		if i is None or self.cost[i] < 0:
+			return None
+		return self.cost[i]
+
+	def direction_at(self, x, y):
+		"""Returns the (dx, dy) step to take from cell (x, y), or None at a goal or with no way there."""
+		self.update()
+		i = self.grid.index(x, y)
+		if i is None or not self.direction[i]:
+			return None
+		return DIRECTIONS[self.direction[i] - 1]
+
+	def path(self, start):
+		"""Returns the (x, y) indexes of the cells from start to the nearest goal, or None if there is no way there."""
+		x, y = start
+		if self.cost_at(x, y) is None:
+			return None
+		path = [(x, y)]
+		step = self.direction_at(x, y)
+		while step is not None:
+			x, y = x + step[0], y + step[1]
+			path.append((x, y))
+			step = self.direction_at(x, y)
+		return path
+
+
+# Pathfinder Class
+class Pathfinder:
+	"""
+	Finds paths over a Grid, remembering the most recently used ones. Paths are cached by
+	(start, goal, grid version), so any change to the grid's passability makes the cached
+	paths miss; they are then dropped as the least recently used. Flow fields are cached
+	by goal set, and repaired rather than dropped when the grid changes.
+
+	Data members:
+	grid             -- The Grid searched.
+	mode             -- ORTHOGONAL, DIAGONAL or JUMP (flow fields treat JUMP as DIAGONAL).
+	cache_size       -- Maximum number of paths to remember.
+	field_cache_size -- Maximum number of flow fields to remember.
+	hits             -- Number of paths found in the cache.
+	misses           -- Number of paths that had to be searched for.
+
+	"""
+	def __init__(self, grid, mode = ORTHOGONAL, cache_size = DEFAULT_CACHE_SIZE,
+			field_cache_size = DEFAULT_FIELD_CACHE_SIZE):
+		"""See Pathfinder object's Docstring."""
+		if mode not in (ORTHOGONAL, DIAGONAL, JUMP):
+			raise ValueError("Unknown search mode: " + repr(mode))
+		self.grid = grid
+		self.mode = mode
+		self.cache_size = cache_size
+		self.field_cache_size = field_cache_size
+		self.hits = 0
+		self.misses = 0
+		self._paths = OrderedDict()
+		self._fields = OrderedDict()
+
+	def __len__(self):
+		return len(self._paths)
+
+	def find(self, start, goal):
+		"""
+		Returns the shortest path from start to goal (both (x, y) cell indexes) as a list
+		of cell indexes, including both ends, or None if there is no path.
+
+		"""
+		start, goal = tuple(start), tuple(goal)
+		self.grid.update()
+		key = (start, goal, self.grid.version)
+		if key in self._paths:
+			self._paths.move_to_end(key)
+			self.hits += 1
+			path = self._paths[key]
+			return None if path is None else list(path)
+		self.misses += 1
+		if self.mode == JUMP:
+			path = jump_point(self.grid, start, goal)
+		else:
+			path = astar(self.grid, start, goal, self.mode == DIAGONAL)
+		self._paths[key] = None if path is None else tuple(path)
+		while len(self._paths) > self.cache_size:
+			self._paths.popitem(last = False)
+		return path
+
+	def field(self, goals):
+		"""Returns the FlowField (brought up to date) leading to the nearest of the goal (x, y) cell indexes."""
+		key = frozenset(tuple(goal) for goal in goals)
+		field = self._fields.get(key)
+		if field is None:
+			field = FlowField(self.grid, key, self.mode != ORTHOGONAL)
+			self._fields[key] = field
+			while len(self._fields) > self.field_cache_size:
+				self._fields.popitem(last = False)
+		else:
+			self._fields.move_to_end(key)
+			field.update()
+		return field
+
+	def clear(self):
+		"""Forgets every cached path and flow field."""
+		self._paths.clear()
+		self._fields.clear()
@@ -0,0 +1,389 @@
+# ------------------------------------------------------------
+# Filename: render.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# System Imports
+import pygame
+from pygame import Rect
+from collections import OrderedDict
+
+# Default memory budget for cached chunks (in bytes)
+DEFAULT_CHUNK_BUDGET = 32 * 1024 * 1024
+
+
+# Helper Functions
+def visible_range(area, grid_size, tile_size):
+	"""
+	Returns the (x1, y1, x2, y2) range of tile indexes that overlap the pixel area
+	(a Rect in map space). The x2 and y2 bounds are exclusive and everything is
+	clamped to the grid, so the result can be passed straight to range().
+
+	"""
+	tw, th = tile_size
+	x1 = max(0, area.left // tw)
+	y1 = max(0, area.top // th)
+	x2 = min(grid_size[0], -(-area.right // tw))
+	y2 = min(grid_size[1], -(-area.bottom // th))
+	return x1, y1, max(x1, x2), max(y1, y2)
+
+
+# Tile Renderer Class
+class TileRenderer:
+	"""
+	Draws a grid of tiles, only visiting the tiles that overlap the area being drawn.
+	The per-frame cost scales with the size of the screen instead of the map.
+
+	Data members:
+	get_image -- Callable returning the Surface for an (x, y) tile index, or None if empty.
+	grid_size -- The grid dimensions of the map. (2-tuple)
+	tile_size -- The pixel dimensions of a grid square. (2-tuple)
+
+	"""
+	def __init__(self, get_image, grid_size, tile_size):
+		"""See TileRenderer object's Docstring."""
+		self.get_image = get_image
+		self.grid_size = grid_size
+		self.tile_size = tile_size
+
+	def draw_area(self, surface, area, origin):
+		"""
+		Draw the tiles overlapping the map space pixel area onto the surface. The
+		map space pixel at origin ends up at (0, 0) of the surface.
+
+		"""
+		tw, th = self.tile_size
+		ox, oy = origin
+		get_image = self.get_image
+		x1, y1, x2, y2 = visible_range(area, self.grid_size, self.tile_size)
+		blits = []
+		for y in range(y1, y2):
+			for x in range(x1, x2):
+				image = get_image(x, y)
+				if image is not None:
+					blits.append((image, (x*tw - ox, y*th - oy)))
+		surface.blits(blits, False)
+
+	def draw(self, surface, view):
+		"""Draw the view (a Rect in map space) onto the whole surface. Returns the changed rects."""
+		self.draw_area(surface, view, view.topleft)
+		return [surface.get_rect()]
+
+
+# Stack Renderer Class
+class StackRenderer:
+	"""
+	Draws several renderers on top of each other, the first at the bottom. As the source of
+	a ChunkRenderer it composites several layers into the same chunks.
+
+	Data members:
+	sources -- The renderers drawn, bottom first. Each must have a draw_area(surface, area, origin) method.
+
+	"""
+	def __init__(self, sources):
+		"""See StackRenderer object's Docstring."""
+		self.sources = list(sources)
+
+	def draw_area(self, surface, area, origin):
+		"""Draw each source's tiles overlapping the map space pixel area onto the surface. See TileRenderer."""
+		for source in self.sources:
+			source.draw_area(surface, area, origin)
+
+	def draw(self, surface, view):
+		"""Draw the view (a Rect in map space) onto the whole surface. Returns the changed rects."""
+		self.draw_area(surface, view, view.topleft)
+		return [surface.get_rect()]
+
+
+# Chunk Cache Class
+class ChunkCache:
+	"""
+	Least recently used cache of pre-composited chunk Surfaces, limited by memory use.
+	One cache can be shared by several ChunkRenderers so they share a single budget.
+
+	Data members:
+	budget -- Maximum number of bytes of pixel data to keep. The chunk added last is always kept.
+	used   -- Number of bytes of pixel data currently cached.
+	hits   -- Number of lookups that found their chunk.
+	misses -- Number of lookups that did not.
+
+	"""
+	def __init__(self, budget = DEFAULT_CHUNK_BUDGET):
+		"""See ChunkCache object's Docstring."""
+		self.budget = budget
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self._chunks = OrderedDict()
+
+	def __len__(self):
+		return len(self._chunks)
+
+	def __contains__(self, key):
+		return key in self._chunks
+
+	def get(self, key):
+		"""Returns the cached Surface for key (marking it as recently used), or None."""
+		surface = self._chunks.get(key)
+		if surface is None:
+			self.misses += 1
+			return None
+		self._chunks.move_to_end(key)
+		self.hits += 1
+		return surface
+
+	def put(self, key, surface):
+		"""Adds a Surface to the cache, evicting the least recently used chunks over the budget."""
+		self.discard(key)
+		self._chunks[key] = surface
+		self.used += self._size(surface)
+		while self.used > self.budget and len(self._chunks) > 1:
+			old_key, old_surface = self._chunks.popitem(last = False)
+			self.used -= self._size(old_surface)
+
+	def discard(self, key):
+		"""Removes a chunk from the cache, if present."""
+		surface = self._chunks.pop(key, None)
+		if surface is not None:
+			self.used -= self._size(surface)
+
+	def clear(self):
+		"""Removes every chunk from the cache."""
+		self._chunks.clear()
+		self.used = 0
+
+	def _size(self, surface):
+		"""Returns the number of bytes of pixel data in a Surface."""
+		width, height = surface.get_size()
+		return width * height * surface.get_bytesize()
+
+
+# Chunk Renderer Class
+class ChunkRenderer:
+	"""
+	Pre-composites fixed-size blocks of tiles into cached Surfaces, so each frame only
+	blits the few chunks overlapping the view instead of every tile. Chunks are baked
+	on demand and evicted by the ChunkCache when it runs over its memory budget.
+
+	Data members:
+	source     -- Renderer used to bake chunks. Must have a draw_area(surface, area, origin) method.
+	grid_size  -- The grid dimensions of the map. (2-tuple)
+	tile_size  -- The pixel dimensions of a grid square. (2-tuple)
+	chunk_size -- Number of tiles along each side of a chunk.
+	alpha      -- Bake chunks with per-pixel alpha. Use False for opaque maps, it blits faster.
+	cache      -- The ChunkCache holding the baked chunks.
+
+	"""
+	def __init__(self, source, grid_size, tile_size, chunk_size = 16, budget = DEFAULT_CHUNK_BUDGET,
+			alpha = True, cache = None):
+		"""See ChunkRenderer object's Docstring."""
+		self.source = source
+		self.grid_size = grid_size
+		self.tile_size = tile_size
+		self.chunk_size = chunk_size
+		self.alpha = alpha
+		self.cache = cache if cache is not None else ChunkCache(budget)
+
+		# Chunk Grid Dimensions
+		self.chunk_px = (chunk_size * tile_size[0], chunk_size * tile_size[1])
+		self.chunk_grid = (-(-grid_size[0] // chunk_size), -(-grid_size[1] // chunk_size))
+		self.px_size = (grid_size[0] * tile_size[0], grid_size[1] * tile_size[1])
+
+	def get_chunk(self, cx, cy):
+		"""Returns the baked Surface for the chunk at the (cx, cy) chunk index."""
+		key = (self, cx, cy)
+		chunk = self.cache.get(key)
+		if chunk is None:
+			chunk = self._bake(cx, cy)
+			self.cache.put(key, chunk)
+		return chunk
+
+	def _bake(self, cx, cy):
+		"""Composites the tiles of one chunk into a new Surface."""
+		cw, ch = self.chunk_px
+		area = Rect(cx * cw, cy * ch, cw, ch).clip(Rect((0, 0), self.px_size))
+		if self.alpha:
+			chunk = pygame.Surface(area.size, pygame.SRCALPHA)
+		else:
+			chunk = pygame.Surface(area.size)
+		self.source.draw_area(chunk, area, area.topleft)
+		return chunk
+
+	def invalidate(self, x = None, y = None):
+		"""Drops the chunk holding the (x, y) tile index, or every chunk if no index is given."""
+		if x is None or y is None:
+			for cy in range(self.chunk_grid[1]):
+				for cx in range(self.chunk_grid[0]):
+					self.cache.discard((self, cx, cy))
+		else:
+			self.cache.discard((self, x // self.chunk_size, y // self.chunk_size))
+
+	def draw_area(self, surface, area, origin):
+		"""Draw the chunks overlapping the map space pixel area onto the surface. See TileRenderer."""
+		cw, ch = self.chunk_px
+		ox, oy = origin
+		x1, y1, x2, y2 = visible_range(area, self.chunk_grid, self.chunk_px)
+		blits = []
+		for cy in range(y1, y2):
+			for cx in range(x1, x2):
+				blits.append((self.get_chunk(cx, cy), (cx*cw - ox, cy*ch - oy)))
+		surface.blits(blits, False)
+
+	def draw(self, surface, view):
+		"""Draw the view (a Rect in map space) onto the whole surface. Returns the changed rects."""
+		self.draw_area(surface, view, view.topleft)
+		return [surface.get_rect()]
+
+
+# Scroll Renderer Class
+class ScrollRenderer:
+	"""
+	Keeps the previous frame in a back buffer. When the view moves, the buffer is shifted
+	by the scroll delta and only the newly exposed strips are drawn. When the view does not
+	move nothing is drawn at all.
+
+	Data members:
+	source     -- Renderer used to draw the exposed strips. Must have a draw_area(surface, area, origin) method.
+	background -- Color the strips are cleared to before drawing. None keeps the buffer transparent.
+	buffer     -- The back buffer Surface, the size of the view.
+	view       -- The view (a Rect in map space) the buffer currently shows.
+	moved      -- True if the last update shifted or redrew the whole buffer.
+	filled     -- Number of pixels drawn by the last update.
+
+	"""
+	def __init__(self, source, size, background = None):
+		"""See ScrollRenderer object's Docstring."""
+		self.source = source
+		self.background = background
+		if background is None:
+			self.buffer = pygame.Surface(size, pygame.SRCALPHA)
+			self._clear = (0, 0, 0, 0)
+		else:
+			self.buffer = pygame.Surface(size)
+			self._clear = background
+		self.view = None
+		self.moved = False
+		self.filled = 0
+		self._dirty = []
+
+	def invalidate(self, area = None):
+		"""Redraws the map space area (a Rect) on the next update, or the whole buffer if no area is given."""
+		if area is None:
+			self.view = None
+		else:
+			self._dirty.append(Rect(area))
+
+	def update(self, view):
+		"""Brings the buffer up to date for the view. Returns the redrawn rects, in buffer coordinates."""
+		w, h = self.buffer.get_size()
+		self.moved = True
+		if self.view is None or self.view.size != view.size:
+			strips = [Rect(0, 0, w, h)]
+		else:
+			dx, dy = view.x - self.view.x, view.y - self.view.y
+			if abs(dx) >= w or abs(dy) >= h:
+				strips = [Rect(0, 0, w, h)]
+			else:
+				strips = []
+				self.moved = bool(dx or dy)
+				if dx or dy:
+					self.buffer.scroll(-dx, -dy)
+				if dx > 0:
+					strips.append(Rect(w - dx, 0, dx, h))
+				elif dx < 0:
+					strips.append(Rect(0, 0, -dx, h))
+				if dy > 0:
+					strips.append(Rect(0, h - dy, w, dy))
+				elif dy < 0:
+					strips.append(Rect(0, 0, w, -dy))
+
+		# Areas Changed Since the Last Update
+		for area in self._dirty:
+			strip = area.move(-view.x, -view.y).clip(0, 0, w, h)
+			if strip.width and strip.height:
+				strips.append(strip)
+		self._dirty = []
+
+		# Redraw Strips
+		self.filled = 0
+		for strip in strips:
+			self.buffer.set_clip(strip)
+			self.buffer.fill(self._clear, strip)
+			self.source.draw_area(self.buffer, strip.move(view.topleft), view.topleft)
+			self.filled += strip.width * strip.height
+		self.buffer.set_clip(None)
+		self.view = Rect(view)
+		return strips
+
+	def draw_area(self, surface, area, origin):
+		"""Draw the map space pixel area onto the surface, straight from the source. See TileRenderer."""
+		self.source.draw_area(surface, area, origin)
+
+	def draw(self, surface, view):
+		"""Update the buffer for the view and copy it onto the surface. Returns the changed rects."""
+		self.update(view)
+		surface.blit(self.buffer, (0, 0))
+		return [surface.get_rect()]
+
+
+# Dirty Rects Class
+class DirtyRects:
+	"""
+	Collects the screen rects changed during a frame and pushes only those to the display
+	with pygame.display.update(). Falls back to a full pygame.display.flip() when the
+	changed area is larger than the threshold, where one big update is cheaper.
+
+	Data members:
+	screen_rect   -- Rect of the whole display surface.
+	threshold     -- Fraction of the screen area above which the whole display is flipped.
+	rects         -- Rects changed since the last flush.
+	flips         -- Number of flushes that flipped the whole display.
+	updates       -- Number of flushes that updated only the changed rects.
+
+	"""
+	def __init__(self, screen_rect, threshold = 0.5):
+		"""See DirtyRects object's Docstring."""
+		self.screen_rect = Rect(screen_rect)
+		self.threshold = threshold
+		self.rects = []
+		self.flips = 0
+		self.updates = 0
+
+	def add(self, rect):
+		"""Marks a screen rect as changed."""
+		rect = Rect(rect).clip(self.screen_rect)
+		if rect.width and rect.height:
+			self.rects.append(rect)
+
+	def extend(self, rects):
+		"""Marks several screen rects as changed."""
+		for rect in rects:
+			self.add(rect)
+
+	def area(self):
+		"""Returns the changed area in pixels. Overlapping rects are counted more than once."""
+		return sum(rect.width * rect.height for rect in self.rects)
+
+	def flush(self):
+		"""Pushes the changed rects to the display. Returns the rects pushed (empty if nothing changed)."""
+		area = self.area()
+		rects = self.rects
+		self.rects = []
+		if not rects:
+			return rects
+		if area > self.threshold * self.screen_rect.width * self.screen_rect.height:
+			pygame.display.flip()
+			self.flips += 1
+			return [self.screen_rect]
+		pygame.display.update(rects)
+		self.updates += 1
+		return rects
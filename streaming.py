@@ -0,0 +1,370 @@
+# ------------------------------------------------------------
+# Filename: streaming.py
+#
+# Author: Shawn Wilkinson
+# Author Website: http://super3.org/
+# Author Email: me@super3.org
+#
+# Website: http://super3.org/
+# Github Page: https://github.com/super3/PyGame-Tiler/
+#
+# Creative Commons Attribution 3.0 Unported License
+# http://creativecommons.org/licenses/by/3.0/
+# ------------------------------------------------------------
+
+# System Imports
+import os
+import sys
+import json
+import zlib
+import array
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pygame import Rect
+
+# Local Imports
+import tmx
+import images
+import tmxloader3
+from render import TileRenderer
+
+# Marks a region file
+MAGIC = b"PGTREG\r\n"
+
+# Version of the region and index formats
+FORMAT_VERSION = 1
+
+# Magic, format version, region size (in cells) and number of layers
+HEADER = struct.Struct("<8sIII")
+
+# Name of the index file in a split world's folder
+INDEX_NAME = "world.json"
+
+# Default width and height of a region (in cells)
+DEFAULT_REGION_SIZE = 64
+
+
+# Helper Functions
+def _region_path(folder, region):
+	return os.path.join(folder, "%d_%d.region" % region)
+
+def _distance(a, b):
+	"""Returns the distance between two regions, counted in regions (diagonal steps count as one)."""
+	return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+def _sign(n):
+	return (n > 0) - (n < 0)
+
+
+# Region Functions
+def split(filename, folder, region_size = DEFAULT_REGION_SIZE):
+	"""
+	Splits the tile layers of a TMX map into square regions of region_size cells, each in a
+	file of its own in folder, next to an index describing the map and its tilesets. The
+	regions along the right and bottom edges are padded with empty cells.
+
+	"""
+	tiledmap = tmxloader3.load_tmx(filename)
+	source = os.path.dirname(os.path.abspath(filename))
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	width, height = tiledmap.width, tiledmap.height
+	layers = tiledmap.tilelayers
+	for ry in range(-(-height // region_size)):
+		for rx in range(-(-width // region_size)):
+			x1, y1 = rx * region_size, ry * region_size
+			w, h = min(region_size, width - x1), min(region_size, height - y1)
+			gids = array.array(tmxloader3._UINT32)
+			padding = array.array(tmxloader3._UINT32, [0]) * (region_size - w)
+			for layer in layers:
+				data = layer.data.array
+				for y in range(y1, y1 + h):
+					gids.extend(array.array(gids.typecode, data[y * width + x1:y * width + x1 + w]))
+					gids.extend(padding)
+				gids.extend(array.array(gids.typecode, [0]) * (region_size * (region_size - h)))
+			write_region(_region_path(folder, (rx, ry)), region_size, len(layers), gids)
+
+	index = {
+		"version": FORMAT_VERSION,
+		"width": width,
+		"height": height,
+		"tilewidth": tiledmap.tilewidth,
+		"tileheight": tiledmap.tileheight,
+		"region_size": region_size,
+		"layers": [{"name": layer.name, "visible": int(layer.visible)} for layer in layers],
+		"tilesets": [{"name": t.name, "firstgid": t.firstgid, "tilewidth": t.tilewidth,
+			"tileheight": t.tileheight, "image": os.path.relpath(os.path.join(source, t.source), folder),
+			"trans": t.trans}
+			for t in tiledmap.tilesets],
+		"tile_properties": [[gid, dict(props)] for gid, props in tiledmap.tile_properties.items()],
+	}
+	with open(os.path.join(folder, INDEX_NAME), "w") as f:
+		json.dump(index, f)
+
+def write_region(path, region_size, layer_count, gids):
+	"""Writes the gids of a region (each layer's cells row by row, one layer after another) to path."""
+	if sys.byteorder != "little":
+		gids = array.array(gids.typecode, gids)
+		gids.byteswap()
+	with open(path, "wb") as f:
+		f.write(HEADER.pack(MAGIC, FORMAT_VERSION, region_size, layer_count))
+		f.write(zlib.compress(gids.tobytes()))
+
+def read_region(path):
+	"""
+	Returns the gids of each layer of a region written by write_region, as arrays of
+	region_size * region_size cells row by row. Safe to call from any thread.
+	Raises ValueError if path is not a region file this version can read.
+
+	"""
+	with open(path, "rb") as f:
+		data = f.read()
+	if len(data) < HEADER.size:
+		raise ValueError("Not a region file: " + path)
+	magic, version, region_size, layer_count = HEADER.unpack_from(data, 0)
+	if magic != MAGIC or version != FORMAT_VERSION:
+		raise ValueError("Not a region file of version %d: %s" % (FORMAT_VERSION, path))
+	gids = array.array(tmxloader3._UINT32)
+	gids.frombytes(zlib.decompress(data[HEADER.size:]))
+	if sys.byteorder != "little":
+		gids.byteswap()
+	cells = region_size * region_size
+	if len(gids) != cells * layer_count:
+		raise ValueError("Region file is truncated: " + path)
+	return [gids[i * cells:(i + 1) * cells] for i in range(layer_count)]
+
+
+# Streaming Layer Class
+class StreamingLayer:
+	"""
+	A tile layer of a StreamingMap. Only the gids of the loaded regions are kept; the cells
+	of regions that are not loaded are empty.
+
+	Data members:
+	name, visible -- As for tmx.Layer.
+	width, height -- The dimensions of the layer in cells.
+	tile_width, tile_height -- The dimensions of each cell.
+	px_width, px_height -- The dimensions of the layer in pixels.
+	tilesets      -- The tilesets used in the layer (a tmx.Tilesets instance).
+	properties    -- Any properties set for the layer.
+	region_size   -- The width and height of a region in cells.
+	regions       -- Dict of (rx, ry) region index to the array of the region's gids, row by row.
+	renderer      -- The render.TileRenderer drawing the layer.
+
+	"""
+	def __init__(self, name, visible, map, region_size):
+		"""See StreamingLayer object's Docstring."""
+		self.name = name
+		self.visible = visible
+		self.position = (0, 0)
+		self.width, self.height = map.width, map.height
+		self.tile_width, self.tile_height = map.tile_width, map.tile_height
+		self.px_width, self.px_height = map.px_width, map.px_height
+		self.tilesets = map.tilesets
+		self.properties = {}
+		self.region_size = region_size
+		self.regions = {}
+		self.renderer = TileRenderer(self.get_tile_image,
+			(self.width, self.height), (self.tile_width, self.tile_height))
+
+	def __repr__(self):
+		return '<StreamingLayer "%s" at 0x%x>' % (self.name, id(self))
+
+	def _value(self, i, j):
+		# Returns the gid at cell (i, j), 0 if it is empty or its region is not loaded
+		size = self.region_size
+		grid = self.regions.get((i // size, j // size))
+		if grid is None or not (0 <= i < self.width and 0 <= j < self.height):
+			return 0
+		return grid[j % size * size + i % size]
+
+	def __getitem__(self, pos):
+		"""Returns a tmx.Cell for the (x, y) index, or None if it is empty or not loaded."""
+		x, y = pos
+		value = self._value(x, y)
+		if not value:
+			return None
+		return tmx.Cell(x, y, x * self.tile_width, y * self.tile_height, self.tilesets[value])
+
+	def get_tile_image(self, i, j):
+		"""Returns the tile Surface at the (i, j) index, or None."""
+		value = self._value(i, j)
+		if not value:
+			return None
+		return self.tilesets[value].surface
+
+	def update(self, dt, *args):
+		pass
+
+	def set_view(self, x, y, w, h, viewport_ox = 0, viewport_oy = 0):
+		self.view_x, self.view_y = x, y
+		self.view_w, self.view_h = w, h
+		self.position = (x - viewport_ox, y - viewport_oy)
+
+	def draw(self, surface):
+		"""Draws the layer, limited to the current viewport, to the Surface. Returns the changed rects."""
+		view = Rect(self.view_x, self.view_y, self.view_w, self.view_h)
+		self.renderer.draw_area(surface, view, self.position)
+		ox, oy = self.position
+		return [view.move(-ox, -oy)]
+
+
+# Streaming Map Class
+class StreamingMap(tmx.TileMap):
+	"""
+	A tmx.TileMap over a world split into regions (see split) that keeps only the regions
+	around the focus in memory. Each time the focus is set, regions within radius of the
+	focus region are queued for loading on background threads, along with the next
+	prefetch rings of regions in the direction the camera is heading, and regions further
+	than evict_radius away are dropped. Decoding happens off the main thread; the main
+	thread only waits when a region in view has not arrived yet.
+
+	Data members:
+	folder       -- The folder the world was split into.
+	region_size  -- The width and height of a region in cells.
+	radius       -- Regions up to this distance (in regions) from the focus region are loaded.
+	prefetch     -- Number of extra rings of regions loaded ahead of the camera.
+	evict_radius -- Regions further than this from the focus region are dropped.
+	loaded       -- Dict of (rx, ry) region index to the list of its layers' gids.
+	heading      -- The (dx, dy) signs of the camera's last movement.
+	loads        -- Number of regions read.
+	waits        -- Number of times drawing had to wait for a region in view.
+	evictions    -- Number of regions dropped.
+
+	Arguments:
+	folder   -- Folder holding a world written by split.
+	viewport -- The (width, height) of the viewport.
+	workers  -- Number of background threads reading regions.
+	atlas    -- An atlas.Atlas holding the tileset images, as for tmx.TileMap.load.
+
+	"""
+	def __init__(self, folder, viewport, radius = 1, prefetch = 1, evict_radius = None, workers = 2, atlas = None):
+		"""See StreamingMap object's Docstring."""
+		tmx.TileMap.__init__(self, viewport)
+		with open(os.path.join(folder, INDEX_NAME)) as f:
+			index = json.load(f)
+		if index.get("version") != FORMAT_VERSION:
+			raise ValueError("Unsupported world index version: " + str(index.get("version")))
+		self.folder = folder
+		self.width, self.height = index["width"], index["height"]
+		self.tile_width, self.tile_height = index["tilewidth"], index["tileheight"]
+		self.px_width = self.width * self.tile_width
+		self.px_height = self.height * self.tile_height
+		self.region_size = index["region_size"]
+		self.radius = radius
+		self.prefetch = prefetch
+		if evict_radius is None:
+			# one ring of slack, so regions are not dropped and read again at a border
+			evict_radius = radius + prefetch + 1
+		self.evict_radius = evict_radius
+		self.loaded = {}
+		self.heading = (0, 0)
+		self.loads = self.waits = self.evictions = 0
+
+		properties = dict((gid, props) for gid, props in index["tile_properties"])
+		sources = [(os.path.join(folder, t["image"]), t.get("trans")) for t in index["tilesets"]]
+		images.preload([path for path, trans in sources if atlas is None or not atlas.has(path, trans)])
+		for t in index["tilesets"]:
+			tileset = tmx.Tileset(t["name"], t["tilewidth"], t["tileheight"], t["firstgid"])
+			tileset.add_image(os.path.join(folder, t["image"]), atlas, t.get("trans"))
+			for tile in tileset.tiles:
+				tile.add_properties(properties.get(tile.gid, {}).items())
+			self.tilesets.add(tileset)
+		for entry in index["layers"]:
+			layer = StreamingLayer(entry["name"], entry["visible"], self, self.region_size)
+			self.layers.add_named(layer, layer.name)
+
+		self._tile_layers = list(self.layers)
+		self._pending = {}
+		self._executor = ThreadPoolExecutor(workers)
+		self._last_focus = None
+
+	def close(self):
+		"""Stops the background threads. Regions already loaded stay usable."""
+		self._executor.shutdown(wait = True, cancel_futures = True)
+		self._pending.clear()
+
+	def region_at(self, px, py):
+		"""Returns the (rx, ry) index of the region holding the map space pixel."""
+		return (px // (self.tile_width * self.region_size), py // (self.tile_height * self.region_size))
+
+	def visible_regions(self):
+		"""Returns the (rx, ry) indexes of the regions the viewport overlaps. stream() leaves them all loaded."""
+		view = self.viewport
+		x1, y1 = self.region_at(view.left, view.top)
+		x2, y2 = self.region_at(view.right - 1, view.bottom - 1)
+		return [(rx, ry) for ry in range(y1, y2 + 1) for rx in range(x1, x2 + 1) if self._exists((rx, ry))]
+
+	def _exists(self, region):
+		rx, ry = region
+		size = self.region_size
+		return 0 <= rx * size < self.width and 0 <= ry * size < self.height
+
+	def set_focus(self, fx, fy, force = False):
+		tmx.TileMap.set_focus(self, fx, fy, force)
+		self.stream()
+
+	def force_focus(self, fx, fy):
+		tmx.TileMap.force_focus(self, fx, fy)
+		self.stream()
+
+	def stream(self):
+		"""Loads, prefetches and evicts regions for the current viewport. Called by set_focus."""
+		self._install()
+		view = self.viewport
+		focus = view.center
+		if self._last_focus is not None and focus != self._last_focus:
+			self.heading = (_sign(focus[0] - self._last_focus[0]), _sign(focus[1] - self._last_focus[1]))
+		self._last_focus = focus
+		center = self.region_at(*focus)
+
+		# The regions in view have to be there before drawing
+		visible = self.visible_regions()
+
+		cx, cy = center
+		wanted = [(rx, ry) for ry in range(cy - self.radius, cy + self.radius + 1)
+			for rx in range(cx - self.radius, cx + self.radius + 1)]
+		hx, hy = self.heading
+		for ring in range(self.radius + 1, self.radius + self.prefetch + 1):
+			# the rings ahead of the camera, on the sides it is moving towards
+			for k in range(-ring, ring + 1):
+				if hx:
+					wanted.append((cx + hx * ring, cy + k))
+				if hy:
+					wanted.append((cx + k, cy + hy * ring))
+		wanted.sort(key = lambda region: _distance(region, center))
+		for region in visible + wanted:
+			if self._exists(region) and region not in self.loaded and region not in self._pending:
+				self._pending[region] = self._executor.submit(read_region, _region_path(self.folder, region))
+
+		for region in visible:
+			if region not in self.loaded:
+				self.waits += 1
+				self._place(region, self._pending.pop(region).result())
+
+		# The view can reach further than evict_radius when regions are small next to it
+		keep = set(visible)
+		for region in [region for region in self.loaded
+				if region not in keep and _distance(region, center) > self.evict_radius]:
+			del self.loaded[region]
+			for layer in self._tile_layers:
+				del layer.regions[region]
+			self.evictions += 1
+		for region in [region for region in self._pending
+				if region not in keep and _distance(region, center) > self.evict_radius]:
+			# a read already running finishes, but its result is dropped
+			self._pending.pop(region).cancel()
+
+	def _install(self):
+		# Takes the regions the background threads have finished reading
+		for region, future in list(self._pending.items()):
+			if future.done():
+				del self._pending[region]
+				if not future.cancelled():
+					self._place(region, future.result())
+
+	def _place(self, region, grids):
+		self.loaded[region] = grids
+		for layer, grid in zip(self._tile_layers, grids):
+			layer.regions[region] = grid
+		self.loads += 1
@@ -4,14 +4,58 @@
 
 # TODO: support properties on more things
 
+import re
 import sys
-import struct
-import collections
+import base64
+import heapq
+import bisect
+import operator
+import itertools
+import collections.abc
+from array import array
 import pygame
 from pygame.locals import *
 from pygame import Rect
 from xml.etree import ElementTree
 import random
+import images
+import tmxloader3
+from render import TileRenderer, StackRenderer, ChunkRenderer, ChunkCache, ScrollRenderer, DEFAULT_CHUNK_BUDGET
+
+class TileProperties(dict):
+    '''The properties of a Tile. Changing them bumps the class's version, so
+    Layers know the property indexes they built (see Layer.find) are out of
+    date.
+    '''
+    version = 0
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name, value)
+        TileProperties.version += 1
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        TileProperties.version += 1
+
+    def clear(self):
+        dict.clear(self)
+        TileProperties.version += 1
+
+    def pop(self, *args):
+        TileProperties.version += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        TileProperties.version += 1
+        return dict.popitem(self)
+
+    def setdefault(self, name, default=None):
+        TileProperties.version += 1
+        return dict.setdefault(self, name, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        TileProperties.version += 1
 
 class Tile(object):
     def __init__(self, gid, surface, tileset):
@@ -19,7 +63,7 @@ class Tile(object):
         self.surface = surface
         self.tile_width = tileset.tile_width
         self.tile_height = tileset.tile_height
-        self.properties = {}
+        self.properties = TileProperties()
 
     @classmethod
     def fromSurface(cls, surface):
@@ -36,12 +80,15 @@ class Tile(object):
         props = tag.find('properties')
         if props is None:
             return
-        for c in props.findall('property'):
-            # store additional properties.
-            name = c.attrib['name']
-            value = c.attrib['value']
+        # store additional properties.
+        self.add_properties((c.attrib['name'], c.attrib['value'])
+            for c in props.findall('property'))
 
-            # TODO hax
+    def add_properties(self, properties):
+        '''Store properties read from a map, given as (name, value) pairs of
+        strings. Values made of digits only are stored as ints.
+        '''
+        for name, value in properties:
             if value.isdigit():
                 value = int(value)
             self.properties[name] = value
@@ -59,12 +106,12 @@ class Tileset(object):
         self.properties = {}
 
     @classmethod
-    def fromxml(cls, tag, firstgid=None):
+    def fromxml(cls, tag, firstgid=None, atlas=None):
         if 'source' in tag.attrib:
             firstgid = int(tag.attrib['firstgid'])
             with open(tag.attrib['source']) as f:
                 tileset = ElementTree.fromstring(f.read())
-            return cls.fromxml(tileset, firstgid)
+            return cls.fromxml(tileset, firstgid, atlas)
 
         name = tag.attrib['name']
         if firstgid is None:
@@ -74,28 +121,69 @@ class Tileset(object):
 
         tileset = cls(name, tile_width, tile_height, firstgid)
 
-        for c in tag.getchildren():
+        for c in tag:
             if c.tag == "image":
                 # create a tileset
-                tileset.add_image(c.attrib['source'])
+                tileset.add_image(c.attrib['source'], atlas, c.attrib.get('trans'))
             elif c.tag == 'tile':
                 gid = tileset.firstgid + int(c.attrib['id'])
                 tileset.get_tile(gid).loadxml(c)
         return tileset
 
-    def add_image(self, file):
-        image = pygame.image.load(file).convert_alpha()
+    @classmethod
+    def fromxml_all(cls, tags, atlas=None, workers=None):
+        '''Create the Tilesets for a list of <tileset> tags. Their images are
+        decoded together on worker threads first (see images.preload).
+        '''
+        resolved = []
+        for tag in tags:
+            firstgid = None
+            if 'source' in tag.attrib:
+                firstgid = int(tag.attrib['firstgid'])
+                with open(tag.attrib['source']) as f:
+                    tag = ElementTree.fromstring(f.read())
+            resolved.append((tag, firstgid))
+        files = [(c.attrib['source'], c.attrib.get('trans'))
+            for tag, firstgid in resolved for c in tag.findall('image')]
+        images.preload([file for file, trans in files
+            if atlas is None or not atlas.has(file, trans)], workers)
+        return [cls.fromxml(tag, firstgid, atlas) for tag, firstgid in resolved]
+
+    def add_image(self, file, atlas=None, trans=None):
+        '''Cut the image file into tiles. trans is the Tiled colorkey of the
+        image (such as "ff00ff"), its pixels of that color are transparent.
+        If the file is in the atlas (an atlas.Atlas) with the same colorkey
+        the tiles are cut from the atlas sheet instead.
+        '''
+        in_atlas = atlas is not None and atlas.has(file, trans)
+        colorkey = None if trans is None else pygame.Color('#' + trans)
+        if in_atlas:
+            image = atlas.get(file)
+        else:
+            image = images.load(file, trans is None, colorkey)
         if not image:
             sys.exit("Error creating new Tileset: file %s not found" % file)
         id = self.firstgid
+        tiles = []
         for line in range(int(image.get_height()/self.tile_height)):
             for column in range(int(image.get_width()/self.tile_width)):
                 pos = Rect(column*self.tile_width,
                     line*self.tile_height,
                     self.tile_width,
                     self.tile_height )
-                self.tiles.append(Tile(id, image.subsurface(pos), self))
+                tiles.append((Tile(id, image.subsurface(pos), self), pos))
                 id += 1
+        self.tiles.extend(tile for tile, pos in tiles)
+
+        # convert the sheet once the display exists and re-slice the tiles
+        def convert():
+            if in_atlas:
+                sheet = atlas.get(file)
+            else:
+                sheet = images.load(file, trans is None, colorkey)
+            for tile, pos in tiles:
+                tile.surface = sheet.subsurface(pos)
+        images.when_ready(convert)
 
     def get_tile(self, gid):
         return self.tiles[gid - self.firstgid]
@@ -106,6 +194,25 @@ class Tilesets(dict):
             i += tileset.firstgid
             self[i] = tile
 
+# marks a tile property deleted from a single cell
+_DELETED = object()
+
+# the Layer property index key for values that cannot be hashed
+_UNHASHABLE = object()
+
+def _index_key(value):
+    try:
+        hash(value)
+    except TypeError:
+        return _UNHASHABLE
+    return value
+
+def _is_true(value):
+    '''Whether a TMX property value (a string, or None if it is not set)
+    is true.
+    '''
+    return str(value).strip().lower() in ('1', 'true', 'yes')
+
 class Cell(object):
     '''Layers are made of Cells (or empty space).
 
@@ -123,37 +230,73 @@ class Cell(object):
     You may assign a new value for a property to or even delete an existing
     property from the cell - this will not affect the Tile or any other Cells
     using the Cell's Tile.
+
+    Layers create their Cells on demand, so the same cell may be returned as
+    different (but equal) Cell objects. Property changes are kept by the
+    layer and seen by all of them.
     '''
-    def __init__(self, x, y, px, py, tile):
+    __slots__ = ['x', 'y', 'px', 'py', 'tile', '_layer', '_changes']
+
+    def __init__(self, x, y, px, py, tile, layer=None):
         self.x, self.y = x, y
         self.px, self.py = px, py
         self.tile = tile
-        self.topleft = (px, py)
-        self.left = px
-        self.right = px + tile.tile_width
-        self.top = py
-        self.bottom = py + tile.tile_height
-        self.center = (px + tile.tile_width//2, py + tile.tile_height//2)
-        self._added_properties = {}
-        self._deleted_properties = set()
+        self._layer = layer
+        self._changes = None
+        if layer is not None:
+            self._changes = layer._overrides.get((x, y))
+
+    topleft = property(lambda self: (self.px, self.py))
+    left = property(lambda self: self.px)
+    right = property(lambda self: self.px + self.tile.tile_width)
+    top = property(lambda self: self.py)
+    bottom = property(lambda self: self.py + self.tile.tile_height)
+    center = property(lambda self: (self.px + self.tile.tile_width//2,
+        self.py + self.tile.tile_height//2))
+
     def __repr__(self):
         return '<Cell %s,%s %d>' % (self.px, self.py, self.tile.gid)
+    def __eq__(self, other):
+        if not isinstance(other, Cell):
+            return NotImplemented
+        return (self.x, self.y, self.px, self.py, self.tile, self._layer) == \
+            (other.x, other.y, other.px, other.py, other.tile, other._layer)
+    def __hash__(self):
+        return hash((self.x, self.y, self.px, self.py))
     def __contains__(self, key):
-        if key in self._deleted_properties:
-            return False
-        return key in self._added_properties or key in self.tile.properties
+        if self._changes is not None and key in self._changes:
+            return self._changes[key] is not _DELETED
+        return key in self.tile.properties
     def __getitem__(self, key):
-        if key in self._deleted_properties:
-            raise KeyError(key)
-        if key in self._added_properties:
-            return self._added_properties[key]
-        if key in self.tile.properties:
-            return self.tile.properties[key]
-        raise KeyError(key)
+        if self._changes is not None and key in self._changes:
+            value = self._changes[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self.tile.properties[key]
     def __setitem__(self, key, value):
-        self._added_properties[key] = value
+        self._update(key, value)
     def __delitem__(self, key):
-        self._deleted_properties.add(key)
+        self._update(key, _DELETED)
+    def _update(self, key, value):
+        if self._layer is None:
+            self._change()[key] = value
+            return
+        self._layer._unindex(self.x, self.y, (key,))
+        self._change()[key] = value
+        self._layer._reindex(self.x, self.y, (key,))
+        for callback in self._layer.on_change:
+            callback(self.x, self.y)
+    def _change(self):
+        '''Return the dict of this cell's property changes, creating it
+        (and registering it with the layer) on first use.
+        '''
+        if self._changes is None:
+            if self._layer is None:
+                self._changes = {}
+            else:
+                self._changes = self._layer._overrides.setdefault((self.x, self.y), {})
+        return self._changes
     def intersects(self, other):
         '''Determine whether this Cell intersects with the other rect (which has
         .x, .y, .width and .height attributes.)
@@ -164,6 +307,38 @@ class Cell(object):
         if other.y + other.height < self.py: return False
         return True
 
+class LayerCells(collections.abc.MutableMapping):
+    '''The cells of a Layer as a dict-like view keyed off (x, y) index.
+    Only non-empty cells are present; Cells are created as they are looked up.
+    '''
+    def __init__(self, layer):
+        self.layer = layer
+    def __getitem__(self, pos):
+        cell = self.layer._cell(pos)
+        if cell is None:
+            raise KeyError(pos)
+        return cell
+    def get(self, pos, default=None):
+        cell = self.layer._cell(pos)
+        return default if cell is None else cell
+    def __contains__(self, pos):
+        return self.layer._cell(pos) is not None
+    def __setitem__(self, pos, cell):
+        self.layer._set(pos, cell.tile, cell._changes)
+    def __delitem__(self, pos):
+        if pos not in self:
+            raise KeyError(pos)
+        del self.layer[pos]
+    def __iter__(self):
+        # row by row, like the TMX data
+        grid, width = self.layer.grid, self.layer.width
+        for i, value in enumerate(grid):
+            if value:
+                yield (i % width, i // width)
+    def __len__(self):
+        grid = self.layer.grid
+        return len(grid) - grid.count(0)
+
 class LayerIterator(object):
     '''Iterates over all the cells in a layer in column,row order.
     '''
@@ -191,14 +366,27 @@ class Layer(object):
         px_width, px_height - the dimensions of the Layer in pixels
         tilesets - the tilesets used in this Layer (a Tilesets instance)
         properties - any properties set for this Layer
-        cells - a dict of all the Cell instances for this Layer, keyed off
-                (x, y) index.
+        grid - the layer's tiles as a flat row-by-row array, 0 for empty
+               cells and the tile's gid otherwise
+        cells - a dict-like view of all the Cell instances for this Layer,
+                keyed off (x, y) index.
+        on_change - callbacks called with the (x, y) index of a cell
+                    whenever a cell is set or its properties change, and
+                    with (None, None) when the whole layer is refilled
+                    (see set_gids)
+        static - True if the Layer does not change (much) at runtime, so
+                 TileMap.flatten may draw it pre-composited with its
+                 static neighbours; set from a "static" Layer property
+        flat - the FlatLayer drawing this Layer, if it is flattened
 
     Additionally you may look up a cell using direct item access:
 
-       layer[x, y] is layer.cells[x, y]
+       layer[x, y] == layer.cells[x, y]
 
     Note that empty cells will be set to None instead of a Cell instance.
+
+    Only the grid is stored, plus the property changes made through Cells;
+    Cell instances are created when they are looked up.
     '''
     def __init__(self, name, visible, map):
         self.name = name
@@ -214,19 +402,97 @@ class Layer(object):
         self.tilesets = map.tilesets
         self.group = pygame.sprite.Group()
         self.properties = {}
-        self.cells = {}
+        self.grid = array('H', [0]) * (self.width * self.height)
+        self.cells = LayerCells(self)
+        self.on_change = []
+        self.static = False
+        self.flat = None
+
+        # property changes made through Cells, keyed off (x, y) index
+        self._overrides = {}
+
+        # cell positions by property name, then by value (see find), and
+        # the TileProperties.version they were built for
+        self._index = {}
+        self._index_version = TileProperties.version
+
+        # for each indexed property name, one byte per cell: 1 if the cell
+        # has the property (see collide_many)
+        self._masks = {}
+
+        # tiles that are not in the tilesets, keyed off their grid value
+        self._local_tiles = {}
+        self._local_values = {}
+        self.renderer = TileRenderer(self.get_tile_image,
+            (self.width, self.height), (self.tile_width, self.tile_height))
 
     def __repr__(self):
         return '<Layer "%s" at 0x%x>' % (self.name, id(self))
 
     def __getitem__(self, pos):
-        return self.cells.get(pos)
+        return self._cell(pos)
 
     def __setitem__(self, pos, tile):
+        self._set(pos, tile)
+
+    def _set(self, pos, tile, changes=None):
+        '''Set the tile at the (x, y) index, along with the property changes
+        of the cell it came from (if any).
+        '''
+        x, y = pos
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError('cell %s,%s is outside the layer' % (x, y))
+        # a new cell, so any property changes to the old one are gone
+        self._unindex(x, y)
+        self._overrides.pop((x, y), None)
+        if changes:
+            self._overrides[x, y] = dict(changes)
+        value = self._value(tile)
+        if value >= 1 << 16 and self.grid.typecode == 'H':
+            self.grid = array('I', self.grid)
+        self.grid[y * self.width + x] = value
+        self._reindex(x, y)
+        if isinstance(self.renderer, ChunkRenderer):
+            self.renderer.invalidate(x, y)
+        for callback in self.on_change:
+            callback(x, y)
+
+    def __delitem__(self, pos):
+        self[pos] = None
+
+    def _cell(self, pos):
+        '''Return a Cell for the (x, y) index, or None if it is empty or
+        outside the layer.
+        '''
         x, y = pos
-        px = x * self.tile_width
-        py = y * self.tile_width
-        self.cells[pos] = Cell(x, y, px, py, tile)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        value = self.grid[y * self.width + x]
+        if not value:
+            return None
+        return Cell(x, y, x*self.tile_width, y*self.tile_height, self._tile(value), self)
+
+    def _tile(self, value):
+        '''Return the Tile for a grid value.
+        '''
+        if value in self._local_tiles:
+            return self._local_tiles[value]
+        return self.tilesets[value]
+
+    def _value(self, tile):
+        '''Return the grid value for a Tile (0 for None). Tiles that are not
+        in the tilesets get a value of their own.
+        '''
+        if tile is None:
+            return 0
+        if self.tilesets.get(tile.gid) is tile and tile.gid not in self._local_tiles:
+            return tile.gid
+        value = self._local_values.get(id(tile))
+        if value is None:
+            value = max(max(self.tilesets, default=0), max(self._local_tiles, default=0)) + 1
+            self._local_tiles[value] = tile
+            self._local_values[id(tile)] = value
+        return value
 
     def __iter__(self):
         return LayerIterator(self)
@@ -235,23 +501,58 @@ class Layer(object):
     def fromxml(cls, tag, map):
         layer = cls(tag.attrib['name'], int(tag.attrib.get('visible', 1)), map)
 
+        props = tag.find('properties')
+        if props is not None:
+            for c in props.findall('property'):
+                layer.properties[c.attrib['name']] = c.attrib.get('value', c.text)
+        layer.static = _is_true(layer.properties.get('static'))
+
         data = tag.find('data')
         if data is None:
             raise ValueError('layer %s does not contain <data>' % layer.name)
 
-        data = data.text.strip()
-        data = data.decode('base64').decode('zlib')
-        data = struct.unpack('<%di' % (len(data)/4,), data)
-        assert len(data) == layer.width * layer.height
-        for i, gid in enumerate(data):
-            if gid < 1: continue   # not set
-            tile = map.tilesets[gid]
-            x = i % layer.width
-            y = i // layer.width
-            layer.cells[x,y] = Cell(x, y, x*map.tile_width, y*map.tile_height, tile)
-
+        encoding = data.attrib.get('encoding')
+        compression = data.attrib.get('compression')
+        if encoding == 'csv':
+            # scanned straight into an array, not split into a list of strings
+            data = array(tmxloader3._UINT32, (int(m.group()) for m in re.finditer(r'\d+', data.text)))
+            if sys.byteorder == 'big':
+                data.byteswap()
+        elif encoding == 'base64':
+            data = base64.b64decode(data.text.strip())
+            if compression in ('gzip', 'zlib'):
+                data = tmxloader3.decompress(data, compression, layer.width * layer.height * 4)
+            elif compression is not None:
+                raise ValueError('layer %s uses unsupported compression %s' % (layer.name, compression))
+        else:
+            raise ValueError('layer %s uses unsupported encoding %s' % (layer.name, encoding))
+        # the flip flags are cleared, so flipped tiles are drawn unflipped
+        gids, flags = tmxloader3.decode_gids(data, layer.width, layer.height)
+        del data
+        layer.set_gids(gids.array)
         return layer
 
+    def set_gids(self, data):
+        '''Fill the layer from a flat row-by-row sequence of tile gids.
+        '''
+        assert len(data) == self.width * self.height
+        if len(data) and min(data) < 0:
+            data = [max(gid, 0) for gid in data]   # not set
+        top = max(data) if len(data) else 0
+        grid = array('H' if top < 1 << 16 else 'I', data)
+        missing = set(grid).difference(self.tilesets)
+        missing.discard(0)
+        if missing:
+            raise KeyError(min(missing))
+        self.grid = grid
+        self._overrides.clear()
+        self._index.clear()
+        self._masks.clear()
+        if isinstance(self.renderer, ChunkRenderer):
+            self.renderer.invalidate()
+        for callback in self.on_change:
+            callback(None, None)
+
     def update(self, dt, *args):
         pass
 
@@ -262,28 +563,55 @@ class Layer(object):
         y -= viewport_oy
         self.position = (x, y)
 
+    def use_chunks(self, chunk_size=16, budget=DEFAULT_CHUNK_BUDGET, cache=None):
+        '''Draw this layer from pre-composited chunks of chunk_size x
+        chunk_size cells, kept in a ChunkCache limited to budget bytes.
+        Pass a shared cache to give several layers one budget.
+        '''
+        tiles = TileRenderer(self.get_tile_image,
+            (self.width, self.height), (self.tile_width, self.tile_height))
+        self.renderer = ChunkRenderer(tiles, (self.width, self.height),
+            (self.tile_width, self.tile_height), chunk_size, budget, cache=cache)
+
+    def get_tile_image(self, i, j):
+        '''Return the tile Surface at the nominated (i, j) index, or None.
+        '''
+        if not (0 <= i < self.width and 0 <= j < self.height):
+            return None
+        value = self.grid[j * self.width + i]
+        if not value:
+            return None
+        return self._tile(value).surface
+
+    def draw_area(self, surface, area, origin):
+        '''Draw this layer's part of the map space pixel area to the
+        Surface, with the map pixel at origin at (0, 0) of the surface.
+        '''
+        self.renderer.draw_area(surface, area, origin)
+
     def draw(self, surface):
         '''Draw this layer, limited to the current viewport, to the Surface.
         '''
+        view = Rect(self.view_x, self.view_y, self.view_w, self.view_h)
+        self.draw_area(surface, view, self.position)
         ox, oy = self.position
-        w, h = self.view_w, self.view_h
-        for x in range(ox, ox+w+self.tile_width, self.tile_width):
-            i = x // self.tile_width
-            for y in range(oy, oy+h+self.tile_height, self.tile_height):
-                j = y // self.tile_height
-                if (i, j) not in self.cells:
-                    continue
-                cell = self.cells[i, j]
-                surface.blit(cell.tile.surface, (cell.px-ox, cell.py-oy))
+        return [view.move(-ox, -oy)]
 
     def find(self, *properties):
         '''Find all cells with the given properties set.
+
+        Cells are found through an index of the cell positions for each
+        property name, built the first time the name is looked up and kept
+        up to date as cells change. It is built again after any tile's
+        properties change (see TileProperties and reindex).
         '''
         r = []
         for propname in properties:
-            for cell in self.cells.values():
-                if cell and propname in cell:
-                    r.append(cell)
+            positions = []
+            for bucket in self._property_index(propname).values():
+                positions.extend(bucket)
+            positions.sort()
+            r.extend(self._cell_at(i) for i in positions)
         return r
 
     def match(self, **properties):
@@ -291,25 +619,222 @@ class Layer(object):
         '''
         r = []
         for propname in properties:
-            for cell in self.cells.values():
-                if propname not in cell:
-                    continue
-                if properties[propname] == cell[propname]:
-                    r.append(cell)
+            value = properties[propname]
+            index = self._property_index(propname)
+            key = _index_key(value)
+            if key is _UNHASHABLE:
+                positions = [i for i in index.get(key, ())
+                    if self._cell_at(i)[propname] == value]
+            else:
+                positions = list(index.get(key, ()))
+            positions.sort()
+            r.extend(self._cell_at(i) for i in positions)
         return r
 
+    def _cell_at(self, i):
+        '''Return the Cell at a position in the grid.
+        '''
+        y, x = divmod(i, self.width)
+        return self._cell((x, y))
+
+    def reindex(self, *names):
+        '''Drop the property index and mask of the given property names, or
+        of all of them, so they are built again from the tiles' properties
+        the next time they are used. Changes made through Tile.properties
+        are noticed on their own; this is for tiles given a properties dict
+        of their own.
+        '''
+        for name in names or list(self._index):
+            self._index.pop(name, None)
+            self._masks.pop(name, None)
+
+    def _check_index(self):
+        '''Drop the property indexes and masks if a tile's properties
+        changed since they were built.
+        '''
+        if self._index_version != TileProperties.version:
+            self._index.clear()
+            self._masks.clear()
+            self._index_version = TileProperties.version
+
+    def _property_index(self, name):
+        '''Return the positions of the cells with the named property, as a
+        dict of property value to set of grid positions.
+        '''
+        self._check_index()
+        index = self._index.get(name)
+        if index is not None:
+            return index
+        index = self._index[name] = {}
+
+        # the tiles' values, then the cells using those tiles
+        values = {}
+        for value in set(self.grid):
+            if value and name in self._tile(value).properties:
+                values[value] = _index_key(self._tile(value).properties[name])
+        if values:
+            for i, value in enumerate(self.grid):
+                if value in values:
+                    index.setdefault(values[value], set()).add(i)
+
+        # and the changes made through Cells
+        for (x, y), changes in self._overrides.items():
+            if name not in changes:
+                continue
+            i = y * self.width + x
+            if self.grid[i] in values:
+                self._discard(index, values[self.grid[i]], i)
+            if changes[name] is not _DELETED:
+                index.setdefault(_index_key(changes[name]), set()).add(i)
+        return index
+
+    def _unindex(self, x, y, names=None):
+        '''Remove the cell at (x, y) from the property index, for the given
+        property names or all of them.
+        '''
+        if not self._index:
+            return
+        cell = self._cell((x, y))
+        if cell is None:
+            return
+        i = y * self.width + x
+        for name in names or list(self._index):
+            index = self._index.get(name)
+            if index is not None and name in cell:
+                self._discard(index, _index_key(cell[name]), i)
+                if name in self._masks:
+                    self._masks[name][i] = 0
+
+    def _reindex(self, x, y, names=None):
+        '''Add the cell at (x, y) to the property index, for the given
+        property names or all of them.
+        '''
+        if not self._index:
+            return
+        cell = self._cell((x, y))
+        if cell is None:
+            return
+        i = y * self.width + x
+        for name in names or list(self._index):
+            index = self._index.get(name)
+            if index is not None and name in cell:
+                index.setdefault(_index_key(cell[name]), set()).add(i)
+                if name in self._masks:
+                    self._masks[name][i] = 1
+
+    def _discard(self, index, key, i):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.discard(i)
+            if not bucket:
+                del index[key]
+
     def collide(self, rect, propname):
         '''Find all cells the rect is touching that have the indicated property
         name set.
         '''
+        mask = self.get_mask(propname)
+        tw, th = self.tile_width, self.tile_height
+        width, height = self.width, self.height
+        # the range of cells touched, as in get_in_region
+        i1, i2 = int(rect.x // tw), int((rect.x + rect.width) // tw) + 1
+        j1, j2 = int(rect.y // th), int((rect.y + rect.height) // th) + 1
+        i1, j1, i2, j2 = max(i1, 0), max(j1, 0), min(i2, width), min(j2, height)
+        if i1 >= i2 or j1 >= j2:
+            return []
+        find = mask.find
+        hits = []
+        for row in range(j1 * width, j2 * width, width):
+            end = row + i2
+            i = find(1, row + i1, end)
+            while i != -1:
+                hits.append(i)
+                i = find(1, i + 1, end)
+        if len(hits) > 1:
+            hits.sort(key=lambda i: (i % width, i))
+        cells = []
+        for i in hits:
+            cell = self._cell_at(i)
+            if cell.intersects(rect):
+                cells.append(cell)
+        return cells
+
+    def collide_many(self, rects, propname):
+        '''Find the cells each of the rects is touching that have the
+        indicated property name set. rects is a sequence of Rects or (x, y,
+        width, height) tuples.
+
+        Returns a list of Cell lists, one per rect, in the order collide()
+        would return them.
+
+        The cells with the property are looked up in a mask of the layer.
+        The rects are grouped by the shape of the range of cells they touch,
+        and each cell of a shape is looked up for the whole group at once,
+        so only the cells actually hit are looked at in Python.
+        '''
+        mask = self.get_mask(propname)
+        tw, th = self.tile_width, self.tile_height
+        width, height = self.width, self.height
         r = []
-        for cell in self.get_in_region(rect.left, rect.top, rect.right, rect.bottom):
-            if not cell.intersects(rect):
+        # (columns, rows): (rect numbers, position of their top-left cell)
+        groups = {}
+        for n, (x, y, w, h) in enumerate(rects):
+            r.append([])
+            # the range of cells touched, as in get_in_region
+            i1, i2 = int(x // tw), int((x + w) // tw) + 1
+            j1, j2 = int(y // th), int((y + h) // th) + 1
+            if i1 < 0: i1 = 0
+            if j1 < 0: j1 = 0
+            if i2 > width: i2 = width
+            if j2 > height: j2 = height
+            if i1 >= i2 or j1 >= j2:
+                continue
+            group = groups.get((i2 - i1, j2 - j1))
+            if group is None:
+                group = groups[i2 - i1, j2 - j1] = ([], [])
+            group[0].append(n)
+            group[1].append(j1 * width + i1)
+
+        hits = [[] for cells in r]
+        for (columns, rows), (numbers, starts) in groups.items():
+            # column by column, then row by row: the order collide() returns
+            for column in range(columns):
+                for offset in range(column, column + rows * width, width):
+                    positions = list(map(operator.add, starts, itertools.repeat(offset)))
+                    if len(positions) == 1:
+                        found = (mask[positions[0]],)
+                    else:
+                        found = operator.itemgetter(*positions)(mask)
+                    for n, i in itertools.compress(zip(numbers, positions), found):
+                        hits[n].append(i)
+
+        for n, found in enumerate(hits):
+            if not found:
                 continue
-            if propname in cell:
-                r.append(cell)
+            rect = Rect(rects[n])
+            cells = r[n]
+            for i in found:
+                cell = self._cell_at(i)
+                if cell.intersects(rect):
+                    cells.append(cell)
         return r
 
+    def get_mask(self, name):
+        '''Return a bytearray with one byte per cell (row by row), set to 1
+        for the cells with the named property. It is kept up to date as the
+        layer changes, so it must not be modified. A new one is made after a
+        tile's properties change (see find).
+        '''
+        self._check_index()
+        mask = self._masks.get(name)
+        if mask is None:
+            mask = bytearray(self.width * self.height)
+            for bucket in self._property_index(name).values():
+                for i in bucket:
+                    mask[i] = 1
+            self._masks[name] = mask
+        return mask
+
     def get_in_region(self, x1, y1, x2, y2):
         '''Return cells (in [column][row]) that are within the map-space
         pixel bounds specified by the bottom-left (x1, y1) and top-right
@@ -321,19 +846,20 @@ class Layer(object):
         j1 = max(0, y1 // self.tile_height)
         i2 = min(self.width, x2 // self.tile_width + 1)
         j2 = min(self.height, y2 // self.tile_height + 1)
-        return [self.cells[i, j]
+        grid, width = self.grid, self.width
+        return [self._cell((i, j))
             for i in range(int(i1), int(i2))
                 for j in range(int(j1), int(j2))
-                    if (i, j) in self.cells]
+                    if grid[j * width + i]]
 
     def get_at(self, x, y):
         '''Return the cell at the nominated (x, y) coordinate.
 
         Return a Cell instance or None.
         '''
-        i = x // self.tile_width
-        j = y // self.tile_height
-        return self.cells.get((i, j))
+        i = int(x // self.tile_width)
+        j = int(y // self.tile_height)
+        return self._cell((i, j))
 
     def neighbors(self, index):
         '''Return the indexes of the valid (ie. within the map) cardinal (ie.
@@ -353,8 +879,97 @@ class Layer(object):
             n.append((i, j-1))
         return n
 
+class FlatLayer(object):
+    '''Adjacent static Layers drawn as one, from chunks they are
+    pre-composited into. Made by TileMap.flatten, and drawn in place of
+    its Layers; the Layers themselves stay in the TileMap as they were.
+
+    Editing a Layer drops the chunk holding the cell, so it is composited
+    again the next time it is drawn. Showing or hiding a Layer, or
+    replacing its gids with set_gids, drops every chunk.
+
+        layers - the Layers flattened, bottom first
+        renderer - the ChunkRenderer drawing them
+    '''
+    def __init__(self, layers, chunk_size=16, budget=DEFAULT_CHUNK_BUDGET, cache=None, alpha=True):
+        self.layers = list(layers)
+        first = self.layers[0]
+        self.stack = StackRenderer([])
+        self.renderer = ChunkRenderer(self.stack, (first.width, first.height),
+            (first.tile_width, first.tile_height), chunk_size, budget, alpha, cache)
+        self._tiles = [TileRenderer(layer.get_tile_image, (layer.width, layer.height),
+            (layer.tile_width, layer.tile_height)) for layer in self.layers]
+        self._state = None
+        for layer in self.layers:
+            layer.flat = self
+            layer.on_change.append(self._changed)
+
+    def __repr__(self):
+        return '<FlatLayer of %s>' % ', '.join('"%s"' % layer.name for layer in self.layers)
+
+    @property
+    def visible(self):
+        return any(layer.visible for layer in self.layers)
+
+    def _changed(self, x, y):
+        self.renderer.invalidate(x, y)
+
+    def _check(self):
+        '''Drop every chunk if a Layer was shown, hidden or refilled since
+        they were composited.
+        '''
+        state = [(layer.visible, layer.grid) for layer in self.layers]
+        if self._state is not None and all(visible == old_visible and grid is old_grid
+                for (visible, grid), (old_visible, old_grid) in zip(state, self._state)):
+            return
+        self._state = state
+        self.stack.sources = [tiles for layer, tiles in zip(self.layers, self._tiles) if layer.visible]
+        self.renderer.invalidate()
+
+    def detach(self):
+        '''Stop drawing the Layers from chunks.
+        '''
+        for layer in self.layers:
+            layer.flat = None
+            layer.on_change.remove(self._changed)
+        self.renderer.invalidate()
+
+    def update(self, dt, *args):
+        pass
+
+    def draw_area(self, surface, area, origin):
+        '''Draw the chunks overlapping the map space pixel area to the
+        Surface, with the map pixel at origin at (0, 0) of the surface.
+        '''
+        self._check()
+        self.renderer.draw_area(surface, area, origin)
+
+    def draw(self, surface):
+        '''Draw the Layers, limited to the current viewport, to the Surface.
+        '''
+        first = self.layers[0]
+        view = Rect(first.view_x, first.view_y, first.view_w, first.view_h)
+        self.draw_area(surface, view, first.position)
+        ox, oy = first.position
+        return [view.move(-ox, -oy)]
+
 class SpriteLayer(pygame.sprite.AbstractGroup):
-    def __init__(self):
+    '''A group of sprites drawn as a layer of the TileMap.
+
+    The sprites are kept in a spatial hash of bucket_size x bucket_size
+    pixel buckets, so draw() only visits the sprites near the view and
+    get_in_region() / get_near() only the sprites near the area asked for.
+
+    Sprites that moved are found and re-hashed in update(). Call
+    moved(sprite) after moving a sprite some other way.
+    '''
+    def __init__(self, bucket_size=256):
+        self.bucket_size = bucket_size
+        self._buckets = {}      # (column, row) -> set of sprites
+        self._placed = {}       # sprite -> (rect when hashed, bucket keys)
+        self._order = {}        # sprite -> order it was added in
+        self._added = 0
+        self._drawn = set()
         super(SpriteLayer, self).__init__()
         self.visible = True
 
@@ -365,12 +980,222 @@ class SpriteLayer(pygame.sprite.AbstractGroup):
         y -= viewport_oy
         self.position = (x, y)
 
+    def add_internal(self, sprite, layer=None):
+        super(SpriteLayer, self).add_internal(sprite)
+        self._order[sprite] = self._added
+        self._added += 1
+        self._place(sprite)
+
+    def remove_internal(self, sprite):
+        super(SpriteLayer, self).remove_internal(sprite)
+        self._unplace(sprite)
+        del self._order[sprite]
+        self._drawn.discard(sprite)
+
+    def update(self, *args, **kwargs):
+        '''Update the sprites, then re-hash the ones that moved.
+        '''
+        super(SpriteLayer, self).update(*args, **kwargs)
+        # compare each sprite's rect with the one it was hashed with, in C
+        placed = self._placed
+        changed = map(operator.ne, map(operator.attrgetter('rect'), placed),
+            map(operator.itemgetter(0), placed.values()))
+        for sprite in list(itertools.compress(placed, changed)):
+            self.moved(sprite)
+
+    def moved(self, sprite):
+        '''Re-hash a sprite after its rect changed.
+        '''
+        if sprite not in self._placed:
+            return
+        rect, keys = self._placed[sprite]
+        if self._keys(sprite.rect) == keys:
+            self._placed[sprite] = (Rect(sprite.rect), keys)
+        else:
+            self._unplace(sprite)
+            self._place(sprite)
+
+    def _ranges(self, rect):
+        '''Return the ranges of bucket columns and rows the map-space rect
+        is in.
+        '''
+        size = self.bucket_size
+        columns = range(rect.left // size, max(rect.left, rect.right - 1) // size + 1)
+        rows = range(rect.top // size, max(rect.top, rect.bottom - 1) // size + 1)
+        return columns, rows
+
+    def _keys(self, rect):
+        '''Return the keys of the buckets the map-space rect is in.
+        '''
+        columns, rows = self._ranges(rect)
+        return [(column, row) for column in columns for row in rows]
+
+    def _place(self, sprite):
+        keys = self._keys(sprite.rect)
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = set()
+            bucket.add(sprite)
+        self._placed[sprite] = (Rect(sprite.rect), keys)
+
+    def _unplace(self, sprite):
+        rect, keys = self._placed.pop(sprite)
+        for key in keys:
+            bucket = self._buckets[key]
+            bucket.discard(sprite)
+            if not bucket:
+                del self._buckets[key]
+
+    def get_in_region(self, x1, y1, x2, y2):
+        '''Return the sprites touching the map-space pixel area from (x1, y1)
+        to (x2, y2), in the order they were added.
+        '''
+        area = Rect(x1, y1, x2 - x1, y2 - y1)
+        columns, rows = self._ranges(area)
+        found = set()
+        if len(columns) * len(rows) > len(self._buckets):
+            # asking for more than the layer covers
+            for bucket in self._buckets.values():
+                found.update(bucket)
+        else:
+            buckets = self._buckets
+            for column in columns:
+                for row in rows:
+                    bucket = buckets.get((column, row))
+                    if bucket:
+                        found.update(bucket)
+        return sorted((sprite for sprite in found if area.colliderect(sprite.rect)),
+            key=self._order.__getitem__)
+
+    def get_near(self, x, y, radius):
+        '''Return the sprites whose rect is within radius pixels of the
+        map-space point (x, y), nearest first.
+        '''
+        near = []
+        for sprite in self.get_in_region(x - radius, y - radius, x + radius + 1, y + radius + 1):
+            # to the nearest pixel of the sprite
+            rect = sprite.rect
+            dx = max(rect.left - x, 0, x - rect.right + 1)
+            dy = max(rect.top - y, 0, y - rect.bottom + 1)
+            distance = dx * dx + dy * dy
+            if distance <= radius * radius:
+                near.append((distance, self._order[sprite], sprite))
+        near.sort(key=lambda n: n[:2])
+        return [sprite for distance, order, sprite in near]
+
     def draw(self, screen):
+        '''Draw the sprites in view to the screen. Return the screen rects
+        changed since the last draw: where each sprite is now and where it
+        was, including sprites that have left the view.
+        '''
         ox, oy = self.position
-        w, h = self.view_w, self.view_h
-        for sprite in self.sprites():
+        spritedict = self.spritedict
+        dirty = self.lostsprites
+        self.lostsprites = []
+        visible = self.get_in_region(self.view_x, self.view_y,
+            self.view_x + self.view_w, self.view_y + self.view_h)
+        drawn = set(visible)
+        for sprite in self._drawn - drawn:
+            old = spritedict[sprite]
+            if old:
+                dirty.append(old)
+            spritedict[sprite] = 0
+        self._drawn = drawn
+        for sprite in visible:
             sx, sy = sprite.rect.topleft
-            screen.blit(sprite.image, (sx-ox, sy-oy))
+            rect = screen.blit(sprite.image, (sx-ox, sy-oy))
+            old = spritedict[sprite]
+            if not old:
+                dirty.append(rect)
+            elif rect.colliderect(old):
+                dirty.append(rect.union(old))
+            else:
+                dirty.append(rect)
+                dirty.append(old)
+            spritedict[sprite] = rect
+        return dirty
+
+class DepthSpriteLayer(SpriteLayer):
+    '''A SpriteLayer drawn in depth order: sprites lower on the map (with a
+    larger rect.bottom) are drawn over the ones above them, and sprites at
+    the same depth in the order they were added.
+
+    Each bucket of the spatial hash keeps its sprites sorted by depth, and
+    only sprites whose rect.bottom changed are moved within it, so the
+    layer is never sorted as a whole. Drawing and get_in_region() merge the
+    sorted buckets in the area.
+    '''
+    def __init__(self, bucket_size=256):
+        self._depth = {}        # bucket key -> sorted list of (bottom, order, sprite)
+        self._depth_of = {}     # sprite -> (bottom, order) it was placed with
+        super(DepthSpriteLayer, self).__init__(bucket_size)
+
+    def moved(self, sprite):
+        if sprite not in self._placed:
+            return
+        bottom, order = self._depth_of[sprite]
+        if sprite.rect.bottom == bottom:
+            super(DepthSpriteLayer, self).moved(sprite)
+            return
+        rect, keys = self._placed[sprite]
+        if self._keys(sprite.rect) != keys:
+            self._unplace(sprite)
+            self._place(sprite)
+            return
+        # same buckets, new depth: move it within them
+        entry = (sprite.rect.bottom, order, sprite)
+        for key in keys:
+            depth = self._depth[key]
+            del depth[bisect.bisect_left(depth, (bottom, order))]
+            bisect.insort(depth, entry)
+        self._depth_of[sprite] = entry[:2]
+        self._placed[sprite] = (Rect(sprite.rect), keys)
+
+    def _place(self, sprite):
+        super(DepthSpriteLayer, self)._place(sprite)
+        entry = (sprite.rect.bottom, self._order[sprite], sprite)
+        self._depth_of[sprite] = entry[:2]
+        for key in self._placed[sprite][1]:
+            depth = self._depth.get(key)
+            if depth is None:
+                depth = self._depth[key] = []
+            bisect.insort(depth, entry)
+
+    def _unplace(self, sprite):
+        bottom, order = self._depth_of.pop(sprite)
+        for key in self._placed[sprite][1]:
+            depth = self._depth[key]
+            del depth[bisect.bisect_left(depth, (bottom, order))]
+            if not depth:
+                del self._depth[key]
+        super(DepthSpriteLayer, self)._unplace(sprite)
+
+    def get_in_region(self, x1, y1, x2, y2):
+        '''Return the sprites touching the map-space pixel area from (x1, y1)
+        to (x2, y2), in depth order.
+        '''
+        area = Rect(x1, y1, x2 - x1, y2 - y1)
+        columns, rows = self._ranges(area)
+        if len(columns) * len(rows) > len(self._depth):
+            lists = list(self._depth.values())
+        else:
+            lists = [self._depth[column, row] for column in columns for row in rows
+                if (column, row) in self._depth]
+        if len(lists) == 1:
+            merged = lists[0]
+        else:
+            merged = heapq.merge(*lists, key=operator.itemgetter(0, 1))
+        r = []
+        seen = set()
+        for bottom, order, sprite in merged:
+            # sprites in several buckets come up once per bucket
+            if sprite in seen:
+                continue
+            seen.add(sprite)
+            if area.colliderect(sprite.rect):
+                r.append(sprite)
+        return r
 
 class Layers(list):
     def __init__(self):
@@ -381,8 +1206,8 @@ class Layers(list):
         self.by_name[name] = layer
 
     def __getitem__(self, item):
-        if isinstance(item, int):
-            return self[item]
+        if isinstance(item, (int, slice)):
+            return list.__getitem__(self, item)
         return self.by_name[item]
 
 class TileMap(object):
@@ -410,6 +1235,8 @@ class TileMap(object):
         view_w, view_h - viewport size
         view_x, view_y - viewport offset (origin)
         viewport - a Rect instance giving the current viewport specification
+        flat_layers - the FlatLayers drawn in place of static Layers (see
+                      flatten)
 
     '''
     def __init__(self, size, origin=(0,0)):
@@ -426,37 +1253,247 @@ class TileMap(object):
         self.view_w, self.view_h = size     # viewport size
         self.view_x, self.view_y = origin   # viewport offset
         self.viewport = Rect(origin, size)
+        self.flat_layers = []
 
     def update(self, dt, *args):
         for layer in self.layers:
             layer.update(dt, *args)
 
+    def _draw_order(self, layers):
+        '''Return the layers to draw, with each FlatLayer in place of the
+        Layers it flattens.
+        '''
+        if not self.flat_layers:
+            return layers
+        order = []
+        for layer in layers:
+            flat = getattr(layer, 'flat', None)
+            if flat is None:
+                order.append(layer)
+            elif flat.layers[0] is layer:
+                order.append(flat)
+        return order
+
+    scroll_buffer = None
     def draw(self, screen):
-        for layer in self.layers:
+        '''Draw all visible layers to the screen. Return the screen rects
+        that changed, ready for pygame.display.update().
+        '''
+        if self.scroll_buffer is not None:
+            return self._draw_buffered(screen)
+        dirty = []
+        for layer in self._draw_order(self.layers):
             if layer.visible:
+                dirty.extend(layer.draw(screen))
+        return dirty
+
+    def use_scroll_buffer(self, background=None):
+        '''Keep the bottom tile Layers (up to the first non-tile layer) in a
+        back buffer that is shifted when the focus moves, so only the newly
+        exposed strips are drawn. Layers above are drawn as usual.
+
+        With no background color the buffer is transparent and blended onto
+        the screen, otherwise it is opaque and cleared to that color.
+        '''
+        self.scroll_buffer = ScrollRenderer(self, (self.view_w, self.view_h), background)
+        self._buffered_state = None
+        tw, th = self.tile_width, self.tile_height
+        def changed(x, y):
+            if x is None:
+                self.scroll_buffer.invalidate()
+            else:
+                self.scroll_buffer.invalidate(Rect(x*tw, y*th, tw, th))
+        for layer in self.layers:
+            if isinstance(layer, Layer):
+                layer.on_change.append(changed)
+
+    def _buffered_layers(self):
+        buffered = []
+        for layer in self.layers:
+            if not isinstance(layer, Layer):
+                break
+            buffered.append(layer)
+        return buffered
+
+    def _draw_buffered(self, screen):
+        buffered = self._buffered_layers()
+        above = [layer for layer in self.layers[len(buffered):] if layer.visible]
+        # redraw everything if layers were added or shown/hidden
+        state = [(layer, layer.visible) for layer in buffered]
+        if state != self._buffered_state:
+            self._buffered_state = state
+            self.scroll_buffer.invalidate()
+        strips = self.scroll_buffer.update(self.viewport)
+        buffer = self.scroll_buffer.buffer
+        view = Rect((self.view_x, self.view_y), buffer.get_size())
+
+        if self.scroll_buffer.moved or any(isinstance(layer, Layer) for layer in above):
+            # the whole viewport changes
+            screen.blit(buffer, view)
+            for layer in above:
                 layer.draw(screen)
+            return [view]
+
+        # only sprites moved: put the buffer back where they were
+        def restore(surface, rect):
+            rect = rect.clip(view)
+            surface.blit(buffer, rect, rect.move(-view.x, -view.y))
+        for layer in above:
+            layer.clear(screen, restore)
+        dirty = []
+        for strip in strips:
+            rect = strip.move(view.topleft)
+            screen.blit(buffer, rect, strip)
+            dirty.append(rect)
+        for layer in above:
+            dirty.extend(layer.draw(screen))
+        return dirty
+
+    def draw_area(self, surface, area, origin):
+        '''Draw the buffered tile Layers for the map space pixel area onto
+        the surface, with the map pixel at origin at (0, 0) of the surface.
+        '''
+        for layer in self._draw_order(self._buffered_layers()):
+            if layer.visible:
+                layer.draw_area(surface, area, origin)
+
+    def use_chunks(self, chunk_size=16, budget=DEFAULT_CHUNK_BUDGET):
+        '''Draw all tile Layers from pre-composited chunks sharing a single
+        ChunkCache, so the whole map stays within budget bytes of chunks.
+        '''
+        self.chunk_cache = ChunkCache(budget)
+        for layer in self.layers:
+            if isinstance(layer, Layer):
+                layer.use_chunks(chunk_size, cache=self.chunk_cache)
+
+    def flatten(self, layers=None, chunk_size=16, budget=DEFAULT_CHUNK_BUDGET, alpha=True):
+        '''Draw each run of adjacent static Layers as one FlatLayer,
+        pre-composited into chunks of chunk_size x chunk_size cells that
+        share a ChunkCache of budget bytes. The other layers are drawn as
+        usual, in between or on top.
+
+        layers may give the Layers (or their names) to flatten instead of
+        the static ones. Pass alpha=False if the bottom Layer of each run
+        fills every cell, as opaque chunks blit faster.
+
+        Returns the FlatLayers, which are also kept in flat_layers.
+        '''
+        self.unflatten()
+        if layers is None:
+            layers = [layer for layer in self.layers if isinstance(layer, Layer) and layer.static]
+        else:
+            layers = [self.layers[layer] if isinstance(layer, str) else layer for layer in layers]
+        chosen = set(id(layer) for layer in layers)
+
+        runs = [[]]
+        for layer in self.layers:
+            if isinstance(layer, Layer) and id(layer) in chosen:
+                runs[-1].append(layer)
+            elif runs[-1]:
+                runs.append([])
+
+        cache = ChunkCache(budget)
+        self.flat_layers = [FlatLayer(run, chunk_size, cache=cache, alpha=alpha) for run in runs if run]
+        return self.flat_layers
+
+    def unflatten(self):
+        '''Draw the flattened Layers one by one again.
+        '''
+        for flat in self.flat_layers:
+            flat.detach()
+        self.flat_layers = []
 
     @classmethod
-    def load(cls, filename, viewport):
-        with open(filename) as f:
-            map = ElementTree.fromstring(f.read())
+    def load(cls, filename, viewport, atlas=None, cache=False, workers=None,
+            cache_dir=None):
+        '''Load a TMX file. atlas may be an atlas.Atlas holding the tileset
+        images, so they are cut from its sheets instead of loaded one by one.
+
+        With cache the map is compiled to a binary file (see mapcache) the
+        first time and loaded from that until the TMX, TSX or images change.
+        It is kept in cache_dir, by default a ".mapcache" folder next to the
+        map.
+
+        The tileset images are decoded by workers threads (see
+        images.preload). Layers with a true "static" property are
+        flattened (see flatten).
+        '''
+        if cache:
+            import mapcache
+            return cls.fromtiled(mapcache.load_tmx(filename, cache_dir), viewport,
+                atlas, workers)
+
+        # the file is streamed, each tileset and layer is freed once loaded
+        tilemap = TileMap(viewport)
+        map = None
+        depth = 0
+        # tilesets are created together, before the first layer needs them
+        tilesets = []
+        def add_tilesets():
+            for tileset in Tileset.fromxml_all(tilesets, atlas, workers):
+                tilemap.tilesets.add(tileset)
+            del tilesets[:]
+        for event, tag in ElementTree.iterparse(filename, ('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    # get most general map informations
+                    map = tag
+                    tilemap.width = int(map.attrib['width'])
+                    tilemap.height  = int(map.attrib['height'])
+                    tilemap.tile_width = int(map.attrib['tilewidth'])
+                    tilemap.tile_height = int(map.attrib['tileheight'])
+                    tilemap.px_width = tilemap.width * tilemap.tile_width
+                    tilemap.px_height = tilemap.height * tilemap.tile_height
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+            if tag.tag == 'tileset':
+                tilesets.append(tag)
+            elif tag.tag == 'layer':
+                add_tilesets()
+                layer = Layer.fromxml(tag, tilemap)
+                tilemap.layers.add_named(layer, layer.name)
+            map.remove(tag)
+        add_tilesets()
+
+        if any(isinstance(layer, Layer) and layer.static for layer in tilemap.layers):
+            tilemap.flatten()
+        return tilemap
 
-        # get most general map informations and create a surface
+    @classmethod
+    def fromtiled(cls, tiledmap, viewport, atlas=None, workers=None):
+        '''Create a TileMap from a map loaded by tmxloader3.load_tmx (or a
+        compiled one from mapcache). Flipped tiles are drawn unflipped.
+        '''
         tilemap = TileMap(viewport)
-        tilemap.width = int(map.attrib['width'])
-        tilemap.height  = int(map.attrib['height'])
-        tilemap.tile_width = int(map.attrib['tilewidth'])
-        tilemap.tile_height = int(map.attrib['tileheight'])
+        tilemap.width = tiledmap.width
+        tilemap.height = tiledmap.height
+        tilemap.tile_width = tiledmap.tilewidth
+        tilemap.tile_height = tiledmap.tileheight
         tilemap.px_width = tilemap.width * tilemap.tile_width
         tilemap.px_height = tilemap.height * tilemap.tile_height
 
-        for tag in map.findall('tileset'):
-            tilemap.tilesets.add(Tileset.fromxml(tag))
-
-        for tag in map.findall('layer'):
-            layer = Layer.fromxml(tag, tilemap)
+        images.preload([t.source for t in tiledmap.tilesets
+            if atlas is None or not atlas.has(t.source, t.trans)], workers)
+        for t in tiledmap.tilesets:
+            tileset = Tileset(t.name, t.tilewidth, t.tileheight, t.firstgid)
+            tileset.add_image(t.source, atlas, t.trans)
+            for tile in tileset.tiles:
+                tile.add_properties(tiledmap.tile_properties.get(tile.gid, {}).items())
+            tilemap.tilesets.add(tileset)
+
+        for l in tiledmap.tilelayers:
+            layer = Layer(l.name, int(l.visible), tilemap)
+            layer.set_gids(l.data.array)
+            layer.properties.update(l.properties)
+            layer.static = _is_true(layer.properties.get('static'))
             tilemap.layers.add_named(layer, layer.name)
 
+        if any(layer.static for layer in tilemap.layers):
+            tilemap.flatten()
         return tilemap
 
     _old_focus = None
@@ -570,8 +1607,8 @@ class TileMap(object):
         sx, sy = self.pixel_from_screen(x, y)
         return int(sx//self.tile_width), int(sy//self.tile_height)
 
-def load(filename, viewport):
-    return TileMap.load(filename, viewport)
+def load(filename, viewport, workers=None):
+    return TileMap.load(filename, viewport, workers=workers)
 
 if __name__ == '__main__':
     # allow image load to work
@@ -43,6 +43,10 @@ When you want to draw tiles, you simply call "get_tile_image":
     >>> image = tiledmap.get_tile_image(x, y, layer)
     >>> screen.blit(image, position)
 
+or, for a whole area at once, "getTileImages":
+
+    >>> screen.blits(tiledmap.getTileImages(area, layer, origin), False)
+
 
 Layers, objectgroups, tilesets, and maps all have a simple way to access
 metadata that was set inside tiled: they all become class attributes.
@@ -63,16 +67,88 @@ and are regular Python dictionaries:
 """
 
 from itertools import chain
+import array, hashlib, re, sys, zlib
 
 
 # internal flags
 FLIP_X = 1
 FLIP_Y = 2
+FLIP_D = 4
 
 
 # Tiled gid flags
 GID_FLIP_X = 1<<31
 GID_FLIP_Y = 1<<30
+GID_FLIP_D = 1<<29
+
+
+# the flip flags live in the most significant byte of each little-endian gid,
+# so they can be read and cleared for a whole layer with bytes.translate
+_FLAGS_TABLE = bytes(((b & 0x80) and FLIP_X) | ((b & 0x40) and FLIP_Y) | ((b & 0x20) and FLIP_D)
+                     for b in range(256))
+_MASK_TABLE = bytes(b & 0x1f for b in range(256))
+
+# array typecode for unsigned 32-bit ints
+_UINT32 = "I" if array.array("I").itemsize == 4 else "L"
+
+
+def decompress(data, compression, size=0):
+    """
+    decompress a layer's "gzip" or "zlib" compressed data
+
+    size is the expected size of the result: when it is right, the result
+    is allocated once instead of grown (and copied) while it is inflated
+    """
+
+    wbits = {"gzip": 16 + zlib.MAX_WBITS, "zlib": zlib.MAX_WBITS}[compression]
+    return zlib.decompress(data, wbits, max(size, zlib.DEF_BUF_SIZE))
+
+
+def decode_gids(data, width, height):
+    """
+    decode a layer's raw gids (little-endian unsigned 32-bit ints) in bulk
+
+    returns the layer data and its flip flags (FLIP_X, FLIP_Y and FLIP_D,
+    one byte per tile) as TiledLayerData, or None for the flags if no tile
+    is flipped
+    """
+
+    # the data is only read: the gids are copied out without their flip flags
+    raw = memoryview(data).cast("B")
+    count = width * height
+
+    if len(raw) != count * 4:
+        msg = "Layer data has {0} gids, expected {1}.".format(len(raw) // 4, count)
+        raw.release()
+        raise Exception(msg)
+    high = bytes(raw[3::4])
+    flags = high.translate(_FLAGS_TABLE)
+    high = high.translate(_MASK_TABLE)
+
+    # store as 16-bit ints when they fit, which is almost always.  the low
+    # two bytes of each gid are copied across with strided slices, so the
+    # whole layer is never copied as 32-bit ints
+    if high.count(0) == count and bytes(raw[2::4]).count(0) == count:
+        gids = array.array("H", [0]) * count
+        out = memoryview(gids).cast("B")
+        low = 0 if sys.byteorder == "little" else 1
+        out[low::2] = raw[0::4]
+        out[1 - low::2] = raw[1::4]
+        out.release()
+    else:
+        gids = array.array(_UINT32)
+        gids.frombytes(raw)
+        out = memoryview(gids).cast("B")
+        out[3::4] = high
+        out.release()
+        if sys.byteorder == "big":
+            gids.byteswap()
+    raw.release()
+    del high
+
+    if flags.count(0) == len(flags):
+        return TiledLayerData(gids, width, height), None
+    return TiledLayerData(gids, width, height), TiledLayerData(bytearray(flags), width, height)
 
 
 class TiledElement(object):
@@ -96,6 +172,11 @@ class TiledMap(TiledElement):
         # this is a work around to tiled's strange way of storing gid's
         self.images = [0]
 
+        # flipped tiles use a transformed copy of their image, made once for
+        # each (gid, flags) by make_variant and shared.  see get_variant
+        self.variants = {}
+        self.make_variant = None
+
         # defaults from the TMX specification
         self.version = 0.0
         self.orientation = None
@@ -113,18 +194,39 @@ class TiledMap(TiledElement):
         """
 
         try:
-            gid = self.tilelayers[layer].data[y][x]
+            tiles = self.tilelayers[layer]
+            gid = tiles.data[y][x]
+            flags = 0 if tiles.flags is None else tiles.flags[y][x]
         except (IndexError, ValueError):
             msg = "Coords: ({0},{1}) in layer {2} is invalid.".format(x, y, layer)
             raise Exception(msg)
 
         else:
             try:
+                if flags:
+                    return self.get_variant(gid, flags)
                 return self.images[gid]
             except (IndexError, ValueError):
                 msg = "Coords: ({0},{1}) in layer {2} has invalid GID: {3}/{4}.".format(x, y, layer, gid, len(self.images))
                 raise Exception(msg)
 
+    def get_variant(self, gid, flags):
+        """
+        return the image of a gid transformed by flags (FLIP_X, FLIP_Y and
+        FLIP_D, the diagonal flip tiled uses for rotations)
+
+        each variant is only made once, and shared by every tile using it
+        """
+
+        try:
+            return self.variants[gid, flags]
+        except KeyError:
+            image = self.images[gid]
+            if image and flags and self.make_variant is not None:
+                image = self.make_variant(image, flags)
+            self.variants[gid, flags] = image
+            return image
+
     def getTileGID(self, x, y, layer):
         """
         return GID of a tile in this location
@@ -137,6 +239,45 @@ class TiledMap(TiledElement):
             msg = "Coords: ({0},{1}) in layer {2} is invalid.".format(x, y, layer)
             raise Exception(msg)
 
+    def getTileFlags(self, x, y, layer):
+        """
+        return the flip flags of a tile in this location (0 if not flipped)
+        x and y must be integers and are in tile coordinates, not pixel
+        """
+
+        try:
+            tiles = self.tilelayers[layer]
+            return 0 if tiles.flags is None else tiles.flags[y][x]
+        except (IndexError, ValueError):
+            msg = "Coords: ({0},{1}) in layer {2} is invalid.".format(x, y, layer)
+            raise Exception(msg)
+
+    def setTileGID(self, x, y, layer, gid, flags=0):
+        """
+        change the tile in this location, optionally flipped
+        x and y must be integers and are in tile coordinates, not pixel
+
+        only the layer data changes: a flipped tile shares the image of
+        every other tile with the same gid and flags (see get_variant).
+        layers decoded as 16 bit gids are widened to 32 bits for a larger gid
+        """
+
+        if not 0 <= gid < GID_FLIP_D:
+            raise ValueError("GID {0} is invalid, gids must be from 0 to {1}.".format(gid, GID_FLIP_D - 1))
+
+        try:
+            tiles = self.tilelayers[layer]
+            if gid > 0xffff and memoryview(tiles.data.array).itemsize < 4:
+                tiles.data = TiledLayerData(array.array(_UINT32, tiles.data.array), tiles.width, tiles.height)
+            tiles.data[y][x] = gid
+            if flags and tiles.flags is None:
+                tiles.flags = TiledLayerData(bytearray(tiles.width * tiles.height), tiles.width, tiles.height)
+            if tiles.flags is not None:
+                tiles.flags[y][x] = flags
+        except (IndexError, ValueError):
+            msg = "Coords: ({0},{1}) in layer {2} is invalid.".format(x, y, layer)
+            raise Exception(msg)
+
     def getDrawOrder(self):
         """
         return a list of objects in the order that they should be drawn
@@ -146,18 +287,52 @@ class TiledMap(TiledElement):
         from tiled
         """
 
-        raise NotImplementedError
+        return [ layer for layer in self.layers if layer.visible ]
 
-    def getTileImages(self, r, layer):
+    def getTileImages(self, r, layer, origin=(0, 0)):
         """
-        return a group of tiles in an area
-        expects a pygame rect or rect-like list/tuple
+        return the tiles in an area as a list of (image, position) pairs,
+        ready for Surface.blits
+        expects a pygame rect or rect-like list/tuple, in tile coordinates
+
+        origin is the pixel position tile (0, 0) is drawn at; the area is
+        clipped to the layer and empty tiles are skipped.
 
-        useful if you don't want to repeatedly call get_tile_image
-        probably not the most efficient way of doing this, but oh well.
+        much faster than calling get_tile_image for each tile, as the
+        layer data is read a row slice at a time.
         """
 
-        raise NotImplementedError
+        tiles = self.tilelayers[layer]
+        x, y, w, h = r
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, tiles.width), min(y + h, tiles.height)
+        if x0 >= x1 or y0 >= y1:
+            return []
+
+        tw, th = self.tilewidth, self.tileheight
+        ox, oy = origin
+        xs = range(ox + x0 * tw, ox + x1 * tw, tw)
+        gids = tiles.data.array
+        flags = None if tiles.flags is None else tiles.flags.array
+        images = self.images
+        blits = []
+
+        try:
+            for y in range(y0, y1):
+                start = y * tiles.width
+                row = gids[start + x0:start + x1]
+                py = oy + y * th
+                flagrow = None if flags is None else flags[start + x0:start + x1]
+                if flagrow is None or not any(flagrow):
+                    blits.extend([ (images[gid], (px, py)) for gid, px in zip(row, xs) if gid ])
+                else:
+                    blits.extend([ (self.get_variant(gid, flag) if flag else images[gid], (px, py))
+                                   for gid, flag, px in zip(row, flagrow, xs) if gid ])
+        except (IndexError, ValueError):
+            msg = "Area {0} in layer {1} has an invalid GID (of {2}).".format(tuple(r), layer, len(self.images))
+            raise Exception(msg)
+
+        return blits
 
     def getObjects(self):
         """
@@ -212,12 +387,45 @@ class TiledLayer(TiledElement):
     def __init__(self):
         TiledElement.__init__(self)
         self.data = None
+        self.flags = None           # flip flags of each tile, if any are flipped
+        self.properties = {}        # the layer's tiled properties (also set as attributes)
 
         # defaults from the specification
         self.name = None
         self.opacity = 1.0
         self.visible = 1
 
+class TiledLayerData(object):
+    """
+    2D grid of gids stored in one contiguous array, row by row
+
+    rows are accessed like the list of arrays it replaces:
+
+    >>> gid = layer.data[y][x]
+    >>> layer.data[y][x] = gid
+    """
+
+    __slots__ = ['array', 'width', 'height', '_view']
+
+    def __init__(self, gids, width, height):
+        self.array = gids
+        self.width = width
+        self.height = height
+        self._view = memoryview(gids)
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, y):
+        if y < 0: y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("row index out of range")
+        return self._view[y * self.width:(y + 1) * self.width]
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield self[y]
+
 class TiledObjectGroup(TiledElement):
     def __init__(self):
         TiledElement.__init__(self)
@@ -225,6 +433,8 @@ class TiledObjectGroup(TiledElement):
 
         # defaults from the specification
         self.name = None
+        self.opacity = 1.0
+        self.visible = 1
 
 class TiledObject(TiledElement):
     __slots__ = ['name', 'type', 'x', 'y', 'width', 'height', 'gid']
@@ -242,21 +452,32 @@ class TiledObject(TiledElement):
         self.gid = 0
 
 
-def load_tmx(filename):
+def load_tmx(filename, cache=False, cache_dir=None):
     """
     Utility function to parse a Tiled TMX and return a usable object.
     Images will not be loaded, so probably not useful to call this directly
 
+    The file is streamed: each tileset, layer and objectgroup is parsed as
+    soon as it has been read and then freed, so the whole document is never
+    held in memory at once.
+
+    with cache=True the map is compiled into a ".mapcache" folder next to
+    it, or into cache_dir if given (see mapcache.py), and later loads map
+    that instead of parsing xml, until the map, its tsx files or its images
+    change.
+
     See the load_pygame func for an idea of what to do
     """
 
-    from xml.dom.minidom import parse
-    from itertools import tee, islice, chain
+    if cache:
+        import mapcache
+        return mapcache.load_tmx(filename, cache_dir)
+
+    from xml.etree.ElementTree import iterparse, parse
     from collections import defaultdict
-    from struct import unpack
-    import array, os
+    import os
 
-    # used to change the unicode string returned from minidom to
+    # used to change the strings read from the xml to
     # proper python variable types.
     types = {
         "version": float,
@@ -274,7 +495,7 @@ def load_tmx(filename):
         "trans": str,
         "id": int,
         "opacity": float,
-        "visible": bool,
+        "visible": lambda v: bool(int(v)),
         "encoding": str,
         "compression": str,
         "gid": int,
@@ -284,16 +505,6 @@ def load_tmx(filename):
         "value": str,
     }
 
-    def pairwise(iterable):
-        # return a list as a sequence of pairs
-        a, b = tee(iterable)
-        next(b, None)
-        return zip(a, b)
-
-    def group(l, n):
-        # return a list as a sequence of n tuples
-        return zip(*[islice(l, i, None, n) for i in range(n)])
-
     def parse_properties(node):
         """
         parse a node and return a dict that represents a tiled "property"
@@ -301,13 +512,10 @@ def load_tmx(filename):
 
         d = {}
 
-        for child in node.childNodes:
-            if child.nodeName == "properties":
-                for subnode in child.getElementsByTagName("property"):
-                    # the "properties" from tiled's tmx have an annoying
-                    # quality that "name" and "value" is included as part of it.
-                    # so we mangle it to get that stuff out.
-                    d.update(dict(pairwise([ str(i.value) for i in list(subnode.attributes.values()) ])))
+        for subnode in node.findall("properties/property"):
+            value = subnode.get("value")
+            if value is None: value = subnode.text or ""
+            d[str(subnode.get("name"))] = str(value)
 
         return d
 
@@ -342,51 +550,12 @@ def load_tmx(filename):
 
         d = defaultdict(lambda:None)
 
-        for k, v in list(node.attributes.items()):
+        for k, v in list(node.attrib.items()):
             k = str(k)
-            d[k] = types[k](v)
+            d[k] = types.get(k, str)(v)
 
         return d
 
-    def decode_gid(raw_gid):
-        # gids are encoded with extra information
-        # as of 0.7.0 it determines if the tile should be flipped when rendered
-
-        flags = 0
-        if raw_gid & GID_FLIP_X == GID_FLIP_X: flags += FLIP_X
-        if raw_gid & GID_FLIP_Y == GID_FLIP_Y: flags += FLIP_Y
-        gid = raw_gid & ~(GID_FLIP_X | GID_FLIP_Y)
-
-        return gid, flags
-
-
-    def parse_map(node):
-        """
-        parse a map node from a tiled tmx file
-        return a tiledmap
-        """
-
-        tiledmap = TiledMap()
-        tiledmap.filename = filename
-        set_properties(tiledmap, map_node)
-
-        for node in map_node.getElementsByTagName("tileset"):
-            t, tiles = parse_tileset(node)
-            tiledmap.tilesets.append(t)
-            tiledmap.tile_properties.update(tiles)
-
-        for node in dom.getElementsByTagName("layer"):
-            l = parse_layer(tiledmap.tilesets, node)
-            tiledmap.tilelayers.append(l)
-            tiledmap.layers.append(l)
-
-        for node in dom.getElementsByTagName("objectgroup"):
-            o = parse_objectgroup(node)
-            tiledmap.objectgroups.append(o)
-            tiledmap.layers.append(o)
-
-        return tiledmap
-
 
     def parse_tileset(node, firstgid=None):
         """
@@ -402,12 +571,11 @@ def load_tmx(filename):
 
         # since tile objects probably don't have a lot of metadata,
         # we store it separately from the class itself
-        for child in node.childNodes:
-            if child.nodeName == "tile":
-                p = get_properties(child)
-                gid = p["id"] + tileset.firstgid
-                del p["id"]
-                tiles[gid] = p
+        for child in node.findall("tile"):
+            p = get_properties(child)
+            gid = p["id"] + tileset.firstgid
+            del p["id"]
+            tiles[gid] = p
 
         # check for tiled "external tilesets"
         if hasattr(tileset, "source"):
@@ -419,17 +587,18 @@ def load_tmx(filename):
                 except IOError:
                     raise IOError("Cannot load external tileset: " + path)
 
-                tileset_node = tsx.getElementsByTagName("tileset")[0]
+                tileset_node = tsx.getroot()
+                source = tileset.source
                 tileset, tiles = parse_tileset(tileset_node, tileset.firstgid)
+
+                # remembered so compiled maps know to check it for changes
+                tileset.tsx = source
             else:
                 raise Exception("Found external tileset, but cannot handle type: " + tileset.source)
 
         # if we have an "image" tag, process it here
-        try:
-            image_node = node.getElementsByTagName("image")[0]
-        except IndexError:
-            pass
-        else:
+        image_node = node.find("image")
+        if image_node is not None:
             attr = get_attributes(image_node)
             tileset.source = attr["source"]
             tileset.trans = attr["trans"]
@@ -438,74 +607,59 @@ def load_tmx(filename):
             x, r = divmod(attr["width"], tileset.tilewidth)
             y, r = divmod(attr["height"], tileset.tileheight)
 
-            tileset.lastgid = tileset.firstgid + x + y
+            tileset.lastgid = tileset.firstgid + x * y - 1
 
         return tileset, tiles
 
 
-    def parse_layer(tilesets, node):
+    def parse_layer(node, tile_gids=None):
         """
         parse a layer element and return a layer object
 
-        tilesets is required since we need to mangle gid's here
+        tile_gids holds the gids of the <tile> elements if they were
+        collected (and dropped) while streaming
         """
 
         layer = TiledLayer()
-        layer.data = []
-        layer.flipped_tiles = []
         set_properties(layer, node)
+        # the tiled properties alone, as they are mixed with the xml attributes above
+        layer.properties = parse_properties(node)
 
         data = None
-        next_gid = None
 
-        data_node = node.getElementsByTagName("data")[0]
+        data_node = node.find("data")
         attr = get_attributes(data_node)
 
         if attr["encoding"] == "base64":
             from base64 import b64decode
-            data = b64decode(bytes(data_node.lastChild.nodeValue, 'ascii'))
+            data = b64decode(data_node.text.strip())
 
         elif attr["encoding"] == "csv":
-            next_gid = map(int, "".join([line.strip() for line in data_node.lastChild.nodeValue]).split(","))
+            # scan the numbers one at a time, so the layer is never split
+            # into a list of strings
+            data = array.array(_UINT32, (int(m.group()) for m in re.finditer(r"\d+", data_node.text)))
 
         elif not attr["encoding"] is None:
             raise Exception("TMX encoding type: " + str(attr["encoding"]) + " is not supported.")
 
-        if attr["compression"] == "gzip":
-            from io import BytesIO
-            import gzip
-            with gzip.GzipFile(fileobj=BytesIO(data)) as fh:
-                data = fh.read()
+        if attr["compression"] in ("gzip", "zlib"):
+            data = decompress(data, attr["compression"], layer.width * layer.height * 4)
 
         elif not attr["compression"] is None:
             raise Exception("TMX compression type: " + str(attr["compression"]) + " is not supported.")
 
-        # if data is None, then it was not decoded or decompressed, so
-        # we assume here that it is going to be a bunch of tile elements
-        if attr["encoding"] == next_gid is None:
-            def get_children(parent):
-                for child in parent.getElementsByTagName("tile"):
-                    yield int(child.getAttribute("gid"))
-
-            next_gid = get_children(data_node)
+        # if there is no encoding, we assume here that it is going to be a
+        # bunch of tile elements
+        if attr["encoding"] is None:
+            data = tile_gids
+            if data is None:
+                data = array.array(_UINT32, (int(child.get("gid"))
+                                   for child in data_node.iterfind("tile")))
 
-        elif not data is None:
-            # cast the data as a list of 32-bit integers
-            def u(i): return unpack("<L", bytes(i))[0]
-            next_gid = map(u, group(data, 4))
+        if isinstance(data, array.array) and sys.byteorder == "big":
+            data.byteswap()
 
-        gids = [ i.firstgid for i in tilesets ]
-
-        # fill up our 2D array of gids.
-        for y in range(layer.height):
-
-            # store as 16-bit ints, since we will never use enough tiles to fill a 32-bit int
-            layer.data.append(array.array("H"))
-
-            for x in range(layer.width):
-                gid, flags = decode_gid(next(next_gid))
-                if not flags == 0: layer.flipped_tiles.append((x, y, gid, flags))
-                layer.data[y].append(gid)
+        layer.data, layer.flags = decode_gids(data, layer.width, layer.height)
 
         return layer
 
@@ -518,7 +672,7 @@ def load_tmx(filename):
         objgroup = TiledObjectGroup()
         set_properties(objgroup, node)
 
-        for subnode in node.getElementsByTagName("object"):
+        for subnode in node.findall("object"):
             obj = TiledObject()
             set_properties(obj, subnode)
             objgroup.objects.append(obj)
@@ -526,109 +680,390 @@ def load_tmx(filename):
         return objgroup
 
 
-    # open and read our TMX (which is really just xml)
-    dom = parse(filename)
-    map_node =  dom.getElementsByTagName("map")[0]
-    return parse_map(map_node)
+    # stream our TMX (which is really just xml).  the children of the map
+    # are handled as soon as they are complete, then dropped.
+    tiledmap = TiledMap()
+    tiledmap.filename = filename
+    map_node = None
+    data_node = None
+    tile_gids = None
+    depth = 0
+
+    for event, node in iterparse(filename, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                map_node = node
+                set_properties(tiledmap, node)
+            elif depth == 3 and node.tag == "data" and node.get("encoding") is None:
+                data_node = node
+                tile_gids = array.array(_UINT32)
+            continue
+
+        depth -= 1
+        if depth == 3 and data_node is not None and node.tag == "tile":
+            # layer data as <tile> elements: keep just the gid
+            tile_gids.append(int(node.get("gid")))
+            data_node.remove(node)
+            continue
+        if depth != 1:
+            continue
+
+        if node.tag == "tileset":
+            t, tiles = parse_tileset(node)
+            tiledmap.tilesets.append(t)
+            tiledmap.tile_properties.update(tiles)
+
+        elif node.tag == "layer":
+            l = parse_layer(node, tile_gids)
+            data_node = tile_gids = None
+            tiledmap.tilelayers.append(l)
+            tiledmap.layers.append(l)
+
+        elif node.tag == "objectgroup":
+            o = parse_objectgroup(node)
+            tiledmap.objectgroups.append(o)
+            tiledmap.layers.append(o)
+
+        elif node.tag == "properties":
+            [ setattr(tiledmap, k, v) for k,v in list(parse_properties(map_node).items()) ]
+
+        map_node.remove(node)
 
+    return tiledmap
 
-def load_pygame(filename):
+
+class TileDeduper(object):
     """
-    load a tiled TMX map for use with pygame
+    finds identical tiles by a digest of their pixels, so they can share one
+    surface.  the digests are kept for the whole process, so tiles are shared
+    across every map loaded with load_pygame, even between different sheets.
+
+    only the digest and the location of the first tile seen with it are
+    kept, not the pixels.  sheets are known by their resolved path, and the
+    tiles of a sheet are forgotten once its file changes (see check), as
+    the images cache reloads it then.
     """
 
-    from pygame import Surface
-    import pygame, os
+    def __init__(self):
+        self.sources = {}       # digest: (path, trans, rect) of the first tile
+        self.stamps = {}        # path: modification time of the sheet when scanned
+        self.tiles = 0          # tiles looked at
+        self.duplicates = 0     # tiles that were already seen
+        self.bytes_saved = 0    # pixel bytes of the duplicates
 
-    tiledmap = load_tmx(filename)
+    def scan(self, image, tile_size, trans=None):
+        """
+        return (rect, digest) for each whole tile of a sheet, row by row
 
-    # cache will find duplicate tiles to reduce memory usage
-    # mostly this is a problem in the blank areas of a tilemap
-    cache = {}
+        each row of tiles is copied into one reused strip, tile under tile,
+        so every tile's pixels are hashed in one piece without making a
+        surface or a bytes copy for it.  the strip is 32-bit RGBA whatever
+        the format of the sheet.
 
-    # just a precaution to make sure tileset images are added in the correct order
-    for firstgid, t in sorted([ (t.firstgid, t) for t in tiledmap.tilesets ]):
-        path = os.path.join(os.path.dirname(tiledmap.filename), t.source)
+        with a trans colorkey the sheet is hashed as it looks converted
+        (see images.convert): opaque, with the colorkey pixels transparent.
+        so the digests are the same before and after the display exists.
+        """
 
-        image = pygame.image.load(path)
+        import pygame
+
+        w, h = image.get_size()
+        tw, th = tile_size
+        cols, rows = w // tw, h // th
+        size = tw * th * 4
+        # the same pixels with another tile size or colorkey make another tile
+        salt = repr((tw, th, trans)).encode("ascii")
+
+        if trans is not None:
+            if image.get_flags() & pygame.SRCALPHA:
+                # converting with a colorkey drops the alpha channel
+                image = pygame.image.frombuffer(pygame.image.tostring(image, "RGB"), (w, h), "RGB")
+            elif image.get_colorkey() is None:
+                image = image.copy()
+            if image.get_colorkey() is None:
+                image.set_colorkey(pygame.Color("#" + trans))
+
+        if not image.get_flags() & pygame.SRCALPHA:
+            # without per-pixel alpha a plain blit copies the sheet exactly,
+            # and adding from the copy is far quicker than from 8 or 24 bits
+            sheet = pygame.Surface((w, h), pygame.SRCALPHA, 32)
+            sheet.blit(image, (0, 0))
+            image = sheet
+
+        strip = pygame.Surface((tw, th * cols), pygame.SRCALPHA, 32)
+        found = []
+        for band in range(rows):
+            # adding onto zeroed pixels copies them exactly, alpha included
+            strip.fill((0, 0, 0, 0))
+            strip.blits([ (image, (0, x * th), pygame.Rect(x * tw, band * th, tw, th),
+                           pygame.BLEND_RGBA_MAX) for x in range(cols) ], False)
+            pixels = memoryview(strip.get_view("0"))
+            for x in range(cols):
+                # sha256 has hardware support on most CPUs, which makes it the
+                # quickest of the hashlib digests here
+                digest = hashlib.sha256(salt)
+                digest.update(pixels[x * size:(x + 1) * size])
+                found.append((pygame.Rect(x * tw, band * th, tw, th), digest.digest()))
+            pixels.release()
+        return found
+
+    def check(self, path):
+        """
+        forget the tiles of the sheet at path (a resolved path) if its file
+        changed since they were recorded.  called before a sheet is scanned
+        """
 
-        w, h = image.get_rect().size
+        import os
 
-        tile_size = (t.tilewidth, t.tileheight)
+        mtime = os.stat(path).st_mtime_ns
+        if self.stamps.setdefault(path, mtime) != mtime:
+            self.sources = dict((digest, source) for digest, source in self.sources.items()
+                                if source[0] != path)
+            self.stamps[path] = mtime
 
-        # some tileset images may be slightly larger than the tiles area
-        # ie: may include a banner, copyright, etc.  this compensates for that
-        for y in range(0, int(h / t.tileheight) * t.tileheight, t.tileheight):
-            for x in range(0, int(w / t.tilewidth) * t.tilewidth, t.tilewidth):
+    def add(self, digest, source, size):
+        """
+        record a tile found at source, a (path, trans, rect) tuple with the
+        sheet's resolved path, and return the source of the first tile with
+        the same digest (maybe this one).  size is the number of bytes of the
+        tile's pixels
+        """
 
-                # somewhat handle transparency, though colorkey handling is not tested
-                if t.trans is None:
-                    tile = Surface(tile_size, pygame.SRCALPHA)
-                else:
-                    tile = Surface(tile_size)
+        self.tiles += 1
+        first = self.sources.get(digest)
+        if first is not None and first[0] != source[0]:
+            # another sheet, which may have changed since
+            try:
+                self.check(first[0])
+            except OSError:
+                self.sources = dict((d, s) for d, s in self.sources.items() if s[0] != first[0])
+            first = self.sources.get(digest)
+        if first is None:
+            first = self.sources[digest] = source
+        if first is not source:
+            self.duplicates += 1
+            self.bytes_saved += size
+        return first
 
-                # blit the smaller portion onto a new image from the larger one
-                tile.blit(image, (0,0), ((x, y), tile_size))
+    def stats(self):
+        return {"tiles": self.tiles, "unique": self.tiles - self.duplicates,
+                "duplicates": self.duplicates, "bytes_saved": self.bytes_saved}
 
-                # make a unique id for this image, not sure if this is the best way, but it works
-                key = pygame.image.tostring(tile, "RGBA")
+    def clear(self):
+        self.sources.clear()
+        self.stamps.clear()
+        self.tiles = self.duplicates = self.bytes_saved = 0
 
-                # make sure we don't have a duplicate tile
-                try:
-                    tile = cache[key]
-                except KeyError:
-                    if t.trans is None:
-                        tile = tile.convert_alpha()
-                    else:
-                        tile = tile.convert()
-                        tile.set_colorkey((0,0,0))
-
-                    # update the cache
-                    cache[key] = tile
-
-                tiledmap.images.append(tile)
-
-    # correctly handle transformed tiles.  currently flipped tiles
-    # work by creating a new gid for the flipped tile and changing the gid
-    # in the layer to the new gid.
-    for layer in tiledmap.tilelayers:
-        for x, y, gid, trans in layer.flipped_tiles:
-            fx = trans & FLIP_X == FLIP_X
-            fy = trans & FLIP_Y == FLIP_Y
 
-            tile = pygame.transform.flip(tiledmap.images[gid], fx, fy)
+# shared by every map loaded with load_pygame
+deduper = TileDeduper()
+
+
+def load_pygame(filename, atlas=None, cache=False, workers=None, cache_dir=None):
+    """
+    load a tiled TMX map for use with pygame
+
+    tiles are subsurfaces of the tileset images, which are shared through
+    the images cache with every other map using them.
+
+    atlas can be an atlas.Atlas holding the tileset images, or True to pack
+    them into one that is cached in a ".atlas" folder next to the map.
+
+    cache and cache_dir are passed on to load_tmx.
+
+    the tileset images are decoded by workers threads first (see
+    images.preload), then sliced on this thread.
+    """
+
+    import pygame, os
+    import images
+
+    tiledmap = load_tmx(filename, cache, cache_dir)
+
+    if atlas is True:
+        from atlas import load_atlas
+        folder = os.path.dirname(tiledmap.filename)
+        atlas = load_atlas([ os.path.join(folder, t.source) for t in tiledmap.tilesets ],
+                           os.path.join(folder, ".atlas"),
+                           trans=dict((os.path.join(folder, t.source), t.trans)
+                                      for t in tiledmap.tilesets))
+
+    # tiles are subsurfaces of their (shared) tileset image.  they are
+    # cut again once the display exists and the images are converted.
+    # keyed by id(tile)
+    sources = {}
+
+    def get_sheet(path, trans):
+        # an atlas image packed with another colorkey can't be used
+        if atlas is not None and atlas.has(path, trans):
+            return atlas.get(path)
+        if trans is None:
+            return images.load(path, True)
+        return images.load(path, False, pygame.Color("#" + trans))
+
+    folder = os.path.dirname(tiledmap.filename)
+    images.preload([ os.path.join(folder, t.source) for t in tiledmap.tilesets
+                     if atlas is None or not atlas.has(os.path.join(folder, t.source), t.trans) ],
+                   workers)
+
+    # identical tiles share one surface (see TileDeduper); this is mostly
+    # for the blank areas of a tilemap.  keyed by digest, for this map
+    unique = {}
+
+    # just a precaution to make sure tileset images are added in the correct order
+    for firstgid, t in sorted([ (t.firstgid, t) for t in tiledmap.tilesets ]):
+        path = os.path.join(os.path.dirname(tiledmap.filename), t.source)
+
+        image = get_sheet(path, t.trans)
+        size = t.tilewidth * t.tileheight * image.get_bytesize()
+        real = os.path.realpath(path)
+        deduper.check(real)
+
+        # some tileset images may be slightly larger than the tiles area
+        # ie: may include a banner, copyright, etc.  only whole tiles are used
+        for rect, digest in deduper.scan(image, (t.tilewidth, t.tileheight), t.trans):
+            source = deduper.add(digest, (real, t.trans, rect), size)
+            try:
+                tile = unique[digest]
+            except KeyError:
+                # transparency is handled when the tileset image is converted
+                if source[0] == real:
+                    # by the map's own path, which the atlas knows it by
+                    source = (path, t.trans, source[2])
+                    tile = image.subsurface(source[2])
+                else:
+                    tile = get_sheet(source[0], source[1]).subsurface(source[2])
+                sources[id(tile)] = source
+                unique[digest] = tile
+
             tiledmap.images.append(tile)
 
-            # change the original gid in the layer data to the new gid
-            layer.data[y][x] = len(tiledmap.images) - 1
+    # flipped tiles keep their gid; their flip flags pick a transformed copy
+    # of its image, made once for each distinct (gid, flags) and shared
+    def make_variant(image, flags):
+        # tiled flips diagonally (swapping x and y) first
+        if flags & FLIP_D:
+            image = pygame.transform.flip(pygame.transform.rotate(image, 90), False, True)
+        return pygame.transform.flip(image, flags & FLIP_X, flags & FLIP_Y)
 
-        del layer.flipped_tiles
-    del cache
+    tiledmap.make_variant = make_variant
+    for layer in tiledmap.tilelayers:
+        if layer.flags is None: continue
+        gids, flags = layer.data.array, layer.flags.array
+        for match in re.finditer(b"[^\x00]", flags):
+            i = match.start()
+            tiledmap.get_variant(gids[i], flags[i])
+    del unique
+
+    def convert_tiles():
+        # duplicate tiles share one Surface, so cut each only once
+        converted = {}
+        for i, tile in enumerate(tiledmap.images):
+            if not tile: continue
+            try:
+                tiledmap.images[i] = converted[id(tile)]
+            except KeyError:
+                path, trans, rect = sources[id(tile)]
+                converted[id(tile)] = get_sheet(path, trans).subsurface(rect)
+                tiledmap.images[i] = converted[id(tile)]
+
+        # and flip the converted tiles again
+        variants = list(tiledmap.variants)
+        tiledmap.variants.clear()
+        for gid, flags in variants:
+            tiledmap.get_variant(gid, flags)
+
+    # if the display already exists the tiles were cut from converted images
+    if not images.display_ready():
+        images.when_ready(convert_tiles)
 
     return tiledmap
 
 class TiledRenderer(object):
     """
     Super simple way to render a tiled map
+
+    layers are drawn in the order of TiledMap.getDrawOrder: hidden layers
+    are skipped, only the tiles and objects in view are drawn, each tile
+    layer with one Surface.blits call, and translucent layers are composed
+    through a buffer the size of the view.
     """
 
     def __init__(self, filename):
         self.tiledmap = load_pygame(filename)
 
+        # for layers with an opacity below 1, made as needed
+        self.buffer = None
+
+    def render(self, surface, view=None):
+        """
+        draw the map on surface
+
+        view is the rect of the map (in pixels) drawn, and defaults to the
+        size of surface from the top left corner of the map.
+        """
+
+        import pygame
 
-    def render(self, surface):
-        # not going for effeciency here
-        # for demonstration purposes only
+        if view is None:
+            view = surface.get_rect()
+        view = pygame.Rect(view)
 
         tw = self.tiledmap.tilewidth
         th = self.tiledmap.tileheight
-        gt = self.tiledmap.getTileImage
 
-        for l in xrange(0, len(self.tiledmap.tilelayers)):
-            for y in xrange(0, self.tiledmap.height):
-                for x in xrange(0, self.tiledmap.width):
-                    tile = gt(x, y, l)
-                    if tile: surface.blit(tile, (x*tw, y*th))
+        # the tiles in view, including the ones it only partly covers
+        x0, y0 = view.left // tw, view.top // th
+        area = (x0, y0, -(-view.right // tw) - x0, -(-view.bottom // th) - y0)
+        origin = (-view.left, -view.top)
+
+        for layer in self.tiledmap.getDrawOrder():
+            if layer.opacity <= 0: continue
+
+            if isinstance(layer, TiledLayer):
+                blits = self.tiledmap.getTileImages(area, self.tiledmap.tilelayers.index(layer), origin)
+            else:
+                blits = self.getObjectImages(layer, view)
+            if not blits: continue
+
+            if layer.opacity >= 1:
+                surface.blits(blits, False)
+                continue
+
+            if self.buffer is None or self.buffer.get_size() != view.size:
+                self.buffer = pygame.Surface(view.size, pygame.SRCALPHA, 32)
+            self.buffer.fill((0, 0, 0, 0))
+            self.buffer.blits(blits, False)
+            self.buffer.set_alpha(int(layer.opacity * 255))
+            surface.blit(self.buffer, (0, 0))
+
+    def getObjectImages(self, group, view):
+        """
+        return the tile objects of an object group that are in view as
+        (image, position) pairs, in the order they are drawn.  objects
+        without a gid are shapes, and are not drawn.
+        """
+
+        objects = [ obj for obj in group.objects if obj.gid ]
+        if getattr(group, "draworder", "topdown") == "topdown":
+            objects.sort(key=lambda obj: obj.y)
+
+        blits = []
+        for obj in objects:
+            # the flip flags of an object are part of its gid, as in the layer data
+            gid = obj.gid & ~(GID_FLIP_X | GID_FLIP_Y | GID_FLIP_D)
+            flags = _FLAGS_TABLE[obj.gid >> 24 & 0xff]
+            image = self.tiledmap.get_variant(gid, flags) if flags else self.tiledmap.images[gid]
+            if not image: continue
+
+            # tile objects are placed by their bottom left corner
+            w, h = image.get_size()
+            x, y = obj.x, obj.y - h
+            if x < view.right and y < view.bottom and x + w > view.left and y + h > view.top:
+                blits.append((image, (x - view.left, y - view.top)))
+
+        return blits
 
 if __name__ == '__main__':
     print('[tmxloader] starting built-in test')
@@ -19,8 +19,13 @@ import json
 import pygame
 import logging
 from pprint import pprint
+from pygame import Rect
 from pygame.locals import Color
 
+# Local Imports
+import images
+from render import TileRenderer, ChunkRenderer, ScrollRenderer, DirtyRects, DEFAULT_CHUNK_BUDGET
+
 # Declare Alpha
 ALPHA = (100, 100, 100)
 
@@ -52,23 +57,39 @@ class Tile(pygame.sprite.Sprite):
 		# Call the parent class (Sprite) constructor 
 		pygame.sprite.Sprite.__init__(self)
 		
-		#  Try to load image
+		#  Try to load image (shared with other tiles using the same file). Only its path is queued
+		#  to be converted to the display format (keeping .PNG transparency) once the display exists,
+		#  the tile looks the converted image up the next time it is used
+		self._converted = False
 		if os.path.exists(img_path):
-			# Create an image
-			tmp_image = pygame.image.load(img_path)
+			self._path = img_path
+			self._image = images.load_queued(img_path)
 		else:
 			# Else return a blank surface
-			tmp_image = pygame.Surface(size)
-
-		# Sets .PNG transparency to PyGame transparency
-		# self.image = tmp_image.convert_alpha() 
-		self.image = tmp_image # hack
+			self._path = None
+			self._image = pygame.Surface((check_size, check_size))
 
 		# Check Image Dimensions
-		if not self.image.get_size() == (check_size, check_size): 
-			print(self.image.get_size())
+		if not self._image.get_size() == (check_size, check_size): 
+			print(self._image.get_size())
 			raise ValueError("Invalid image size.")
 
+	@property
+	def image(self):
+		"""The tile's image, in the display format once the display exists."""
+		if not self._converted and images.display_ready():
+			if self._path is not None:
+				self._image = images.load(self._path)
+			else:
+				self._image = images.convert(self._image)
+			self._converted = True
+		return self._image
+
+	@image.setter
+	def image(self, image):
+		self._image = image
+		self._converted = True
+
 	def render(self, screen, loc):
 		screen.blit(self.image, (loc[0], loc[1]))
 
@@ -98,6 +119,10 @@ class Map:
 		"""Returns the map list index for a given (x,y) location on the grid."""
 		return x + world_grid_size[0] * ( world_grid_size[1] - y - 1 ) - 1
 
+	def get_tile_image(self, x, y):
+		"""Returns the image of the tile at the given (x,y) location on the grid."""
+		return self.map_data[self.get_index(x, y, self.map_size)].image
+
 	def load(self, path):
 		# Get JSON Data
 		data = json.load(open(path))
@@ -146,18 +171,28 @@ class World:
 	fps 			 -- Frames per second to display game. 
 	scroll_speed 	 -- Pixel amount to move view window for every key press. 
 	map 	         -- An array of tile objects. 
+	renderer         -- Draws the visible part of the map. Only tiles on the screen are visited.
+	dirty            -- DirtyRects collecting the changed parts of the screen, or None to flip every frame.
 
 	screen 			 -- Actual display surface.
 	done 	         -- Sentinel for game loop.
 	clock 	         -- Helps track time for FPS and animations.
 
 	Arguments:
-	icon -- Will set the window icon of the window.
+	icon         -- Will set the window icon of the window.
+	chunk_size   -- If set, the map is pre-baked into chunks of chunk_size x chunk_size tiles.
+	chunk_budget -- Memory budget (in bytes) for the baked chunks.
+	scroll_buffer -- If True, the previous frame is kept and only the strips exposed by scrolling are drawn.
+	dirty_rects  -- If True, only the changed parts of the screen are pushed to the display.
+	                Implies scroll_buffer.
+	dirty_threshold -- Fraction of the screen that may change before the whole display is flipped.
 	See data members.
 
 	"""
 	# Constructor and Magics
-	def __init__(self, screen_size, map_obj, icon_path = None, fps = 30, scroll_speed = 10):
+	def __init__(self, screen_size, map_obj, icon_path = None, fps = 30, scroll_speed = 10,
+			chunk_size = None, chunk_budget = DEFAULT_CHUNK_BUDGET, scroll_buffer = False,
+			dirty_rects = False, dirty_threshold = 0.5):
 		"""See World object's Docstring."""
 		# Initialize Data Members
 		self.screen_size = screen_size
@@ -171,6 +206,16 @@ class World:
 		self.fps = fps
 		self.scroll_speed = scroll_speed
 		self.map = []
+		self.renderer = TileRenderer(map_obj.get_tile_image, self.world_grid_size, self.tile_size)
+		if chunk_size:
+			self.renderer = ChunkRenderer(self.renderer, self.world_grid_size, self.tile_size,
+				chunk_size, chunk_budget, alpha = False)
+		if scroll_buffer or dirty_rects:
+			self.renderer = ScrollRenderer(self.renderer, screen_size, self.background_color)
+		self.dirty = None
+		if dirty_rects:
+			self.dirty = DirtyRects(Rect((0, 0), screen_size), dirty_threshold)
+		self._hover_rect = None
 		
 		# Start PyGame
 		pygame.init()
@@ -179,7 +224,11 @@ class World:
 		if not icon_path == None: self._set_icon(icon_path)
 		
 		# Display Screen
-		self.screen = pygame.display.set_mode(screen_size)
+		self.screen = images.set_mode(screen_size)
+
+		# Hover Highlight
+		self._hover_image = pygame.Surface((self.tile_size[0], self.tile_size[1]), pygame.SRCALPHA, 32)
+		self._hover_image.fill((23, 100, 255, 50))
 		
 		# Sentinel and Game Timer
 		self.done = False
@@ -270,6 +319,9 @@ class World:
 		x = (pos[0]+abs(self.offset_x))/self.tile_size[0]
 		y = (pos[1]+abs(self.offset_y))/self.tile_size[1]
 		return (int(x), int(y))
+	def get_view(self):
+		"""Returns the part of the map (in map pixels) currently shown on the screen."""
+		return Rect(-self.offset_x, -self.offset_y, self.screen_size[0], self.screen_size[1])
 
 
 	# Methods
@@ -281,6 +333,43 @@ class World:
 		elif direction == RIGHT: self._move_right(speed)
 		else: logging.warning("Invalid move direction.: " + str(direction) + ".")	
 
+	def _hover_at(self, pos):
+		"""Returns the screen rect of the tile under the given mouse location."""
+		mos_x, mos_y = self.get_tile(pos)
+		x = mos_x*self.tile_size[0] + self.offset_x
+		y = mos_y*self.tile_size[1] + self.offset_y
+		return Rect(x, y, self.tile_size[0], self.tile_size[1])
+
+	def draw(self):
+		"""Draws a frame onto the screen. Returns the screen rects that changed."""
+		hover = self._hover_at(pygame.mouse.get_pos())
+
+		# Redraw Everything
+		if self.dirty is None:
+			self.screen.fill(self.background_color)
+			self.renderer.draw(self.screen, self.get_view())
+			self.screen.blit(self._hover_image, hover)
+			self._hover_rect = hover
+			return [self.screen.get_rect()]
+
+		# Redraw Changed Parts
+		strips = self.renderer.update(self.get_view())
+		buffer = self.renderer.buffer
+		if self.renderer.moved:
+			self.screen.blit(buffer, (0, 0))
+			rects = [self.screen.get_rect()]
+		else:
+			rects = strips
+			if (rects or hover != self._hover_rect) and self._hover_rect is not None:
+				rects.append(self._hover_rect)
+			for rect in rects:
+				self.screen.blit(buffer, rect, rect)
+		if rects or hover != self._hover_rect:
+			self.screen.blit(self._hover_image, hover)
+			rects.append(hover)
+		self._hover_rect = hover
+		return rects
+
 	def run(self):
 		"""
 		Contains the main game loop for the world, which will basically draw everything
@@ -312,26 +401,15 @@ class World:
 			elif key[pygame.K_RIGHT]:
 				self.move(RIGHT, self.scroll_speed) 	
 				
-			# Clear the Screen
-			self.screen.fill(self.background_color)
+			# Draw Frame
+			rects = self.draw()
 
-			# Draw all Sprites
-			for y in range(self.world_grid_size[1]):
-				for x in range(self.world_grid_size[0]):
-					draw_tile = self.map_obj.map_data[self._get_index(x,y)]
-					x_loc = x*self.tile_size[0] + self.offset_x
-					y_loc = y*self.tile_size[1] + self.offset_y
-					draw_tile.render(self.screen, (x_loc, y_loc))
-
-			# Hover Tile
-			mos_x, mos_y = self.get_tile(pygame.mouse.get_pos())
-
-			rect = pygame.Surface((self.tile_size[0], self.tile_size[1]), pygame.SRCALPHA, 32)
-			rect.fill((23, 100, 255, 50))
-			self.screen.blit(rect, (mos_x*self.tile_size[0], mos_y*self.tile_size[1]))
-			
 			# Update Display
-			pygame.display.flip()
+			if self.dirty is None:
+				pygame.display.flip()
+			else:
+				self.dirty.extend(rects)
+				self.dirty.flush()
 			
 			# Limit FPS of Game Loop
 			self.clock.tick(self.fps)